@@ -12,7 +12,7 @@ import sys
 
 sys.path.append("/home/sambray/Documents/MS_analysis_samsplaying/")
 from ms_opto_stim_protocol import OptoStimProtocol
-from Analysis.lfp_analysis import get_ref_electrode_index
+from Analysis.lfp_analysis import get_ref_electrode_index, resolve_session_electrodes
 from spyglass.common import Session, PositionIntervalMap
 
 from spyglass.spikesorting import spikesorting_pipeline_populator, SortGroup
@@ -108,6 +108,8 @@ sessions2 = [
     "Bilbo20230803_.nwb",
 ]
 sessions = sessions + sessions2
+# look up the electrodes of every session together, reused by get_ref_electrode_index
+resolve_session_electrodes(sessions)
 
 from spyglass.common import PositionIntervalMap
 
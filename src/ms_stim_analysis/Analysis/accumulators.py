@@ -0,0 +1,174 @@
+import numpy as np
+
+
+class HistogramAccumulator:
+    """Streaming 1d/2d histogram with optional binned moments and sample reservoir
+
+    Counts (and the sum / sum of squares of an optional value) are
+    accumulated with np.bincount on each call to `add`, so samples from many
+    epochs can be histogrammed without being collected first. Accumulators
+    with the same bins can be merged, e.g. when epochs are processed by
+    different workers.
+
+    Bin edges follow np.histogram: bins are half-open except the last, which
+    includes its right edge. Samples outside the edges are dropped.
+
+    Parameters
+    ----------
+    bins : np.ndarray or list of np.ndarray
+        bin edges, one array per dimension
+    reservoir_size : int, optional
+        number of raw samples to keep (uniformly sampled from everything added),
+        by default 0. Use np.inf to keep all samples
+    rng : np.random.Generator, optional
+        random generator used for the reservoir
+    """
+
+    def __init__(
+        self,
+        bins,
+        reservoir_size: int = 0,
+        rng: np.random.Generator = None,
+    ):
+        if isinstance(bins, np.ndarray) and bins.ndim == 1:
+            bins = [bins]
+        self.bins = [np.asarray(b, dtype=np.float64) for b in bins]
+        self.shape = tuple(len(b) - 1 for b in self.bins)
+        self.counts = np.zeros(self.shape, dtype=np.int64)
+        self.sum = np.zeros(self.shape)
+        self.sum_sq = np.zeros(self.shape)
+        self.n_added = 0
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.default_rng() if rng is None else rng
+        self._reservoir = None
+        self._reservoir_keys = np.zeros(0)
+
+    @property
+    def ndim(self):
+        return len(self.bins)
+
+    def bin_index(self, *coords):
+        """flat bin index of each sample and a mask of samples inside the bins"""
+        n_samples = len(coords[0])
+        valid = np.ones(n_samples, dtype=bool)
+        multi_index = []
+        for x, edges in zip(coords, self.bins):
+            ind = np.searchsorted(edges, x, side="right") - 1
+            # right edge of the last bin is inclusive, as in np.histogram
+            ind[x == edges[-1]] = len(edges) - 2
+            valid &= (ind >= 0) & (ind < len(edges) - 1)
+            multi_index.append(ind)
+        multi_index = [ind[valid] for ind in multi_index]
+        return np.ravel_multi_index(multi_index, self.shape), valid
+
+    def add(self, *coords, values=None):
+        """add samples
+
+        Parameters
+        ----------
+        *coords : np.ndarray
+            coordinates of each sample, one array per dimension
+        values : np.ndarray, optional
+            value of each sample, accumulated as binned sum and sum of squares
+        """
+        if len(coords) != self.ndim:
+            raise ValueError(
+                f"expected {self.ndim} coordinate arrays, got {len(coords)}"
+            )
+        coords = [np.asarray(x, dtype=np.float64).ravel() for x in coords]
+        if len(coords[0]) == 0:
+            return self
+        flat_ind, valid = self.bin_index(*coords)
+        size = self.counts.size
+        self.counts += np.bincount(flat_ind, minlength=size).reshape(self.shape)
+        if values is not None:
+            values = np.asarray(values, dtype=np.float64).ravel()
+            v = values[valid]
+            self.sum += np.bincount(flat_ind, weights=v, minlength=size).reshape(
+                self.shape
+            )
+            self.sum_sq += np.bincount(
+                flat_ind, weights=v**2, minlength=size
+            ).reshape(self.shape)
+        self.n_added += int(valid.sum())
+
+        if self.reservoir_size:
+            samples = np.stack([x[valid] for x in coords], axis=1)
+            if values is not None:
+                samples = np.concatenate([samples, v[:, None]], axis=1)
+            self._add_to_reservoir(samples, self.rng.random(len(samples)))
+        return self
+
+    def _add_to_reservoir(self, samples, keys):
+        # keep the samples with the smallest random keys: a uniform sample of
+        # everything seen so far which stays uniform when reservoirs are merged
+        if self._reservoir is None:
+            self._reservoir = np.zeros((0, samples.shape[1]))
+        samples = np.concatenate([self._reservoir, samples])
+        keys = np.concatenate([self._reservoir_keys, keys])
+        if len(keys) > self.reservoir_size:
+            keep = np.argpartition(keys, int(self.reservoir_size))[
+                : int(self.reservoir_size)
+            ]
+            samples, keys = samples[keep], keys[keep]
+        self._reservoir = samples
+        self._reservoir_keys = keys
+
+    def merge(self, other: "HistogramAccumulator"):
+        """add the contents of another accumulator with the same bins"""
+        if self.shape != other.shape or not all(
+            np.array_equal(a, b) for a, b in zip(self.bins, other.bins)
+        ):
+            raise ValueError("can only merge accumulators with the same bins")
+        self.counts += other.counts
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.n_added += other.n_added
+        if self.reservoir_size and other._reservoir is not None:
+            self._add_to_reservoir(other._reservoir, other._reservoir_keys)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    @classmethod
+    def combine(cls, accumulators: list):
+        """merge a list of accumulators into a new one"""
+        accumulators = list(accumulators)
+        combined = cls(
+            accumulators[0].bins,
+            reservoir_size=accumulators[0].reservoir_size,
+            rng=accumulators[0].rng,
+        )
+        for accumulator in accumulators:
+            combined.merge(accumulator)
+        return combined
+
+    @property
+    def bin_centers(self):
+        centers = [b[:-1] + np.diff(b) / 2 for b in self.bins]
+        return centers[0] if self.ndim == 1 else centers
+
+    @property
+    def mean(self):
+        """mean of the accumulated values in each bin"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum / self.counts
+
+    @property
+    def std(self):
+        """standard deviation of the accumulated values in each bin"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(np.maximum(self.sum_sq / self.counts - self.mean**2, 0))
+
+    def density(self, axis=None):
+        """counts normalized to sum to 1 (along axis if given)"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.counts / self.counts.sum(axis=axis, keepdims=axis is not None)
+
+    @property
+    def samples(self):
+        """reservoir samples as (n_samples, ndim [+ 1 if values were added])"""
+        if self._reservoir is None:
+            return np.zeros((0, self.ndim))
+        return self._reservoir
@@ -0,0 +1,293 @@
+import numpy as np
+
+from .spike_annotation import annotate_spikes, interval_membership
+
+
+def window_pairs(
+    reference_times: np.ndarray,
+    target_times: np.ndarray,
+    min_lag: float,
+    max_lag: float,
+    max_pairs: int = 2**24,
+):
+    """iterate over (reference index, target index) of pairs within a lag window
+
+    Both time arrays must be sorted. For each reference time the targets with
+    min_lag <= target - reference <= max_lag form a contiguous run found with
+    searchsorted, so only pairs inside the window are ever enumerated. Pairs
+    are yielded in chunks of about max_pairs to bound memory.
+
+    Parameters
+    ----------
+    reference_times, target_times : np.ndarray
+        sorted event times
+    min_lag, max_lag : float
+        lag window (target - reference), both edges inclusive
+    max_pairs : int, optional
+        approximate number of pairs per chunk, by default 2**24
+
+    Yields
+    ------
+    reference_index, target_index : np.ndarray
+        indices of the pairs in the chunk
+    """
+    reference_times = np.asarray(reference_times, dtype=np.float64)
+    target_times = np.asarray(target_times, dtype=np.float64)
+    start = np.searchsorted(target_times, reference_times + min_lag, side="left")
+    stop = np.searchsorted(target_times, reference_times + max_lag, side="right")
+    n_pairs = np.maximum(stop - start, 0)
+    cumulative = np.cumsum(n_pairs)
+
+    first = 0
+    while first < len(reference_times):
+        # references whose pairs fit in this chunk (at least one)
+        offset = cumulative[first] - n_pairs[first]
+        last = max(
+            np.searchsorted(cumulative, offset + max_pairs, side="right"), first + 1
+        )
+        counts = n_pairs[first:last]
+        total = int(counts.sum())
+        if total:
+            reference_index = np.repeat(np.arange(first, last), counts)
+            # position of each pair within its reference's run of targets
+            run_offset = np.arange(total) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            yield reference_index, start[reference_index] + run_offset
+        first = last
+
+
+def lag_histogram(
+    reference_times: np.ndarray,
+    target_times: np.ndarray,
+    bins: np.ndarray,
+    min_lag: float = None,
+) -> np.ndarray:
+    """histogram of target - reference lags of every pair of events
+
+    Same counts as np.histogram(np.subtract.outer(target_times,
+    reference_times), bins), but only pairs with a lag inside the bins are
+    enumerated, so time and memory grow with the number of pairs in the window
+    rather than the product of the number of events.
+
+    Parameters
+    ----------
+    reference_times, target_times : np.ndarray
+        event times, pass the same array twice for an autocorrelogram
+        (zero-lag self pairs are counted)
+    bins : np.ndarray
+        lag bin edges
+    min_lag : float, optional
+        drop lags below this, e.g. 0 to only count each pair of an
+        autocorrelogram once, by default bins[0]
+
+    Returns
+    -------
+    np.ndarray
+        counts in each bin
+    """
+    bins = np.asarray(bins, dtype=np.float64)
+    reference_times = np.sort(np.asarray(reference_times, dtype=np.float64))
+    target_times = np.sort(np.asarray(target_times, dtype=np.float64))
+    min_lag = bins[0] if min_lag is None else max(min_lag, bins[0])
+    counts = np.zeros(len(bins) - 1, dtype=np.int64)
+    for reference_index, target_index in window_pairs(
+        reference_times, target_times, min_lag, bins[-1]
+    ):
+        lags = target_times[target_index] - reference_times[reference_index]
+        counts += np.histogram(lags, bins=bins)[0]
+    return counts
+
+
+################################################################################
+# Condition-split correlograms
+
+
+def label_conditions(spike_times: list, interval_lists: list):
+    """all spikes of all units in time order, labeled with their condition
+
+    Parameters
+    ----------
+    spike_times : list
+        spike times of each unit
+    interval_lists : list
+        interval list of each condition (e.g. [control, test]). A spike's
+        condition is the first list containing it, spikes outside all of them
+        are dropped
+
+    Returns
+    -------
+    times, units, conditions : np.ndarray
+        time, unit index and condition index of each spike, sorted by time
+    """
+    annotation = annotate_spikes(spike_times, interval_lists)
+    order = np.argsort(annotation["time"], kind="stable")
+    return (
+        annotation["time"][order],
+        annotation["unit"][order],
+        annotation["interval_id"][order],
+    )
+
+
+def condition_pair_lags(
+    times: np.ndarray,
+    units: np.ndarray,
+    conditions: np.ndarray,
+    pairs: list,
+    n_units: int,
+    min_lag: float,
+    max_lag: float,
+    closest_spike_only: bool = False,
+    max_pairs: int = 2**24,
+):
+    """iterate over the in-window spike pairs of unit pairs, within each condition
+
+    For each requested unit pair (a, b) the lag of a pair of spikes is
+    t_a - t_b, with the spike of a as the reference. Only spike pairs in the
+    same condition and with min_lag <= lag <= max_lag are yielded. Spike pairs
+    of all unit pairs are found in one pass over the time-sorted population
+    (see window_pairs).
+
+    Parameters
+    ----------
+    times, units, conditions : np.ndarray
+        output of label_conditions
+    pairs : list
+        (a, b) unit index pairs
+    n_units : int
+        number of units
+    min_lag, max_lag : float
+        lag window, both edges inclusive
+    closest_spike_only : bool, optional
+        only keep the lag from each reference spike to the closest spike of b
+        in the same condition (ties go to the earlier spike, as np.argmin), and
+        only if it falls in the window, by default False
+    max_pairs : int, optional
+        approximate number of spike pairs handled at once, by default 2**24
+
+    Yields
+    ------
+    condition, pair, lag, reference : np.ndarray
+        condition index, index into pairs, lag and index (into times) of the
+        reference spike of each spike pair in the chunk
+    """
+    pair_index = np.full((n_units, n_units), -1, dtype=np.int64)
+    for k, (a, b) in enumerate(pairs):
+        pair_index[a, b] = k
+    window = (min_lag, max_lag)
+    if closest_spike_only:
+        # the closest spike may be on the other side of an asymmetric window
+        reach = max(abs(min_lag), abs(max_lag))
+        window = (-reach, reach)
+
+    for reference, target in window_pairs(
+        times, times, -window[1], -window[0], max_pairs=max_pairs
+    ):
+        pair = pair_index[units[reference], units[target]]
+        keep = (pair >= 0) & (conditions[reference] == conditions[target])
+        reference, target, pair = reference[keep], target[keep], pair[keep]
+        lag = times[reference] - times[target]
+        if closest_spike_only:
+            order = np.lexsort((target, np.abs(lag), pair, reference))
+            reference, pair, lag = reference[order], pair[order], lag[order]
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = (reference[1:] != reference[:-1]) | (pair[1:] != pair[:-1])
+            reference, pair, lag = reference[first], pair[first], lag[first]
+        keep = (lag >= min_lag) & (lag <= max_lag)
+        yield conditions[reference[keep]], pair[keep], lag[keep], reference[keep]
+
+
+def condition_correlograms(
+    spike_times: list,
+    interval_lists: list,
+    bins: np.ndarray,
+    pairs: list,
+    closest_spike_only: bool = False,
+) -> np.ndarray:
+    """cross correlogram counts of unit pairs, split by condition
+
+    Every spike is labeled with its condition once and the lag histograms of
+    all pairs and conditions are built in one pass (condition_pair_lags).
+    Lags are t_a - t_b for each pair (a, b) and are binned on
+    [bins[0], bins[-1]), both spikes in the same condition.
+
+    Parameters
+    ----------
+    spike_times : list
+        spike times of each unit
+    interval_lists : list
+        interval list of each condition (e.g. [control, test])
+    bins : np.ndarray
+        lag bin edges
+    pairs : list
+        (a, b) unit index pairs
+    closest_spike_only : bool, optional
+        see condition_pair_lags, by default False
+
+    Returns
+    -------
+    np.ndarray
+        (n_conditions, n_pairs, n_bins) counts
+    """
+    bins = np.asarray(bins, dtype=np.float64)
+    n_conditions, n_pairs, n_bins = len(interval_lists), len(pairs), len(bins) - 1
+    counts = np.zeros(n_conditions * n_pairs * n_bins, dtype=np.int64)
+    times, units, conditions = label_conditions(spike_times, interval_lists)
+    for condition, pair, lag, _ in condition_pair_lags(
+        times,
+        units,
+        conditions,
+        pairs,
+        len(spike_times),
+        bins[0],
+        bins[-1],
+        closest_spike_only=closest_spike_only,
+    ):
+        keep = lag < bins[-1]
+        lag_bin = np.searchsorted(bins, lag[keep], side="right") - 1
+        index = (condition[keep] * n_pairs + pair[keep]) * n_bins + lag_bin
+        counts += np.bincount(index, minlength=counts.size)
+    return counts.reshape(n_conditions, n_pairs, n_bins)
+
+
+def condition_bin_counts(
+    spike_times: list, interval_lists: list, lags: np.ndarray
+) -> np.ndarray:
+    """number of spikes of each unit whose lagged time stays in the condition
+
+    For spikes of a unit inside a condition's intervals, counts the spikes
+    x with x + lag also inside them, for every lag. This is the number of
+    valid reference spikes used to turn correlogram counts into rates.
+
+    Parameters
+    ----------
+    spike_times : list
+        spike times of each unit
+    interval_lists : list
+        interval list of each condition
+    lags : np.ndarray
+        lag of each bin (e.g. bin centers)
+
+    Returns
+    -------
+    np.ndarray
+        (n_conditions, n_units, n_lags) counts
+    """
+    lags = np.asarray(lags, dtype=np.float64)
+    counts = np.zeros(
+        (len(interval_lists), len(spike_times), lags.size), dtype=np.int64
+    )
+    for i, intervals in enumerate(interval_lists):
+        intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+        # (n_intervals, n_lags) bounds on the spike time for x + lag to be inside
+        starts = intervals[:, :1] - lags[None]
+        stops = intervals[:, 1:] - lags[None]
+        for unit, spikes in enumerate(spike_times):
+            spikes = np.sort(np.asarray(spikes, dtype=np.float64))
+            spikes = spikes[interval_membership(intervals, spikes)]
+            counts[i, unit] = np.sum(
+                np.searchsorted(spikes, stops, side="right")
+                - np.searchsorted(spikes, starts, side="left"),
+                axis=0,
+            )
+    return counts
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+from spyglass.decoding.v1.sorted_spikes import SortedSpikesDecodingV1
+
+from .utils import get_cache_dir
+
+# upper bound on the size (on disk) of the models kept in memory by this process
+MODEL_CACHE_MAX_BYTES = 2**32
+
+_model_cache = OrderedDict()  # cache key -> (model, size)
+
+
+def _cache_key(decode_key: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in decode_key.items()))
+
+
+def _decode_key(key: dict) -> dict:
+    """primary key of the single matching decode
+
+    Only the primary key is fetched: fetching the classifier_path filepath
+    attribute checksums the whole classifier file
+    """
+    return (SortedSpikesDecodingV1 & key).fetch1("KEY")
+
+
+def fetch_decoder_model(key: dict):
+    """SortedSpikesDecodingV1.fetch_model with a per-process LRU cache
+
+    Models are kept until the summed size of their files exceeds
+    MODEL_CACHE_MAX_BYTES, then the least recently used are dropped.
+
+    Parameters
+    ----------
+    key : dict
+        restriction selecting a single SortedSpikesDecodingV1 entry
+
+    Returns
+    -------
+    fit classifier model
+    """
+    decode_key = _decode_key(key)
+    cache_key = _cache_key(decode_key)
+    if cache_key in _model_cache:
+        _model_cache.move_to_end(cache_key)
+        return _model_cache[cache_key][0]
+
+    model = (SortedSpikesDecodingV1 & decode_key).fetch_model()
+    classifier_path = (SortedSpikesDecodingV1 & decode_key).fetch1("classifier_path")
+    try:
+        size = os.path.getsize(classifier_path)
+    except OSError:
+        size = 0
+    _model_cache[cache_key] = (model, size)
+    while (
+        len(_model_cache) > 1
+        and sum(size for _, size in _model_cache.values()) > MODEL_CACHE_MAX_BYTES
+    ):
+        _model_cache.popitem(last=False)
+    return model
+
+
+def clear_decoder_model_cache():
+    """drop all models held by fetch_decoder_model"""
+    _model_cache.clear()
+
+
+def _summary_path(decode_key: dict) -> str:
+    name = hashlib.md5(json.dumps(_cache_key(decode_key)).encode()).hexdigest()
+    return os.path.join(get_cache_dir("decoder_summaries"), name + ".npz")
+
+
+def fetch_encoding_summary(key: dict) -> dict:
+    """lightweight encoding model summary of a sorted spikes decode
+
+    The place fields, occupancy, mean rates and place bins of the (first)
+    encoding model are saved to a sidecar file in the cache directory the first
+    time they are requested, so later calls don't load or checksum the
+    classifier at all. Sidecars are keyed on the decode's primary key only,
+    call clear_encoding_summary after recomputing a decode.
+
+    Parameters
+    ----------
+    key : dict
+        restriction selecting a single SortedSpikesDecodingV1 entry
+
+    Returns
+    -------
+    dict
+        place_fields, occupancy, mean_rates, place_bin_centers and
+        place_bin_edges
+    """
+    decode_key = _decode_key(key)
+    path = _summary_path(decode_key)
+    if os.path.exists(path):
+        with np.load(path) as summary:
+            return {k: summary[k] for k in summary.files}
+
+    model = fetch_decoder_model(decode_key)
+    encoding = list(model.encoding_model_.values())[0]
+    summary = {
+        "place_fields": np.asarray(encoding["place_fields"]),
+        "occupancy": np.asarray(encoding["occupancy"]),
+        "mean_rates": np.asarray(encoding["mean_rates"]),
+        "place_bin_centers": np.asarray(encoding["environment"].place_bin_centers_),
+        "place_bin_edges": np.asarray(encoding["environment"].place_bin_edges_),
+    }
+    tmp_path = path[: -len(".npz")] + ".tmp.npz"
+    np.savez(tmp_path, **summary)
+    os.replace(tmp_path, path)
+    return summary
+
+
+def clear_encoding_summary(key: dict = None):
+    """drop the encoding summaries saved by fetch_encoding_summary
+
+    Parameters
+    ----------
+    key : dict, optional
+        only drop the summaries of the matching decodes, by default all
+    """
+    if key is None:
+        paths = [
+            os.path.join(get_cache_dir("decoder_summaries"), name)
+            for name in os.listdir(get_cache_dir("decoder_summaries"))
+        ]
+    else:
+        paths = [
+            _summary_path(decode_key)
+            for decode_key in (SortedSpikesDecodingV1 & key).fetch("KEY")
+        ]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
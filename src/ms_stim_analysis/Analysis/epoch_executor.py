@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import datajoint as dj
+import numpy as np
+from tqdm import tqdm
+
+from .utils import fetch_epoch_names
+
+# each worker holds its own database connection and loads its epoch's LFP and
+# spikes, so keep the default pool small
+DEFAULT_N_WORKERS = 4
+
+
+def dataset_epochs(dataset, limit_1_epoch: bool = False) -> list:
+    """list the epochs of a dataset as keys for map_epochs
+
+    Parameters
+    ----------
+    dataset : UserTable
+        restricted table of epochs, e.g. from filter_opto_data
+    limit_1_epoch : bool, optional
+        only return the first epoch, by default False
+
+    Returns
+    -------
+    list
+        [{"nwb_file_name": ..., "interval_list_name": ...}, ...]
+    """
+    epochs = [
+        {"nwb_file_name": nwb_file_name, "interval_list_name": interval_list_name}
+        for nwb_file_name, interval_list_name in zip(*fetch_epoch_names(dataset))
+    ]
+    if limit_1_epoch:
+        epochs = epochs[:1]
+    return epochs
+
+
+def _init_worker():
+    # every schema and table built before the fork holds a reference to the
+    # forked copy of the parent's Connection object, so reconnect that object
+    # in place rather than replacing the dj.conn singleton. Otherwise all
+    # workers would keep querying over the socket inherited from the parent
+    dj.conn().connect()
+
+
+def _run_epoch(epoch_func, kwargs, seed, item):
+    index, epoch_key = item
+    # seed per epoch so shuffles don't depend on which worker ran the epoch
+    np.random.seed(None if seed is None else [seed, index])
+    return epoch_func(epoch_key, **kwargs)
+
+
+def map_epochs(
+    epoch_func,
+    epoch_keys: list,
+    n_workers: int = None,
+    seed: int = None,
+    **kwargs,
+) -> list:
+    """apply a per-epoch compute function to every epoch of a dataset
+
+    Epochs are independent, so they are run in a process pool with one
+    database connection per worker. Results are returned in the order of
+    epoch_keys regardless of which worker finishes first. Combining results
+    and plotting is left to the caller.
+
+    Parameters
+    ----------
+    epoch_func : callable
+        module level function called as epoch_func(epoch_key, **kwargs)
+    epoch_keys : list
+        keys passed to epoch_func, one per epoch (see dataset_epochs)
+    n_workers : int, optional
+        number of worker processes, by default DEFAULT_N_WORKERS (at most
+        os.cpu_count()). 1 runs serially in the calling process
+    seed : int, optional
+        seed for np.random, set for each epoch from (seed, epoch index), by
+        default None (unseeded)
+    **kwargs
+        passed to epoch_func
+
+    Returns
+    -------
+    list
+        epoch_func output for each epoch key
+    """
+    items = list(enumerate(epoch_keys))
+    if n_workers is None:
+        n_workers = min(DEFAULT_N_WORKERS, os.cpu_count() or 1)
+    n_workers = min(n_workers, len(items))
+    run = partial(_run_epoch, epoch_func, kwargs, seed)
+    if n_workers <= 1:
+        return [run(item) for item in tqdm(items)]
+
+    # fork keeps the already imported schema modules in the workers
+    ctx = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    )
+    with ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=ctx, initializer=_init_worker
+    ) as executor:
+        return list(tqdm(executor.map(run, items), total=len(items)))
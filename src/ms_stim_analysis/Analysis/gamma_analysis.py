@@ -3,18 +3,16 @@ import matplotlib.pyplot as plt
 
 from spyglass.common import Session
 
-from spyglass.common.common_interval import interval_list_contains
-from spyglass.lfp.analysis.v1 import LFPBandV1
-
-from .utils import (
-    filter_opto_data,
-    get_running_valid_intervals,
+from .epoch_executor import dataset_epochs, map_epochs
+from .utils import filter_opto_data
+from .phase_amplitude_coupling import (
+    CONDITIONS,
+    combine_phase_amplitude,
+    epoch_phase_amplitude,
 )
 
-from .lfp_analysis import get_ref_electrode_index
-
-
 LFP_AMP_CUTOFF = 2000
+POWER_FILTERS = ["Slow Gamma 25-55 Hz", "Fast Gamma 65-100 Hz"]
 
 ################################################################################
 
@@ -25,7 +23,46 @@ def gamma_theta_nesting(
     filter_speed: float = 10.0,
     window: float = 1.0,
     return_distributions: bool = False,
+    block_size: float = 10.0,
+    n_boot: int = 1000,
+    reservoir_size: int = 100000,
+    n_workers: int = None,
 ):
+    """phase-amplitude coupling of slow and fast gamma to a phase band
+
+    Coupling curves are built from per-bin sufficient statistics accumulated
+    per epoch, confidence intervals come from a bootstrap over time blocks.
+
+    Parameters
+    ----------
+    dataset_key : dict
+        key defining the dataset (see filter_opto_data)
+    phase_filter_name : str, optional
+        LFPBand filter used for phase, by default "Theta 5-11 Hz"
+    filter_speed : float, optional
+        running speed threshold, by default 10.0
+    window : float, optional
+        unused
+    return_distributions : bool, optional
+        also return (reservoir sampled) phase and log10 power values, by default False
+    block_size : float, optional
+        length of bootstrap blocks (s). If None, whole epochs are resampled
+    n_boot : int, optional
+        number of bootstrap samples, by default 1000
+    reservoir_size : int, optional
+        number of samples kept per band and condition if return_distributions,
+        by default 100000. Use np.inf to keep all samples
+    n_workers : int, optional
+        number of processes used for the per-epoch computation, by default
+        epoch_executor.DEFAULT_N_WORKERS
+
+    Returns
+    -------
+    dict
+        coupling results per band and condition (see combine_phase_amplitude)
+    dict, optional
+        {band: {condition: (phase, log10 power)}} if return_distributions
+    """
     # Use the driving period lfp band if band filter not specified
     if phase_filter_name is None:
         if "period_ms" not in dataset_key:
@@ -35,99 +72,49 @@ def gamma_theta_nesting(
     # Define the dataset (epochs included in this analyusis)
     dataset = filter_opto_data(dataset_key)
 
-    nwb_file_name_list = dataset.fetch("nwb_file_name")
-    interval_list_name_list = dataset.fetch("interval_list_name")
-    power = []
-    phase = []
-
     if len(set((dataset * Session).fetch("subject_id"))) > 1:
         raise NotImplementedError("Only one subject allowed")
 
+    # phase is computed once per epoch and shared by both gamma bands
+    epoch_keys = [
+        {
+            "nwb_file_name": epoch["nwb_file_name"],
+            "target_interval_list_name": epoch["interval_list_name"],
+        }
+        for epoch in dataset_epochs(dataset)
+    ]
+    epoch_results = map_epochs(
+        epoch_phase_amplitude,
+        epoch_keys,
+        n_workers=n_workers,
+        phase_filter_name=phase_filter_name,
+        amplitude_filter_names=POWER_FILTERS,
+        filter_speed=filter_speed,
+        block_size=block_size,
+        reservoir_size=reservoir_size if return_distributions else 0,
+    )
+    epoch_results = [x for x in epoch_results if x is not None]
+    coupling = combine_phase_amplitude(epoch_results, n_boot=n_boot)
+    if len(coupling) == 0 or any(
+        coupling[power_filter][condition]["n_samples"] == 0
+        for power_filter in POWER_FILTERS
+        for condition in CONDITIONS
+    ):
+        return None
+
     # make the figure
     fig, ax_all = plt.subplots(
         2, 4, figsize=(20, 6), gridspec_kw={"width_ratios": [3, 3, 3, 1]}, sharex="col"
     )
-    for power_filter, ax in zip(
-        ["Slow Gamma 25-55 Hz", "Fast Gamma 65-100 Hz"], ax_all
-    ):
-        power_opto = []
-        power_control = []
-        phase_opto = []
-        phase_control = []
-
-        for nwb_file_name, interval_list_name in zip(
-            nwb_file_name_list, interval_list_name_list
-        ):
-            basic_key = {
-                "nwb_file_name": nwb_file_name,
-                "target_interval_list_name": interval_list_name,
-            }
-            print(basic_key)
-
-            # define the key for the band used to define phase
-            phase_key = {
-                **basic_key,
-                "filter_name": phase_filter_name,
-                "filter_sampling_rate": 1000,
-            }
-            # define the key for the band used to define amplitude
-            power_key = {**basic_key, "filter_name": power_filter}
-            print(power_key)
-            print(phase_key)
-
-            # get analytic band power
-            ref_elect_index, basic_key = get_ref_electrode_index(basic_key)
-            power_df = (LFPBandV1 & power_key).compute_signal_power([ref_elect_index])
-            power_ = np.asarray(power_df[power_df.columns[0]])
-            power_timestamps = power_df.index
-
-            # get phase
-            if not (LFPBandV1 & phase_key) or not (LFPBandV1 & power_key):
-                continue
-            phase_df = (LFPBandV1 & phase_key).compute_signal_phase([ref_elect_index])
-            phase_timestamps = phase_df.index
-            phase_ = np.asarray(phase_df)[:, 0]
-
-            # get test and control run intervals
-            pos_key = {
-                **basic_key,
-                "interval_list_name": basic_key["target_interval_list_name"],
-            }
-            opto_run_intervals, control_run_intervals = get_running_valid_intervals(
-                pos_key, filter_speed=filter_speed, seperate_optogenetics=True
-            )
-
-            for intervals, power, phase in zip(
-                [opto_run_intervals, control_run_intervals],
-                [power_opto, power_control],
-                [phase_opto, phase_control],
-            ):
-                valid_times = interval_list_contains(intervals, phase_timestamps)
-                ind_power = np.digitize(valid_times, power_timestamps)
-                power.extend(power_[ind_power - 1])
-                ind_phase = np.digitize(valid_times, phase_timestamps)
-                phase.extend(phase_[ind_phase - 1])
-
-        if len(phase_opto) == 0 or len(phase_control) == 0:
-            return None, None, None, None
-
-        for a, phase, power, color, name in zip(
+    for power_filter, ax in zip(POWER_FILTERS, ax_all):
+        for a, condition, color in zip(
             ax[:2],
-            [phase_opto, phase_control],
-            [power_opto, power_control],
+            CONDITIONS,
             ["firebrick", "cornflowerblue"],
-            ["opto", "control"],
         ):
-            H, xedges, yedges = np.histogram2d(
-                phase,
-                np.log10(power),
-                bins=[np.linspace(0, 2 * np.pi, 100), np.linspace(0, 5, 30)],
-            )
-            # H, xedges, yedges = np.histogram2d(
-            #     phase,
-            #     power,
-            #     bins=[np.linspace(0, 2 * np.pi, 100), np.linspace(0, 1e5, 100)],
-            # )
+            result = coupling[power_filter][condition]
+            H = result["histogram"].counts
+            xedges, yedges = result["histogram"].bins
             extent = [xedges[0], xedges[-1], yedges[0], yedges[-1]]
             H = H / H.sum(axis=1)[:, None]
             a.imshow(
@@ -140,19 +127,13 @@ def gamma_theta_nesting(
             )
             a.set_xlabel("Phase")
             a.set_ylabel("log10 Power")
-            a.set_title(name)
-
-            # val, bins, ind = scipy.stats.binned_statistic(phase, np.log10(power), bins=100)
-            # # val, bins, ind = scipy.stats.binned_statistic(phase, power, bins=100)
-            # bin_centers = bins[:-1] + np.diff(bins) / 2
+            a.set_title(condition)
 
-            bins = np.linspace(0, 2 * np.pi, 65)
-            labels = np.digitize(phase, bins)
-            val, rng_lo, rng_hi = bootstrap_binned(labels, np.log10(power), n_boot=1000)
-            bin_centers = bins[:-1] + np.diff(bins) / 2
-
-            ax[2].plot(bin_centers, val, color=color, label=name)
-            ax[2].fill_between(bin_centers, rng_lo, rng_hi, facecolor=color, alpha=0.3)
+            bin_centers = result["bin_centers"]
+            ax[2].plot(bin_centers, result["mean"], color=color, label=condition)
+            ax[2].fill_between(
+                bin_centers, result["lo"], result["hi"], facecolor=color, alpha=0.3
+            )
             ax[2].set_xlabel("Phase")
             ax[2].set_ylabel(f"log10 Power {power_filter}")
 
@@ -176,19 +157,58 @@ def gamma_theta_nesting(
         a.set_yticks([])
 
     fig.suptitle(f"{dataset_key['animal']}: {dataset_key['period_ms']}ms period")
-    return phase_opto, phase_control, power_opto, power_control
+    if return_distributions:
+        distributions = {
+            power_filter: {
+                condition: tuple(
+                    coupling[power_filter][condition]["histogram"].samples.T
+                )
+                for condition in CONDITIONS
+            }
+            for power_filter in POWER_FILTERS
+        }
+        return coupling, distributions
+    return coupling
 
 
-def bootstrap_binned(labels, values, n_boot=1000):
+def bootstrap_binned(
+    labels, values, n_boot=1000, max_memory=2**28, rng: np.random.Generator = None
+):
+    """bootstrap the mean of values within each label
+
+    Resampling is done in chunks so that no more than ~max_memory bytes of
+    bootstrap draws are held at once. Bins too large for a single resample
+    to fit in memory use Poisson weights accumulated over chunks of samples.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        bin label of each value
+    values : np.ndarray
+        values to bootstrap, nan values are ignored
+    n_boot : int, optional
+        number of bootstrap samples, by default 1000
+    max_memory : int, optional
+        approximate memory budget in bytes, by default 256 MB
+    rng : np.random.Generator, optional
+        random generator, by default np.random.default_rng()
+
+    Returns
+    -------
+    mean, lo, hi : np.ndarray
+        mean, 0.5 and 99.5 percentiles of the bootstrap distribution per unique label
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    labels = np.asarray(labels)
+    values = np.asarray(values, dtype=np.float64)
     unique_labels = np.unique(labels)
     bootstrap_dist = []
 
     for label in unique_labels:
-        ind = labels == label
-        samples = values[ind]
-        boot_samples = np.random.choice(samples, (n_boot, len(samples)))
-        boot_means = np.nanmean(boot_samples, axis=1)
-        bootstrap_dist.append(boot_means)
+        samples = values[labels == label]
+        samples = samples[~np.isnan(samples)]
+        bootstrap_dist.append(_bootstrap_means(samples, n_boot, max_memory, rng))
 
     bootstrap_dist = np.array(bootstrap_dist)
     return (
@@ -196,3 +216,32 @@ def bootstrap_binned(labels, values, n_boot=1000):
         np.percentile(bootstrap_dist, 0.5, axis=1),
         np.percentile(bootstrap_dist, 99.5, axis=1),
     )
+
+
+def _bootstrap_means(samples, n_boot, max_memory, rng):
+    """n_boot bootstrap means of samples using at most ~max_memory bytes"""
+    n = len(samples)
+    if n == 0:
+        return np.full(n_boot, np.nan)
+    # each draw holds an int64 index and the float64 value it selects
+    bytes_per_draw = 16
+    rows_per_chunk = max_memory // (n * bytes_per_draw)
+    if rows_per_chunk >= 1:
+        boot_means = np.empty(n_boot)
+        for start in range(0, n_boot, rows_per_chunk):
+            stop = min(start + rows_per_chunk, n_boot)
+            ind = rng.integers(0, n, (stop - start, n))
+            boot_means[start:stop] = samples[ind].mean(axis=1)
+        return boot_means
+
+    # a single resample does not fit: Poisson bootstrap over chunks of samples
+    chunk_size = max(1, max_memory // (n_boot * bytes_per_draw))
+    weighted_sum = np.zeros(n_boot)
+    weight_total = np.zeros(n_boot)
+    for start in range(0, n, chunk_size):
+        chunk = samples[start : start + chunk_size]
+        weights = rng.poisson(1.0, (n_boot, len(chunk))).astype(np.float64)
+        weighted_sum += weights @ chunk
+        weight_total += weights.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return weighted_sum / weight_total
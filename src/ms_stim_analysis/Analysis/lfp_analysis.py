@@ -1,3 +1,5 @@
+import json
+import os
 from typing import Tuple
 import numpy as np
 import matplotlib.pyplot as plt
@@ -13,7 +15,6 @@ from spyglass.common import (
     Session,
     Electrode,
     ElectrodeGroup,
-    get_electrode_indices,
 )
 from spyglass.common.common_interval import interval_list_intersect
 from spyglass.lfp.v1 import (
@@ -29,11 +30,19 @@ from .position_analysis import get_running_intervals, filter_position_ports
 
 from ms_stim_analysis.AnalysisTables.ms_interval import EpochIntervalListName
 
-from ms_stim_analysis.AnalysisTables.ms_opto_stim_protocol import OptoStimProtocol
+from ms_stim_analysis.AnalysisTables.ms_opto_stim_protocol import (
+    OptoStimProtocol,
+    OptoStimPulses,
+)
+from .accumulators import HistogramAccumulator
+from .epoch_executor import dataset_epochs, map_epochs
+from .lfp_band_cache import fetch_band_phase, fetch_band_power
 from .utils import (
     weighted_quantile,
     convert_delta_marks_to_timestamp_values,
     filter_opto_data,
+    fetch_epoch_names,
+    get_cache_dir,
 )
 from .circular_shuffle import (
     normalize_by_index_wrapper,
@@ -51,36 +60,166 @@ logger.addHandler(file_handler)
 
 
 LFP_AMP_CUTOFF = 2000
+PULSE_PHASE_BINS = np.linspace(0, 2 * np.pi, 51)
 
 
 ################################################################################
 
 
+# nwb_file_name -> electrode summary of the session, see resolve_session_electrodes
+_session_electrode_cache = {}
+
+
+def _session_electrode_path(nwb_file_name: str) -> str:
+    return os.path.join(
+        get_cache_dir("session_electrodes"),
+        nwb_file_name.replace(os.sep, "_") + ".json",
+    )
+
+
+def resolve_session_electrodes(nwb_file_names) -> dict:
+    """electrode summary used to pick the reference electrode of each session
+
+    Summaries are kept in memory and saved to the cache directory, so a
+    session is only queried once. Sessions not cached yet are fetched together
+    with one query per table. Sessions without LFP are not cached.
+
+    Parameters
+    ----------
+    nwb_file_names : Iterable[str]
+        sessions to resolve
+
+    Returns
+    -------
+    dict
+        {nwb_file_name: summary} with the lfp electrode groups of the session,
+        the (electrode_group_name, electrode_id) of each lfp electrode group in
+        ascending electrode_id (the column order of the LFPV1 series), the yaml
+        defined reference electrode groups and the first
+        original_reference_electrode
+    """
+    nwb_file_names = list(dict.fromkeys(nwb_file_names))
+    for nwb_file_name in nwb_file_names:
+        path = _session_electrode_path(nwb_file_name)
+        if nwb_file_name not in _session_electrode_cache and os.path.exists(path):
+            with open(path) as f:
+                _session_electrode_cache[nwb_file_name] = json.load(f)
+
+    missing = [
+        {"nwb_file_name": nwb_file_name}
+        for nwb_file_name in nwb_file_names
+        if nwb_file_name not in _session_electrode_cache
+    ]
+    if missing:
+        summaries = {
+            key["nwb_file_name"]: {
+                "lfp_groups": [],
+                "lfp_electrodes": {},
+                "reference_groups": [],
+                "original_reference_electrode": None,
+            }
+            for key in missing
+        }
+        for nwb_file_name, lfp_group in zip(
+            *(LFPV1 & missing).fetch(
+                "nwb_file_name", "lfp_electrode_group_name", order_by="KEY"
+            )
+        ):
+            if lfp_group not in summaries[nwb_file_name]["lfp_groups"]:
+                summaries[nwb_file_name]["lfp_groups"].append(lfp_group)
+        for nwb_file_name, lfp_group, electrode_group, electrode_id in zip(
+            *(LFPElectrodeGroup.LFPElectrode & missing).fetch(
+                "nwb_file_name",
+                "lfp_electrode_group_name",
+                "electrode_group_name",
+                "electrode_id",
+            )
+        ):
+            summaries[nwb_file_name]["lfp_electrodes"].setdefault(lfp_group, []).append(
+                (electrode_group, int(electrode_id))
+            )
+        for nwb_file_name, electrode_group in zip(
+            *(ElectrodeGroup & missing & {"description": "reference"}).fetch(
+                "nwb_file_name", "electrode_group_name", order_by="KEY"
+            )
+        ):
+            summaries[nwb_file_name]["reference_groups"].append(electrode_group)
+        for nwb_file_name, original_reference in zip(
+            *(Electrode & missing).fetch(
+                "nwb_file_name", "original_reference_electrode", order_by="KEY"
+            )
+        ):
+            if summaries[nwb_file_name]["original_reference_electrode"] is None:
+                summaries[nwb_file_name]["original_reference_electrode"] = int(
+                    original_reference
+                )
+
+        for nwb_file_name, summary in summaries.items():
+            if not summary["lfp_groups"]:
+                continue
+            for electrodes in summary["lfp_electrodes"].values():
+                electrodes.sort(key=lambda electrode: electrode[1])
+            _session_electrode_cache[nwb_file_name] = summary
+            path = _session_electrode_path(nwb_file_name)
+            with open(path + ".tmp", "w") as f:
+                json.dump(summary, f)
+            os.replace(path + ".tmp", path)
+
+    return {
+        nwb_file_name: _session_electrode_cache[nwb_file_name]
+        for nwb_file_name in nwb_file_names
+        if nwb_file_name in _session_electrode_cache
+    }
+
+
+def clear_session_electrode_cache(nwb_file_name: str = None):
+    """forget the electrode summary of a session (all sessions if None), e.g.
+    after adding an lfp electrode group"""
+    nwb_file_names = (
+        list(_session_electrode_cache) if nwb_file_name is None else [nwb_file_name]
+    )
+    if nwb_file_name is None:
+        nwb_file_names += [
+            file[: -len(".json")]
+            for file in os.listdir(get_cache_dir("session_electrodes"))
+            if file.endswith(".json")
+        ]
+    for name in set(nwb_file_names):
+        _session_electrode_cache.pop(name, None)
+        path = _session_electrode_path(name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _session_electrodes(key: dict) -> Tuple[dict, list]:
+    """electrode summary of the key's session and the lfp groups matching the key"""
+    nwb_file_name = key["nwb_file_name"]
+    summary = resolve_session_electrodes([nwb_file_name]).get(nwb_file_name)
+    if summary is None:
+        raise ValueError(f"no LFP found for {nwb_file_name}")
+    e_group_name_list = summary["lfp_groups"]
+    if "lfp_electrode_group_name" in key:
+        e_group_name_list = [
+            x for x in e_group_name_list if x == key["lfp_electrode_group_name"]
+        ]
+    return summary, e_group_name_list
+
+
 def get_yaml_defined_reference_electrode(key: dict) -> int:
-    electrode_group_name = (ElectrodeGroup & key & {"description": "reference"}).fetch(
-        "electrode_group_name"
-    )[0]
+    summary, e_group_name_list = _session_electrodes(key)
+    electrode_group_name = summary["reference_groups"][0]
     logger.info(f"key: {key}")
     logger.info(f"electrode_group_name: {electrode_group_name}")
     logger.info("     ")
-    e_group_name_list = (
-        LFPV1 & key & {"electrode_group_name": electrode_group_name}
-    ).fetch("lfp_electrode_group_name")
-    targeted_e_group = list(
-        set(
-            [
-                x
-                for x in e_group_name_list
-                if key["nwb_file_name"].split("_")[0][:-8] in x
-            ]
-        )
-    )[0]
+    targeted_e_group = [
+        x for x in e_group_name_list if key["nwb_file_name"].split("_")[0][:-8] in x
+    ][0]
     key["lfp_electrode_group_name"] = targeted_e_group
-    ref_electrode_id = (
-        LFPElectrodeGroup().LFPElectrode()
-        & key
-        & {"electrode_group_name": electrode_group_name}
-    ).fetch("electrode_id")[0]
+    ref_electrode_id = [
+        electrode_id
+        for group, electrode_id in summary["lfp_electrodes"][targeted_e_group]
+        if group == electrode_group_name
+    ][0]
     return ref_electrode_id
 
 
@@ -89,6 +228,8 @@ def get_ref_electrode_index(lfp_s_key: dict) -> Tuple[int, dict]:
     given lfp selection key, returns the key with the reference electrode group
     name added
 
+    Uses the cached electrode summary of the session (resolve_session_electrodes)
+
     Parameters
     ----------
     lfp_s_key : dict
@@ -101,7 +242,7 @@ def get_ref_electrode_index(lfp_s_key: dict) -> Tuple[int, dict]:
     """
     nwb_file_name = lfp_s_key["nwb_file_name"]
 
-    e_group_name_list = (LFPV1 & lfp_s_key).fetch("lfp_electrode_group_name")
+    summary, e_group_name_list = _session_electrodes(lfp_s_key)
     if "full_probe" not in e_group_name_list:
         # for terode animals, use the reference electrode defined in the yaml file
         ref_electrode_id = get_yaml_defined_reference_electrode(lfp_s_key)
@@ -118,7 +259,7 @@ def get_ref_electrode_index(lfp_s_key: dict) -> Tuple[int, dict]:
     else:
         lfp_s_key["lfp_electrode_group_name"] = e_group_name_list[0]
     lfp_electrode_ids = [
-        (Electrode & lfp_s_key).fetch("original_reference_electrode")[0],
+        summary["original_reference_electrode"],
     ]
     # # hack for Olive to fix incorrect reference electrode in nwb file
     # if "Olive" in nwb_file_name:
@@ -126,6 +267,39 @@ def get_ref_electrode_index(lfp_s_key: dict) -> Tuple[int, dict]:
     return lfp_electrode_ids[0], lfp_s_key
 
 
+def get_lfp_electrode_index(lfp_s_key: dict, electrode_id: int) -> int:
+    """column of an electrode in the LFPV1 series of lfp_s_key's electrode group
+
+    Same as get_electrode_indices(lfp_eseries, [electrode_id])[0], without
+    loading the series. Like get_electrode_indices, an electrode missing from
+    the group gives the sentinel index 99999999, which callers use to skip
+    the epoch
+
+    Parameters
+    ----------
+    lfp_s_key : dict
+        key with nwb_file_name and lfp_electrode_group_name (e.g. from
+        get_ref_electrode_index)
+    electrode_id : int
+        electrode to find
+
+    Returns
+    -------
+    int
+        column index of the electrode
+    """
+    summary, _ = _session_electrodes(lfp_s_key)
+    electrode_ids = [
+        electrode
+        for _, electrode in summary["lfp_electrodes"].get(
+            lfp_s_key["lfp_electrode_group_name"], []
+        )
+    ]
+    if electrode_id not in electrode_ids:
+        return 99999999
+    return electrode_ids.index(electrode_id)
+
+
 def power_spectrum(
     data: np.ndarray,
     window_size: int,
@@ -262,7 +436,7 @@ def get_control_test_power_spectrum(
     lfp_eseries = (LFPV1 & lfp_s_key).fetch_nwb()[0][
         "lfp"
     ]  # (LFPOutput()).fetch_nwb(restriction=lfp_s_key)[0]["lfp"]
-    lfp_elect_indeces = get_electrode_indices(lfp_eseries, [ref_electrode])
+    lfp_elect_indeces = [get_lfp_electrode_index(lfp_s_key, ref_electrode)]
     if lfp_elect_indeces[0] > 1000:
         return (
             [],
@@ -481,7 +655,7 @@ def get_control_test_power_spectrum_full_probe(
     ref_electrode, lfp_s_key = get_ref_electrode_index(lfp_s_key)
 
     lfp_eseries = (LFPOutput).fetch_nwb(restriction=lfp_s_key)[0]["lfp"]
-    lfp_elect_indeces = get_electrode_indices(lfp_eseries, [ref_electrode])
+    lfp_elect_indeces = [get_lfp_electrode_index(lfp_s_key, ref_electrode)]
     if lfp_elect_indeces[0] > 1000:
         return (
             [],
@@ -600,6 +774,7 @@ def opto_spectrum_analysis(
     window: float = 1.0,
     return_distributions: bool = False,
     dlc_pos=False,
+    n_workers: int = None,
 ):
     """Generates a figure with the power spectrum for the control and test intervals, and the distribution of entrainment statistics
     Normalizes the spectrum power on a per-animal basis, using control interval peak as reference
@@ -617,6 +792,9 @@ def opto_spectrum_analysis(
         window size for the PSD estimate through welch's method, by default 1.0
     return_distributions : bool, optional
         whether to return the entrainment spectrum distributions with the generated figure, by default False
+    n_workers : int, optional
+        number of worker processes used to compute the epochs, by default
+        epoch_executor.DEFAULT_N_WORKERS
 
     Returns
     -------
@@ -685,38 +863,24 @@ def opto_spectrum_analysis(
     control_weight = {}
     f = []
 
-    for nwb_file_name, interval_name in tqdm(
-        zip(dataset.fetch("nwb_file_name"), dataset.fetch("interval_list_name"))
-    ):
-        key = {"nwb_file_name": nwb_file_name, "interval_list_name": interval_name}
-        if len(TrodesPosV1 & key) == 0:
-            print("missing position:", key)
-            continue
-        lfp_key = {
-            "nwb_file_name": nwb_file_name,
-            "target_interval_list_name": interval_name,
-        }
-        if len(LFPV1 & lfp_key) == 0:
-            print("missing lfp:", key)
+    epoch_results = map_epochs(
+        _opto_spectrum_epoch,
+        dataset_epochs(dataset),
+        n_workers=n_workers,
+        filter_speed=filter_speed,
+        filter_name=filter_name,
+        window=window,
+        dlc_pos=dlc_pos,
+    )
+    for epoch_result in epoch_results:
+        if epoch_result is None:
             continue
-        print(key)
-        # get animal name
-        animal = (Session & key).fetch1("subject_id")
+        animal, opto_, control_, opto_w_, control_w_, f_ = epoch_result
         if not animal in opto_power_spectrum:
             opto_power_spectrum[animal] = []
             control_power_spectrum[animal] = []
             opto_weight[animal] = []
             control_weight[animal] = []
-        opto_, control_, opto_w_, control_w_, f_ = get_control_test_power_spectrum(
-            nwb_file_name,
-            None,
-            filter_speed,
-            filter_name,
-            window,
-            pos_interval_name=interval_name,
-            filter_ports=1,
-            dlc_pos=dlc_pos,
-        )
         if len(f_) > 0:
             f = f_.copy()
         opto_power_spectrum[animal].extend(opto_)
@@ -832,6 +996,43 @@ def opto_spectrum_analysis(
     return fig
 
 
+def _opto_spectrum_epoch(
+    epoch: dict,
+    filter_speed: float,
+    filter_name: str,
+    window: float,
+    dlc_pos: bool = False,
+):
+    """control and test power spectra for one epoch of opto_spectrum_analysis"""
+    nwb_file_name = epoch["nwb_file_name"]
+    interval_name = epoch["interval_list_name"]
+    key = {"nwb_file_name": nwb_file_name, "interval_list_name": interval_name}
+    if len(TrodesPosV1 & key) == 0:
+        print("missing position:", key)
+        return None
+    lfp_key = {
+        "nwb_file_name": nwb_file_name,
+        "target_interval_list_name": interval_name,
+    }
+    if len(LFPV1 & lfp_key) == 0:
+        print("missing lfp:", key)
+        return None
+    print(key)
+    # get animal name
+    animal = (Session & key).fetch1("subject_id")
+    opto_, control_, opto_w_, control_w_, f_ = get_control_test_power_spectrum(
+        nwb_file_name,
+        None,
+        filter_speed,
+        filter_name,
+        window,
+        pos_interval_name=interval_name,
+        filter_ports=1,
+        dlc_pos=dlc_pos,
+    )
+    return animal, opto_, control_, opto_w_, control_w_, f_
+
+
 def opto_spectrum_analysis_full_probe(
     dataset_key: dict,
     filter_name: str = "LFP 0-400 Hz",
@@ -874,9 +1075,7 @@ def opto_spectrum_analysis_full_probe(
     control_weight = {}
     f = []
 
-    for nwb_file_name, interval_name in tqdm(
-        zip(dataset.fetch("nwb_file_name"), dataset.fetch("interval_list_name"))
-    ):
+    for nwb_file_name, interval_name in tqdm(zip(*fetch_epoch_names(dataset))):
         key = {"nwb_file_name": nwb_file_name, "interval_list_name": interval_name}
         if len(TrodesPosV1 & key) == 0:
             print("missing position:", key)
@@ -1266,6 +1465,7 @@ def lfp_per_pulse_analysis(
     traces_only=False,
     circular_shuffle=False,
     limit_1_epoch=False,
+    n_workers: int = None,
 ):
     """Generates a figure characterizing the lfp around each stimulus pulse
 
@@ -1291,6 +1491,9 @@ def lfp_per_pulse_analysis(
         whether to circularly shuffle the lfp traces, by default False
     limit_1_epoch : bool, optional
         whether to limit the analysis to 1 epoch per dataset, by default False
+    n_workers : int, optional
+        number of processes used for the per-epoch computation, by default
+        epoch_executor.DEFAULT_N_WORKERS
     Returns
     -------
     matplotlib.figure.Figure
@@ -1329,195 +1532,47 @@ def lfp_per_pulse_analysis(
             ax = fig.get_axes()[:2]
             ax_horiz = fig.get_axes()[2]
             ax_rose = fig.get_axes()[3:]
-    nwb_file_name_list = dataset.fetch("nwb_file_name")
-    interval_list_name_list = dataset.fetch("interval_list_name")
-    if limit_1_epoch:
-        nwb_file_name_list = nwb_file_name_list[:1]
-        interval_list_name_list = interval_list_name_list[:1]
+    if "period_ms" in dataset_key:
+        shuffle_window = dataset_key["period_ms"] / 1000.0
+    else:
+        shuffle_window = 0.125
+
+    epoch_keys = dataset_epochs(dataset, limit_1_epoch)
+    # the epochs only read the pulses, populate them before the pool starts
+    OptoStimPulses().populate(epoch_keys, {"dio_event_name": "stim"})
+    epoch_results = map_epochs(
+        _lfp_per_pulse_epoch,
+        epoch_keys,
+        n_workers=n_workers,
+        filter_name=filter_name,
+        band_filter_name=band_filter_name,
+        lfp_trace_window=lfp_trace_window,
+        pulse_number_list=pulse_number_list,
+        circular_shuffle=circular_shuffle,
+        shuffle_window=shuffle_window,
+        reservoir_size=np.inf if return_data else 0,
+    )
+    epoch_results = [x for x in epoch_results if x is not None]
 
     # get the lfp traces for every relevant pulse
     lfp_traces = [[] for p in pulse_number_list]
     # get time-shuffled lfp_traces for every relevant pulse
     lfp_traces_shuffled = [[] for p in pulse_number_list]
-    # get the lfp phase for every relevant pulse
-    lfp_phase = [[] for p in pulse_number_list]
-    # get the average lfp power within the window for every relevant pulse
-    # lfp_power = [[] for p in pulse_number_list]
-    count = 0
-    for nwb_file_name, interval_list_name in zip(
-        nwb_file_name_list, interval_list_name_list
-    ):
-        basic_key = {
-            "nwb_file_name": nwb_file_name,
-            "target_interval_list_name": interval_list_name,
-            "filter_name": filter_name,
-        }
-        stim_key = {
-            "nwb_file_name": nwb_file_name,
-            "interval_list_name": interval_list_name,
-            "dio_event_name": "stim",
-        }
-        band_key = {
-            "nwb_file_name": nwb_file_name,
-            "target_interval_list_name": interval_list_name,
-            "filter_name": band_filter_name,
-        }
-        if len(LFPV1() & basic_key) == 0:
-            print("missing LFP for: ", basic_key)
-            continue
-        print(basic_key)
-        # get lfp band phase for reference electrode
-        ref_elect, basic_key = get_ref_electrode_index(basic_key)  #
-        # ref_elect = (Electrode() & basic_key).fetch("original_reference_electrode")[0]
-        lfp_eseries = (LFPOutput & basic_key).fetch_nwb(restriction=basic_key)[0]["lfp"]
-        ref_index = get_electrode_indices(lfp_eseries, [ref_elect])
-
-        # get LFP series
-        lfp_df = (LFPV1() & basic_key).fetch_nwb()[0]["lfp"]
-        lfp_df = (LFPV1() & basic_key).fetch1_dataframe()
-        lfp_timestamps = lfp_df.index
-        lfp_ = np.array(lfp_df[ref_index]).astype(float)
-        # nan out artifact intervals
-        artifact_times = (LFPArtifactDetection() & basic_key).fetch1("artifact_times")
-        for artifact in artifact_times:
-            lfp_[
-                np.logical_and(
-                    lfp_timestamps > artifact[0], lfp_timestamps < artifact[1]
-                )
-            ] = np.nan
-
-        ind = np.sort(np.unique(lfp_timestamps, return_index=True)[1])
-        lfp_timestamps = lfp_timestamps[ind]
-        lfp_ = lfp_[ind]
-        try:
-            assert np.all(np.diff(lfp_timestamps) > 0)
-        except:
-            continue
-        # get phase information
-        phase_df = (LFPBandV1() & band_key).compute_signal_phase(
-            electrode_list=[ref_elect]
-        )
-        phase_time = phase_df.index
-        phase_ = np.asarray(phase_df)[:, 0]
-        # get power information
-        # power_df = (LFPBandV1() & band_key).compute_signal_power(
-        #     electrode_list=[ref_elect]
-        # )
-        # power_time = power_df.index
-        # print("POWER", np.mean(np.diff(power_time)))
-        # power_ = np.asarray(power_df)[:, 0]
-
-        # loop through pulse numbers
-        # get times of firt pulse in cylce
-        t_mark_cycle = OptoStimProtocol().get_cylcle_begin_timepoints(stim_key)
-        # get times of all stimulus
-        stim, t_mark = OptoStimProtocol().get_stimulus(stim_key)
-        t_mark = t_mark[stim == 1]
-        ind_mark = np.digitize(t_mark, lfp_timestamps)
-        ind_mark_phase = np.digitize(t_mark, phase_time)
-        # label each pulse as its count in the cycle
-        pulse_count = np.zeros_like(t_mark)
-        mark_ind_cycle = [np.where(t_mark == t_)[0][0] for t_ in t_mark_cycle]
-        pulse_count[mark_ind_cycle] = 1
-        cycle_id = np.cumsum(pulse_count).astype(
-            int
-        )  # which pulse cycle each pulse is in
-        count = 1
-        for i in range(pulse_count.size):
-            if pulse_count[i] == 1:
-                count = 1
-            pulse_count[i] = count
-            count += 1
-        pulse_count = pulse_count - 1  # 0 index the count
-        # normalize each cycle by first pulse response
-        lfp_norm = [np.nan for _ in range(np.max(cycle_id) + 1)]
-        # find first pulses in each cycle
-        ind_pulse_list = ind_mark[pulse_count == 0]
-        # assert len(ind_pulse_list) == len(lfp_norm)
-        for p, ind in enumerate(ind_pulse_list):
-            dat = np.abs(lfp_[ind - 100 : ind + 500])
-            dat = dat[dat < LFP_AMP_CUTOFF]
-            lfp_norm[p] = np.nanmedian(dat)
-
-        for p, pulse_number in enumerate(pulse_number_list):
-            ind_pulse_list = ind_mark[pulse_count == pulse_number]
-            ind_pulse_list_phase = ind_mark_phase[pulse_count == pulse_number]
-            for lfp_ind, phase_ind, cycle in zip(
-                ind_pulse_list, ind_pulse_list_phase, cycle_id
-            ):
-                if (lfp_ind + lfp_trace_window[0] < 0) or (
-                    lfp_ind + lfp_trace_window[1] >= lfp_.size
-                ):
-                    continue
-
-                # nan out segments with large noise
-                if (
-                    np.abs(
-                        lfp_[
-                            lfp_ind
-                            + lfp_trace_window[0] : lfp_ind
-                            + lfp_trace_window[1]
-                        ]
-                    ).max()
-                    > LFP_AMP_CUTOFF
-                ):
-                    continue
-                if np.isnan(lfp_norm[cycle]):
-                    lfp_norm[cycle] = lfp_[
-                        lfp_ind + lfp_trace_window[0] : lfp_ind + lfp_trace_window[1]
-                    ].max()
-
-                lfp_traces[p].append(
-                    lfp_[lfp_ind + lfp_trace_window[0] : lfp_ind + lfp_trace_window[1]]
-                    / lfp_norm[cycle]
-                )
-                # lfp phase
-                lfp_phase[p].append(phase_[phase_ind])
-                # # lfp power
-                # ind_power = np.digitize(
-                #     stim_timepoints_ref[int(i + pulse_number)], power_time
-                # )
-                # lfp_power[p].append(
-                #     np.mean(
-                #         power_[
-                #             ind_power
-                #             + lfp_trace_window[0] : ind_power
-                #             + lfp_trace_window[1]
-                #         ]
-                #     )
-                # )
-
-            if circular_shuffle:
-                # Get bootstrapped statistics for this pulse number and epoch
-                marks = t_mark[pulse_count == pulse_number]
-                mark_cycle = cycle_id[pulse_count == pulse_number]
-                norm_func = normalize_by_index_wrapper(lfp_norm)
-                if "period_ms" in dataset_key:
-                    shuffle_window = dataset_key["period_ms"] / 1000.0
-                else:
-                    shuffle_window = 0.125
-                lfp_traces_shuffled[p].extend(
-                    shuffled_trace_distribution(
-                        marks=marks,
-                        signal=lfp_,
-                        time=lfp_timestamps,
-                        marks_id=mark_cycle,
-                        shuffle_window=shuffle_window,
-                        normalize_func=norm_func,
-                        sample_window=lfp_trace_window,
-                    )
-                )
-
-        lfp_time_seg = (
-            lfp_timestamps[
-                lfp_ind + lfp_trace_window[0] : lfp_ind + lfp_trace_window[1]
-            ]
-            - lfp_timestamps[lfp_ind]
+    # histogram of the lfp phase for every relevant pulse (raw values are only
+    # kept when returned)
+    lfp_phase = [
+        HistogramAccumulator(
+            PULSE_PHASE_BINS,
+            reservoir_size=np.inf if return_data else 0,
         )
+        for p in pulse_number_list
+    ]
+    for epoch_traces, epoch_traces_shuffled, epoch_phase, lfp_time_seg in epoch_results:
+        for p in range(len(pulse_number_list)):
+            lfp_traces[p].extend(epoch_traces[p])
+            lfp_traces_shuffled[p].extend(epoch_traces_shuffled[p])
+            lfp_phase[p].merge(epoch_phase[p])
 
-        # count += 1
-        # if count > 3:
-        #     break
     if len(lfp_traces[0]) == 0:
         if return_data:
             return fig, lfp_traces, [], []
@@ -1619,9 +1674,8 @@ def lfp_per_pulse_analysis(
             )
         # plot rose plots of stim phase
         for a, pulse_phase in zip(ax_rose, lfp_phase):
-            freq, theta = np.histogram(pulse_phase, bins=50)
-            freq = freq / freq.sum()
-            theta = (theta[1:] + theta[:-1]) / 2
+            freq = pulse_phase.density()
+            theta = pulse_phase.bin_centers
             width = np.radians(360 / len(theta))
             a.bar(
                 theta,
@@ -1662,10 +1716,174 @@ def lfp_per_pulse_analysis(
     plt.rcParams["svg.fonttype"] = "none"
 
     if return_data:
+        lfp_phase = [pulse_phase.samples[:, 0] for pulse_phase in lfp_phase]
         return fig, lfp_traces, peak_amplitudes, lfp_phase
     return fig
 
 
+def _lfp_per_pulse_epoch(
+    epoch: dict,
+    filter_name: str,
+    band_filter_name: str,
+    lfp_trace_window: tuple,
+    pulse_number_list: np.ndarray,
+    circular_shuffle: bool,
+    shuffle_window: float,
+    reservoir_size: int = 0,
+):
+    """normalized lfp traces and lfp phase around each pulse for one epoch of lfp_per_pulse_analysis"""
+    nwb_file_name = epoch["nwb_file_name"]
+    interval_list_name = epoch["interval_list_name"]
+    lfp_traces = [[] for p in pulse_number_list]
+    lfp_traces_shuffled = [[] for p in pulse_number_list]
+    lfp_phase = [
+        HistogramAccumulator(PULSE_PHASE_BINS, reservoir_size=reservoir_size)
+        for p in pulse_number_list
+    ]
+    basic_key = {
+        "nwb_file_name": nwb_file_name,
+        "target_interval_list_name": interval_list_name,
+        "filter_name": filter_name,
+    }
+    stim_key = {
+        "nwb_file_name": nwb_file_name,
+        "interval_list_name": interval_list_name,
+        "dio_event_name": "stim",
+    }
+    band_key = {
+        "nwb_file_name": nwb_file_name,
+        "target_interval_list_name": interval_list_name,
+        "filter_name": band_filter_name,
+    }
+    if len(LFPV1() & basic_key) == 0:
+        print("missing LFP for: ", basic_key)
+        return None
+    print(basic_key)
+    # get lfp band phase for reference electrode
+    ref_elect, basic_key = get_ref_electrode_index(basic_key)  #
+    # ref_elect = (Electrode() & basic_key).fetch("original_reference_electrode")[0]
+    ref_index = [get_lfp_electrode_index(basic_key, ref_elect)]
+
+    # get LFP series
+    lfp_df = (LFPV1() & basic_key).fetch_nwb()[0]["lfp"]
+    lfp_df = (LFPV1() & basic_key).fetch1_dataframe()
+    lfp_timestamps = lfp_df.index
+    lfp_ = np.array(lfp_df[ref_index]).astype(float)
+    # nan out artifact intervals
+    artifact_times = (LFPArtifactDetection() & basic_key).fetch1("artifact_times")
+    for artifact in artifact_times:
+        lfp_[
+            np.logical_and(lfp_timestamps > artifact[0], lfp_timestamps < artifact[1])
+        ] = np.nan
+
+    ind = np.sort(np.unique(lfp_timestamps, return_index=True)[1])
+    lfp_timestamps = lfp_timestamps[ind]
+    lfp_ = lfp_[ind]
+    try:
+        assert np.all(np.diff(lfp_timestamps) > 0)
+    except:
+        return None
+    # get phase information
+    phase_df = fetch_band_phase(band_key, [ref_elect])
+    phase_time = phase_df.index
+    phase_ = np.asarray(phase_df)[:, 0]
+    # get power information
+    # power_df = (LFPBandV1() & band_key).compute_signal_power(
+    #     electrode_list=[ref_elect]
+    # )
+    # power_time = power_df.index
+    # print("POWER", np.mean(np.diff(power_time)))
+    # power_ = np.asarray(power_df)[:, 0]
+
+    # loop through pulse numbers
+    # get times of all stimulus, labeled with their cycle and count in the cycle
+    pulses = OptoStimPulses().fetch_pulses(stim_key)
+    t_mark = pulses["pulse_on"]
+    ind_mark = np.digitize(t_mark, lfp_timestamps)
+    ind_mark_phase = np.digitize(t_mark, phase_time)
+    cycle_id = pulses["cycle_id"]  # which pulse cycle each pulse is in
+    pulse_count = pulses["pulse_number"]  # 0 indexed count in the cycle
+    # normalize each cycle by first pulse response
+    lfp_norm = [np.nan for _ in range(np.max(cycle_id) + 1)]
+    # find first pulses in each cycle
+    ind_pulse_list = ind_mark[pulse_count == 0]
+    # assert len(ind_pulse_list) == len(lfp_norm)
+    for p, ind in enumerate(ind_pulse_list):
+        dat = np.abs(lfp_[ind - 100 : ind + 500])
+        dat = dat[dat < LFP_AMP_CUTOFF]
+        lfp_norm[p] = np.nanmedian(dat)
+
+    for p, pulse_number in enumerate(pulse_number_list):
+        ind_pulse_list = ind_mark[pulse_count == pulse_number]
+        ind_pulse_list_phase = ind_mark_phase[pulse_count == pulse_number]
+        valid_phase_ind = []
+        for lfp_ind, phase_ind, cycle in zip(
+            ind_pulse_list, ind_pulse_list_phase, cycle_id
+        ):
+            if (lfp_ind + lfp_trace_window[0] < 0) or (
+                lfp_ind + lfp_trace_window[1] >= lfp_.size
+            ):
+                continue
+
+            # nan out segments with large noise
+            if (
+                np.abs(
+                    lfp_[lfp_ind + lfp_trace_window[0] : lfp_ind + lfp_trace_window[1]]
+                ).max()
+                > LFP_AMP_CUTOFF
+            ):
+                continue
+            if np.isnan(lfp_norm[cycle]):
+                lfp_norm[cycle] = lfp_[
+                    lfp_ind + lfp_trace_window[0] : lfp_ind + lfp_trace_window[1]
+                ].max()
+
+            lfp_traces[p].append(
+                lfp_[lfp_ind + lfp_trace_window[0] : lfp_ind + lfp_trace_window[1]]
+                / lfp_norm[cycle]
+            )
+            # lfp phase
+            valid_phase_ind.append(phase_ind)
+            # # lfp power
+            # ind_power = np.digitize(
+            #     stim_timepoints_ref[int(i + pulse_number)], power_time
+            # )
+            # lfp_power[p].append(
+            #     np.mean(
+            #         power_[
+            #             ind_power
+            #             + lfp_trace_window[0] : ind_power
+            #             + lfp_trace_window[1]
+            #         ]
+            #     )
+            # )
+
+        lfp_phase[p].add(phase_[np.asarray(valid_phase_ind, dtype=int)])
+
+        if circular_shuffle:
+            # Get bootstrapped statistics for this pulse number and epoch
+            marks = t_mark[pulse_count == pulse_number]
+            mark_cycle = cycle_id[pulse_count == pulse_number]
+            norm_func = normalize_by_index_wrapper(lfp_norm)
+            lfp_traces_shuffled[p].extend(
+                shuffled_trace_distribution(
+                    marks=marks,
+                    signal=lfp_,
+                    time=lfp_timestamps,
+                    marks_id=mark_cycle,
+                    shuffle_window=shuffle_window,
+                    normalize_func=norm_func,
+                    sample_window=lfp_trace_window,
+                )
+            )
+
+    lfp_time_seg = (
+        lfp_timestamps[lfp_ind + lfp_trace_window[0] : lfp_ind + lfp_trace_window[1]]
+        - lfp_timestamps[lfp_ind]
+    )
+    return lfp_traces, lfp_traces_shuffled, lfp_phase, lfp_time_seg
+
+
 def lfp_power_dynamics_pulse_hilbert(
     dataset_key: dict,
     filter_name: str = "LFP 0-400 Hz",
@@ -1707,8 +1925,7 @@ def lfp_power_dynamics_pulse_hilbert(
     # Define the dataset (epochs included in this analyusis)
     dataset = filter_opto_data(dataset_key)
 
-    nwb_file_name_list = dataset.fetch("nwb_file_name")
-    interval_list_name_list = dataset.fetch("interval_list_name")
+    nwb_file_name_list, interval_list_name_list = fetch_epoch_names(dataset)
     power_curves = []
 
     for nwb_file_name, interval_list_name in zip(
@@ -1728,9 +1945,9 @@ def lfp_power_dynamics_pulse_hilbert(
             continue
         # get analytic band power
         ref_elect_index, basic_key = get_ref_electrode_index(basic_key)
-        power_df = (
-            LFPBandV1 & basic_key & {"filter_name": band_filter_name}
-        ).compute_signal_power([ref_elect_index])
+        power_df = fetch_band_power(
+            {**basic_key, "filter_name": band_filter_name}, [ref_elect_index]
+        )
         power_ = np.asarray(power_df[power_df.columns[0]])
         power_timestamps = power_df.index
         power_sampling_rate = int(np.round(1 / np.mean(np.diff(power_timestamps))))
@@ -1819,8 +2036,7 @@ def lfp_power_dynamics_pulse_cwt(
     # Define the dataset (epochs included in this analyusis)
     dataset = filter_opto_data(dataset_key)
 
-    nwb_file_name_list = dataset.fetch("nwb_file_name")
-    interval_list_name_list = dataset.fetch("interval_list_name")
+    nwb_file_name_list, interval_list_name_list = fetch_epoch_names(dataset)
     power_curves = []
 
     for nwb_file_name, interval_list_name in zip(
@@ -1842,8 +2058,7 @@ def lfp_power_dynamics_pulse_cwt(
         # get lfp data
         ref_elect, basic_key = get_ref_electrode_index(basic_key)  #
         # ref_elect = (Electrode() & basic_key).fetch("original_reference_electrode")[0]
-        lfp_eseries = (LFPOutput).fetch_nwb(restriction=basic_key)[0]["lfp"]
-        ref_index = get_electrode_indices(lfp_eseries, [ref_elect])
+        ref_index = [get_lfp_electrode_index(basic_key, ref_elect)]
 
         # get LFP series
         lfp_df = (LFPV1() & basic_key).fetch1_dataframe()
@@ -1980,8 +2195,7 @@ def lfp_power_dynamics_pulse_cwt_spectrogram(
     # Define the dataset (epochs included in this analyusis)
     dataset = filter_opto_data(dataset_key)
 
-    nwb_file_name_list = dataset.fetch("nwb_file_name")
-    interval_list_name_list = dataset.fetch("interval_list_name")
+    nwb_file_name_list, interval_list_name_list = fetch_epoch_names(dataset)
     spectrograms = []
 
     for nwb_file_name, interval_list_name in zip(
@@ -2003,8 +2217,7 @@ def lfp_power_dynamics_pulse_cwt_spectrogram(
         # get lfp data
         ref_elect, basic_key = get_ref_electrode_index(basic_key)  #
         # ref_elect = (Electrode() & basic_key).fetch("original_reference_electrode")[0]
-        lfp_eseries = (LFPOutput & basic_key).fetch_nwb(restriction=basic_key)[0]["lfp"]
-        ref_index = get_electrode_indices(lfp_eseries, [ref_elect])
+        ref_index = [get_lfp_electrode_index(basic_key, ref_elect)]
 
         # get LFP series
         lfp_df = (LFPV1() & basic_key).fetch1_dataframe()
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from spyglass.lfp.analysis.v1 import LFPBandV1
+
+from .utils import get_cache_dir
+
+SIGNALS = ("phase", "power")
+
+
+def _band_entry(key: dict):
+    """primary key and analysis file of the LFPBandV1 entry used for key
+
+    compute_signal_phase uses the first entry matching the restriction, so
+    the same one is used here
+    """
+    band_keys, analysis_file_names = (LFPBandV1 & key).fetch(
+        "KEY", "analysis_file_name"
+    )
+    if len(band_keys) == 0:
+        raise ValueError(f"no LFPBandV1 entry for {key}")
+    return band_keys[0], analysis_file_names[0]
+
+
+def _band_path(band_key: dict) -> str:
+    name = hashlib.md5(
+        json.dumps(sorted((k, str(v)) for k, v in band_key.items())).encode()
+    ).hexdigest()
+    return os.path.join(get_cache_dir("lfp_band_signals"), name)
+
+
+def _save(path: str, array: np.ndarray):
+    # write then rename so other processes never map a partial file
+    tmp_path = path[: -len(".npy")] + ".tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def _valid_band_dir(band_key: dict, analysis_file_name: str) -> str:
+    """cache directory of the band, emptied if the band was recomputed"""
+    path = _band_path(band_key)
+    meta_file = os.path.join(path, "band.json")
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            if json.load(f)["analysis_file_name"] == analysis_file_name:
+                return path
+    os.makedirs(path, exist_ok=True)
+    for file in os.listdir(path):
+        os.remove(os.path.join(path, file))
+    with open(meta_file + ".tmp", "w") as f:
+        json.dump(
+            {
+                "key": {k: str(v) for k, v in band_key.items()},
+                "analysis_file_name": analysis_file_name,
+            },
+            f,
+        )
+    os.replace(meta_file + ".tmp", meta_file)
+    return path
+
+
+def fetch_band_signal(key: dict, electrode_list: list, signal: str) -> pd.DataFrame:
+    """phase or power of an LFP band, computed once and memory-mapped after
+
+    The first request for an (LFPBandV1 entry, electrode) runs
+    compute_signal_phase and compute_signal_power together and saves both
+    as float32 arrays in the cache directory. The timestamps are shared by
+    all electrodes of the band. Cached signals are dropped if the band's
+    analysis file changes.
+
+    Parameters
+    ----------
+    key : dict
+        LFPBandV1 restriction, the first matching entry is used
+    electrode_list : list
+        electrode ids
+    signal : str
+        "phase" or "power"
+
+    Returns
+    -------
+    pd.DataFrame
+        one column per electrode indexed by time, as returned by
+        LFPBandV1.compute_signal_phase / compute_signal_power
+    """
+    if signal not in SIGNALS:
+        raise ValueError(f"signal must be one of {SIGNALS}, got {signal}")
+    electrode_list = [int(electrode) for electrode in electrode_list]
+    band_key, analysis_file_name = _band_entry(key)
+    path = _valid_band_dir(band_key, analysis_file_name)
+
+    def signal_file(name, electrode):
+        return os.path.join(path, f"{name}_{electrode}.npy")
+
+    missing = [
+        electrode
+        for electrode in electrode_list
+        if not all(os.path.exists(signal_file(name, electrode)) for name in SIGNALS)
+    ]
+    if missing:
+        computed = {
+            "phase": (LFPBandV1 & band_key).compute_signal_phase(
+                electrode_list=missing
+            ),
+            "power": (LFPBandV1 & band_key).compute_signal_power(
+                electrode_list=missing
+            ),
+        }
+        time_file = os.path.join(path, "time.npy")
+        if not os.path.exists(time_file):
+            _save(time_file, np.asarray(computed["phase"].index, dtype=np.float64))
+        for name, df in computed.items():
+            for i, electrode in enumerate(missing):
+                _save(
+                    signal_file(name, electrode),
+                    np.asarray(df.iloc[:, i], dtype=np.float32),
+                )
+
+    # read from the memory-mapped files into one writable array, callers
+    # modify the returned values in place
+    time = np.load(os.path.join(path, "time.npy"), mmap_mode="r")
+    values = np.empty((len(time), len(electrode_list)), dtype=np.float32)
+    for i, electrode in enumerate(electrode_list):
+        values[:, i] = np.load(signal_file(signal, electrode), mmap_mode="r")
+    return pd.DataFrame(
+        values, index=pd.Index(np.array(time), name="time"), columns=electrode_list
+    )
+
+
+def fetch_band_phase(key: dict, electrode_list: list) -> pd.DataFrame:
+    """cached LFPBandV1.compute_signal_phase, see fetch_band_signal"""
+    return fetch_band_signal(key, electrode_list, "phase")
+
+
+def fetch_band_power(key: dict, electrode_list: list) -> pd.DataFrame:
+    """cached LFPBandV1.compute_signal_power, see fetch_band_signal"""
+    return fetch_band_signal(key, electrode_list, "power")
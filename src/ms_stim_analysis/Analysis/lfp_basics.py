@@ -1,14 +1,10 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from spyglass.common import (
-    get_electrode_indices,
-)
 from spyglass.lfp.v1 import LFPElectrodeGroup, LFPV1
-from spyglass.lfp.lfp_merge import LFPOutput
 from spyglass.lfp.analysis.v1 import LFPBandV1
 from ms_stim_analysis.AnalysisTables.ms_opto_stim_protocol import OptoStimProtocol
-from .utils import filter_opto_data
-from .lfp_analysis import get_ref_electrode_index
+from .utils import filter_opto_data, fetch_epoch_names
+from .lfp_analysis import get_lfp_electrode_index, get_ref_electrode_index
 from ms_stim_analysis.Style.style_guide import animal_style, transfection_style
 
 LFP_AMP_CUTOFF = 2000
@@ -26,8 +22,7 @@ def individual_lfp_traces(
 ):
     # Define the dataset (epochs included in this analyusis)
     dataset = filter_opto_data(dataset_key)
-    nwb_file_name_list = dataset.fetch("nwb_file_name")
-    interval_list_name_list = dataset.fetch("interval_list_name")
+    nwb_file_name_list, interval_list_name_list = fetch_epoch_names(dataset)
     # get the color for display
     if "animal" in dataset_key:
         color = animal_style.loc[dataset_key["animal"]]["color"]
@@ -67,8 +62,7 @@ def individual_lfp_traces(
             ).fetch("electrode_id")[0]
 
         # ref_elect = (Electrode() & basic_key).fetch("original_reference_electrode")[0]
-        lfp_eseries = LFPOutput().fetch_nwb(restriction=basic_key)[0]["lfp"]
-        ref_index = get_electrode_indices(lfp_eseries, [ref_elect])
+        ref_index = [get_lfp_electrode_index(basic_key, ref_elect)]
 
         # get LFP series
         lfp_df = (LFPV1() & basic_key).fetch_nwb()[0]["lfp"]
@@ -0,0 +1,324 @@
+import numpy as np
+
+from spyglass.common.common_interval import interval_list_contains
+from spyglass.lfp.analysis.v1 import LFPBandV1
+
+from .accumulators import HistogramAccumulator
+from .utils import get_running_valid_intervals
+from .lfp_analysis import get_ref_electrode_index
+from .lfp_band_cache import fetch_band_phase, fetch_band_power
+
+PHASE_BINS = np.linspace(0, 2 * np.pi, 65)
+LOG_POWER_BINS = np.linspace(0, 5, 30)
+CONDITIONS = ("opto", "control")
+
+################################################################################
+# Per-bin sufficient statistics
+
+
+def binned_moments(labels: np.ndarray, values: np.ndarray, n_bins: int):
+    """count, sum and sum of squares of values in each bin
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        bin index of each value (0 <= labels < n_bins)
+    values : np.ndarray
+        values to accumulate
+    n_bins : int
+        number of bins
+
+    Returns
+    -------
+    np.ndarray
+        (3, n_bins) array of count, sum and sum of squares
+    """
+    labels = np.asarray(labels, dtype=int)
+    values = np.asarray(values, dtype=np.float64)
+    return np.array(
+        [
+            np.bincount(labels, minlength=n_bins),
+            np.bincount(labels, weights=values, minlength=n_bins),
+            np.bincount(labels, weights=values**2, minlength=n_bins),
+        ]
+    )
+
+
+def phase_bin_labels(phase: np.ndarray, bins: np.ndarray = PHASE_BINS) -> np.ndarray:
+    """index of the phase bin of each sample, phase of 2pi goes in the last bin"""
+    return np.clip(np.digitize(phase, bins) - 1, 0, len(bins) - 2)
+
+
+def block_moments(
+    timestamps: np.ndarray,
+    labels: np.ndarray,
+    values: np.ndarray,
+    n_bins: int,
+    block_size: float = None,
+):
+    """binned moments computed separately for contiguous time blocks
+
+    Parameters
+    ----------
+    timestamps : np.ndarray
+        time of each sample (s)
+    labels : np.ndarray
+        bin index of each sample
+    values : np.ndarray
+        values to accumulate
+    n_bins : int
+        number of bins
+    block_size : float, optional
+        length of each block (s). If None, all samples form a single block
+
+    Returns
+    -------
+    np.ndarray
+        (n_blocks, 3, n_bins) array of count, sum and sum of squares per block.
+        Blocks without samples are dropped
+    """
+    if len(values) == 0:
+        return np.zeros((0, 3, n_bins))
+    if block_size is None:
+        return binned_moments(labels, values, n_bins)[None]
+    block = ((timestamps - timestamps[0]) // block_size).astype(int)
+    _, block = np.unique(block, return_inverse=True)
+    n_blocks = block.max() + 1
+    # flatten (block, bin) into a single index so one bincount handles all blocks
+    moments = binned_moments(block * n_bins + labels, values, n_blocks * n_bins)
+    return moments.reshape(3, n_blocks, n_bins).transpose(1, 0, 2)
+
+
+def moments_mean_std(moments: np.ndarray):
+    """mean and standard deviation per bin from (..., 3, n_bins) moments"""
+    count, total, total_sq = np.asarray(moments).sum(
+        axis=tuple(range(np.ndim(moments) - 2))
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean**2, 0))
+    return mean, std
+
+
+def block_bootstrap_mean(
+    moments: np.ndarray,
+    n_boot: int = 1000,
+    percentiles=(0.5, 99.5),
+    chunk_size: int = 100,
+    rng: np.random.Generator = None,
+):
+    """Bootstrap the per-bin mean by resampling blocks with replacement
+
+    Only the per-block sums are resampled, so memory scales with
+    chunk_size * n_blocks rather than with the number of samples.
+
+    Parameters
+    ----------
+    moments : np.ndarray
+        (n_blocks, 3, n_bins) per-block moments (see block_moments)
+    n_boot : int, optional
+        number of bootstrap samples, by default 1000
+    percentiles : tuple, optional
+        percentiles of the bootstrap distribution to return, by default (0.5, 99.5)
+    chunk_size : int, optional
+        number of bootstrap samples drawn at once, by default 100
+    rng : np.random.Generator, optional
+        random generator, by default np.random.default_rng()
+
+    Returns
+    -------
+    mean, lo, hi : np.ndarray
+        mean of the bootstrap distribution and the requested percentiles per bin
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    n_blocks = moments.shape[0]
+    count = moments[:, 0]
+    total = moments[:, 1]
+    boot_means = []
+    for start in range(0, n_boot, chunk_size):
+        n = min(chunk_size, n_boot - start)
+        # number of times each block is drawn in each bootstrap sample
+        weights = rng.multinomial(n_blocks, np.ones(n_blocks) / n_blocks, size=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            boot_means.append((weights @ total) / (weights @ count))
+    boot_means = np.concatenate(boot_means, axis=0)
+    return (
+        np.nanmean(boot_means, axis=0),
+        np.nanpercentile(boot_means, percentiles[0], axis=0),
+        np.nanpercentile(boot_means, percentiles[1], axis=0),
+    )
+
+
+################################################################################
+# Per-epoch accumulation
+
+
+def epoch_phase_amplitude(
+    basic_key: dict,
+    phase_filter_name: str,
+    amplitude_filter_names: list,
+    filter_speed: float = 10.0,
+    block_size: float = 10.0,
+    phase_bins: np.ndarray = PHASE_BINS,
+    log_power_bins: np.ndarray = LOG_POWER_BINS,
+    reservoir_size: int = 0,
+):
+    """phase-amplitude statistics for one epoch and several amplitude bands
+
+    The phase of the reference electrode is computed once and shared by all
+    amplitude bands. Only per-block binned moments of log10 power and a
+    streaming phase x log10 power histogram are kept.
+
+    Parameters
+    ----------
+    basic_key : dict
+        key with nwb_file_name and target_interval_list_name
+    phase_filter_name : str
+        LFPBand filter used for phase
+    amplitude_filter_names : list
+        LFPBand filters used for amplitude
+    filter_speed : float, optional
+        running speed threshold, by default 10.0
+    block_size : float, optional
+        length of bootstrap blocks (s). If None the epoch is one block
+    phase_bins : np.ndarray, optional
+        phase bin edges for the coupling curve
+    log_power_bins : np.ndarray, optional
+        log10 power bin edges for the 2d histogram
+    reservoir_size : int, optional
+        number of raw (phase, log10 power) samples kept in the histogram
+        reservoir, by default 0
+
+    Returns
+    -------
+    dict or None
+        {amplitude_filter_name: {condition: {"moments", "histogram"}}}, where
+        histogram is a HistogramAccumulator
+        None if band data is missing for this epoch
+    """
+    phase_key = {
+        **basic_key,
+        "filter_name": phase_filter_name,
+        "filter_sampling_rate": 1000,
+    }
+    if not (LFPBandV1 & phase_key):
+        return None
+    power_keys = {
+        name: {**basic_key, "filter_name": name} for name in amplitude_filter_names
+    }
+    if not all(LFPBandV1 & power_key for power_key in power_keys.values()):
+        return None
+
+    ref_elect_index, basic_key = get_ref_electrode_index(basic_key)
+
+    # phase is shared by every amplitude band
+    phase_df = fetch_band_phase(phase_key, [ref_elect_index])
+    phase_timestamps = np.asarray(phase_df.index)
+    phase_ = np.asarray(phase_df)[:, 0]
+
+    # get test and control run intervals
+    pos_key = {
+        **basic_key,
+        "interval_list_name": basic_key["target_interval_list_name"],
+    }
+    run_intervals = dict(
+        zip(
+            CONDITIONS,
+            get_running_valid_intervals(
+                pos_key, filter_speed=filter_speed, seperate_optogenetics=True
+            ),
+        )
+    )
+    valid_times = {}
+    valid_phase = {}
+    for condition, intervals in run_intervals.items():
+        valid_times[condition] = interval_list_contains(intervals, phase_timestamps)
+        ind_phase = np.digitize(valid_times[condition], phase_timestamps)
+        valid_phase[condition] = phase_[ind_phase - 1]
+
+    n_bins = len(phase_bins) - 1
+    results = {}
+    for amplitude_filter in amplitude_filter_names:
+        power_df = fetch_band_power(power_keys[amplitude_filter], [ref_elect_index])
+        power_ = np.asarray(power_df[power_df.columns[0]])
+        power_timestamps = np.asarray(power_df.index)
+        results[amplitude_filter] = {}
+        for condition in CONDITIONS:
+            ind_power = np.digitize(valid_times[condition], power_timestamps)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                log_power = np.log10(power_[ind_power - 1])
+            valid = np.isfinite(log_power)
+            phase_c = valid_phase[condition][valid]
+            log_power = log_power[valid]
+            histogram = HistogramAccumulator(
+                [np.linspace(0, 2 * np.pi, 100), log_power_bins],
+                reservoir_size=reservoir_size,
+            )
+            histogram.add(phase_c, log_power)
+            results[amplitude_filter][condition] = {
+                "moments": block_moments(
+                    valid_times[condition][valid],
+                    phase_bin_labels(phase_c, phase_bins),
+                    log_power,
+                    n_bins,
+                    block_size,
+                ),
+                "histogram": histogram,
+            }
+    return results
+
+
+def combine_phase_amplitude(
+    epoch_results: list,
+    n_boot: int = 1000,
+    phase_bins: np.ndarray = PHASE_BINS,
+    rng: np.random.Generator = None,
+):
+    """combine per-epoch results from epoch_phase_amplitude
+
+    Parameters
+    ----------
+    epoch_results : list
+        outputs of epoch_phase_amplitude (None entries are skipped)
+    n_boot : int, optional
+        number of block bootstrap samples, by default 1000
+    phase_bins : np.ndarray, optional
+        phase bin edges used for the epoch results
+    rng : np.random.Generator, optional
+        random generator for the bootstrap
+
+    Returns
+    -------
+    dict
+        {amplitude_filter_name: {condition: {"bin_centers", "mean", "std", "boot_mean",
+        "lo", "hi", "n_samples", "n_blocks", "histogram"}}}
+    """
+    epoch_results = [x for x in epoch_results if x is not None]
+    if len(epoch_results) == 0:
+        return {}
+    bin_centers = phase_bins[:-1] + np.diff(phase_bins) / 2
+    combined = {}
+    for amplitude_filter in epoch_results[0]:
+        combined[amplitude_filter] = {}
+        for condition in CONDITIONS:
+            moments = np.concatenate(
+                [x[amplitude_filter][condition]["moments"] for x in epoch_results]
+            )
+            histogram = HistogramAccumulator.combine(
+                [x[amplitude_filter][condition]["histogram"] for x in epoch_results]
+            )
+            mean, std = moments_mean_std(moments)
+            boot_mean, lo, hi = block_bootstrap_mean(moments, n_boot=n_boot, rng=rng)
+            combined[amplitude_filter][condition] = {
+                "bin_centers": bin_centers,
+                "mean": mean,
+                "std": std,
+                "boot_mean": boot_mean,
+                "lo": lo,
+                "hi": hi,
+                "n_samples": int(moments[:, 0].sum()),
+                "n_blocks": moments.shape[0],
+                "histogram": histogram,
+            }
+    return combined
@@ -0,0 +1,287 @@
+import numpy as np
+
+from .accumulators import HistogramAccumulator
+from .spike_annotation import interval_membership
+from .utils import smooth
+
+
+def _position_coords(positions: np.ndarray, bins) -> tuple:
+    """split positions into one coordinate array per spatial dimension"""
+    positions = np.asarray(positions, dtype=np.float64)
+    if isinstance(bins, np.ndarray) and bins.ndim == 1:
+        bins = [bins]
+    bins = [np.asarray(b, dtype=np.float64) for b in bins]
+    if positions.ndim == 1:
+        positions = positions[:, None]
+    if positions.shape[1] != len(bins):
+        raise ValueError(
+            f"positions have {positions.shape[1]} dimensions, bins have {len(bins)}"
+        )
+    return tuple(positions.T), bins
+
+
+def occupancy_map(positions: np.ndarray, bins) -> np.ndarray:
+    """number of position samples in each spatial bin
+
+    Parameters
+    ----------
+    positions : np.ndarray
+        (n_samples,) linearized or (n_samples, 2) 2d positions
+    bins : np.ndarray or list of np.ndarray
+        bin edges, one array per spatial dimension
+
+    Returns
+    -------
+    np.ndarray
+        occupancy, shape of the spatial bins
+    """
+    coords, bins = _position_coords(positions, bins)
+    return HistogramAccumulator(bins).add(*coords).counts
+
+
+def population_spike_counts(
+    units: np.ndarray, positions: np.ndarray, bins, n_units: int
+) -> np.ndarray:
+    """spike count in each spatial bin for every unit at once
+
+    One bincount over the combined (unit, spatial bin) index replaces a
+    np.histogram call per unit. Samples outside the bins are dropped, as in
+    np.histogram.
+
+    Parameters
+    ----------
+    units : np.ndarray
+        unit index of each spike (e.g. annotate_spikes(...)["unit"])
+    positions : np.ndarray
+        (n_spikes,) linearized or (n_spikes, 2) 2d position of each spike
+    bins : np.ndarray or list of np.ndarray
+        spatial bin edges, one array per spatial dimension
+    n_units : int
+        number of units
+
+    Returns
+    -------
+    np.ndarray
+        (n_units, *spatial bins) spike counts
+    """
+    coords, bins = _position_coords(positions, bins)
+    unit_bins = np.arange(n_units + 1) - 0.5
+    return HistogramAccumulator([unit_bins] + bins).add(units, *coords).counts
+
+
+def smooth_rate_maps(maps: np.ndarray, n: int = 5, sigma: float = None) -> np.ndarray:
+    """smooth the spatial axes of (n_units, *spatial bins) maps
+
+    Same gaussian kernel and edge padding as utils.smooth applied to each unit,
+    done as one convolution of the whole population per spatial axis.
+
+    Parameters
+    ----------
+    maps : np.ndarray
+        (n_units, *spatial bins) counts or rates
+    n : int, optional
+        kernel size in bins, by default 5
+    sigma : float, optional
+        kernel width in bins, by default n / 2
+
+    Returns
+    -------
+    np.ndarray
+        smoothed maps, same shape as maps
+    """
+    maps = np.asarray(maps, dtype=np.float64)
+    for axis in range(1, maps.ndim):
+        moved = np.moveaxis(maps, axis, 0)
+        shape = moved.shape
+        smoothed = smooth(moved.reshape(shape[0], -1), n, sigma)
+        maps = np.moveaxis(smoothed.reshape(shape), 0, axis)
+    return maps
+
+
+def _spatial_axes(maps: np.ndarray) -> tuple:
+    return tuple(range(1, np.ndim(maps)))
+
+
+def normalized_place_fields(counts: np.ndarray, occupancy: np.ndarray) -> np.ndarray:
+    """occupancy normalized rate maps, each summing to 1 over the spatial bins"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fields = counts / occupancy
+        return fields / np.nansum(fields, axis=_spatial_axes(fields), keepdims=True)
+
+
+def relative_rate_maps(counts: np.ndarray, occupancy: np.ndarray) -> np.ndarray:
+    """p(spike|pos)/p(spike) for each unit"""
+    axes = _spatial_axes(counts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (counts / occupancy) / (
+            counts.sum(axis=axes, keepdims=True) / occupancy.sum()
+        )
+
+
+def population_spatial_information(
+    counts: np.ndarray, occupancy: np.ndarray
+) -> np.ndarray:
+    """spatial information rate (bits/spike) of every unit
+
+    Array form of spatial_information_rate(spike_counts, occupancy) in
+    spiking_analysis.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        (n_units, *spatial bins) spike counts
+    occupancy : np.ndarray
+        occupancy of the spatial bins
+
+    Returns
+    -------
+    np.ndarray
+        (n_units,) spatial information rate
+    """
+    axes = _spatial_axes(counts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        spike_rate = counts / occupancy
+        p_loc = occupancy / occupancy.sum()
+        total_rate = counts.sum(axis=axes, keepdims=True) / occupancy.sum()
+        relative_rate = spike_rate / total_rate
+        return np.nansum(p_loc * relative_rate * np.log2(relative_rate), axis=axes)
+
+
+def peak_ratio(fields: np.ndarray) -> np.ndarray:
+    """ratio of the peak to the median of each unit's field (nan if any bin is nan)"""
+    axes = _spatial_axes(fields)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.max(fields, axis=axes) / np.median(fields, axis=axes)
+
+
+################################################################################
+# Shuffle significance
+
+
+def spatial_information_significance(
+    units: np.ndarray,
+    spike_times: np.ndarray,
+    n_units: int,
+    intervals: np.ndarray,
+    pos_time: np.ndarray,
+    positions: np.ndarray,
+    bins,
+    occupancy: np.ndarray,
+    n_shuffles: int = 500,
+    min_shift: float = 20.0,
+    smooth_n: int = None,
+    max_memory: int = 2**28,
+    rng: np.random.Generator = None,
+):
+    """shuffle test of the spatial information of every unit
+
+    Each shuffle circularly shifts each unit's spike train by a random number
+    of position samples within the intervals, so every spike is moved to the
+    position sample that many valid samples later. Rate maps for a chunk of
+    shuffles are built together with one (shuffles x units x bins) bincount,
+    with the chunk sized so that roughly max_memory bytes are used at once.
+
+    Parameters
+    ----------
+    units : np.ndarray
+        unit index of each spike
+    spike_times : np.ndarray
+        time of each spike, all inside intervals
+    n_units : int
+        number of units
+    intervals : np.ndarray
+        (n_intervals, 2) non-overlapping intervals the spikes were restricted to
+    pos_time : np.ndarray
+        position timestamps
+    positions : np.ndarray
+        (n_samples,) linearized or (n_samples, 2) 2d position at each timestamp
+    bins : np.ndarray or list of np.ndarray
+        spatial bin edges, one array per spatial dimension
+    occupancy : np.ndarray
+        occupancy of the spatial bins used for the rate maps
+    n_shuffles : int, optional
+        number of shuffles, by default 500
+    min_shift : float, optional
+        minimum circular shift (s), by default 20.0. Limited to half the total
+        interval time
+    smooth_n : int, optional
+        if given, rate maps are smoothed with smooth_rate_maps(maps, smooth_n)
+        before computing spatial information
+    max_memory : int, optional
+        approximate memory budget in bytes, by default 256 MB
+    rng : np.random.Generator, optional
+        random generator, by default np.random.default_rng()
+
+    Returns
+    -------
+    information, p_value : np.ndarray
+        (n_units,) spatial information of the unshifted spikes and the fraction
+        of shuffles (with the observed one counted) with at least as much
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    units = np.asarray(units, dtype=np.int64)
+    spike_times = np.asarray(spike_times, dtype=np.float64)
+    pos_time = np.asarray(pos_time, dtype=np.float64)
+
+    # spatial bin of each position sample, samples outside the bins go to an
+    # extra overflow bin that is dropped from the counts
+    coords, bins = _position_coords(positions, bins)
+    spatial = HistogramAccumulator(bins)
+    flat_ind, valid = spatial.bin_index(*coords)
+    n_bins = spatial.counts.size
+    sample_bin = np.full(len(valid), n_bins, dtype=np.int64)
+    sample_bin[valid] = flat_ind
+    unit_offset = units * (n_bins + 1)
+
+    def information(spike_bin, n_rows):
+        # spike_bin: (n_rows, n_spikes) spatial bin of each spike in each row
+        index = spike_bin + unit_offset
+        index += (np.arange(n_rows) * n_units * (n_bins + 1))[:, None]
+        counts = np.bincount(index.ravel(), minlength=n_rows * n_units * (n_bins + 1))
+        counts = counts.reshape(n_rows * n_units, n_bins + 1)[:, :n_bins]
+        counts = counts.reshape((n_rows * n_units,) + spatial.shape)
+        if smooth_n is not None:
+            counts = smooth_rate_maps(counts, smooth_n)
+        return population_spatial_information(counts, occupancy).reshape(
+            n_rows, n_units
+        )
+
+    # position sample of each spike, same convention as annotate_spikes
+    spike_sample = np.clip(
+        np.searchsorted(pos_time, spike_times, side="right"), 0, len(pos_time) - 1
+    )
+    observed = information(sample_bin[spike_sample][None], 1)[0]
+
+    # shuffles move spikes between the position samples inside the intervals
+    frames = np.where(interval_membership(intervals, pos_time))[0]
+    n_frames = len(frames)
+    if n_shuffles == 0 or n_frames < 2:
+        return observed, np.full(n_units, np.nan)
+    frame_bin = sample_bin[frames]
+    spike_frame = np.clip(np.searchsorted(frames, spike_sample), 0, n_frames - 1)
+    intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+    frame_rate = n_frames / np.sum(intervals[:, 1] - intervals[:, 0])
+    min_shift = int(min(min_shift * frame_rate, (n_frames - 1) // 2))
+
+    # memory of one shuffle at the peak of information():
+    # - per spike, int64 shifted frames, spatial bins and bincount index, the
+    #   shifts[:, units] temporary and one more for the fixed per-spike arrays
+    # - per unit and bin, the int64 counts (with the overflow bin), the float64
+    #   copy and padded/convolved temporaries of smooth_rate_maps, and about
+    #   five float64 temporaries of population_spatial_information (rate,
+    #   relative rate, log2 and the products)
+    n_map_arrays = 1 + 5 + (3 if smooth_n is not None else 0)
+    bytes_per_shuffle = 8 * 5 * len(spike_times) + 8 * n_map_arrays * n_units * (
+        n_bins + 1
+    )
+    chunk_size = int(max(1, max_memory // max(bytes_per_shuffle, 1)))
+    n_exceed = np.zeros(n_units)
+    for start in range(0, n_shuffles, chunk_size):
+        n = min(chunk_size, n_shuffles - start)
+        shifts = rng.integers(min_shift, n_frames - min_shift, (n, n_units))
+        shifted = spike_frame + shifts[:, units]
+        shifted %= n_frames
+        null = information(frame_bin[shifted], n)
+        n_exceed += np.sum(null >= observed, axis=0)
+    return observed, (n_exceed + 1) / (n_shuffles + 1)
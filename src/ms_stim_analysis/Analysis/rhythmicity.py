@@ -0,0 +1,415 @@
+import numpy as np
+from scipy.ndimage import maximum_filter1d, uniform_filter1d
+from scipy.signal import welch
+
+
+def correlogram_matrix(correlograms) -> np.ndarray:
+    """stack correlograms into a (n_correlograms, n_lags) float array
+
+    Accepts a 2d array or a sequence of equal length 1d arrays, e.g. the
+    "correlogram" column of CrossCorrelogram().fetch_dataframe()
+    """
+    if isinstance(correlograms, np.ndarray) and correlograms.dtype != object:
+        return np.atleast_2d(np.asarray(correlograms, dtype=np.float64))
+    correlograms = list(correlograms)
+    if len(correlograms) == 0:
+        return np.zeros((0, 0))
+    return np.stack([np.asarray(x, dtype=np.float64) for x in correlograms])
+
+
+def _row_chunks(n_rows: int, chunk_size: int):
+    for start in range(0, n_rows, chunk_size):
+        yield slice(start, min(start + chunk_size, n_rows))
+
+
+################################################################################
+# Spectral rhythmicity
+
+
+def fft_rhythmicity(
+    correlograms,
+    lag_times: np.ndarray,
+    freq_range: tuple = (5, 11),
+    nperseg: int = None,
+    nfft: int = 10000,
+    chunk_size: int = 1024,
+) -> np.ndarray:
+    """peak Welch power in a frequency band of each peak-normalized correlogram
+
+    Each correlogram is divided by its nanmax and the Welch spectra of a chunk
+    of correlograms are computed together along the lag axis. The band maximum
+    is a masked nanmax over the frequencies strictly inside freq_range.
+
+    Parameters
+    ----------
+    correlograms : np.ndarray or sequence of np.ndarray
+        (n_correlograms, n_lags) correlograms, see correlogram_matrix
+    lag_times : np.ndarray
+        lag of each correlogram point
+    freq_range : tuple, optional
+        frequency band (Hz), by default (5, 11)
+    nperseg : int, optional
+        welch segment length, by default None (welch default)
+    nfft : int, optional
+        welch fft length (zero padding), by default 10000
+    chunk_size : int, optional
+        correlograms transformed at once, by default 1024. Memory grows with
+        chunk_size * nfft
+
+    Returns
+    -------
+    np.ndarray
+        (n_correlograms,) band power
+    """
+    data = correlogram_matrix(correlograms)
+    if np.max(data, initial=-np.inf) > 1e9:
+        raise ValueError("correlogram values above 1e9, check the normalization")
+    fs = 1 / np.mean(np.diff(lag_times))
+    rhythmicity = np.full(len(data), np.nan)
+    for rows in _row_chunks(len(data), chunk_size):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            normalized = data[rows] / np.nanmax(data[rows], axis=-1, keepdims=True)
+        frequencies, power = welch(
+            normalized,
+            fs=fs,
+            nperseg=nperseg,
+            nfft=nfft,
+            scaling="density",
+            axis=-1,
+        )
+        band = (frequencies > freq_range[0]) & (frequencies < freq_range[1])
+        rhythmicity[rows] = np.nanmax(power[:, band], axis=-1)
+    return rhythmicity
+
+
+################################################################################
+# Boxcar filtering
+
+
+def boxcar_filter(data, size: int = 100, method: str = "subtract", axis: int = -1):
+    """remove (subtract) or normalize out (divide) a boxcar moving average
+
+    The moving average matches np.convolve(x, np.ones(size) / size, "same")
+    for signals at least size long (zero padding past the ends), computed with
+    uniform_filter1d along axis. Averages over windows containing non-finite
+    values are nan.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        signals
+    size : int, optional
+        boxcar width in samples, by default 100
+    method : str, optional
+        "subtract" or "divide", by default "subtract"
+    axis : int, optional
+        axis to filter along, by default -1
+
+    Returns
+    -------
+    np.ndarray
+        filtered signals, same shape as data
+    """
+    if method not in ("subtract", "divide"):
+        raise NotImplementedError(f"method {method} not defined for boxcar filter")
+    data = np.asarray(data, dtype=np.float64)
+    finite = np.isfinite(data)
+    average = uniform_filter1d(
+        np.where(finite, data, 0), size, axis=axis, mode="constant"
+    )
+    if not finite.all():
+        # the running sum would carry a nan past the end of its window
+        touched = uniform_filter1d(
+            (~finite).astype(float), size, axis=axis, mode="constant"
+        )
+        average[touched > 0] = np.nan
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if method == "subtract":
+            return data - average
+        return data / average
+
+
+################################################################################
+# Peak / trough rhythmicity
+
+
+def local_peaks(data, distance: int = 1) -> np.ndarray:
+    """mask of the peaks of each row, as scipy.signal.find_peaks(x, distance=distance)
+
+    Local maxima (flat peaks at their middle sample) are found for all rows at
+    once. Peaks closer than distance to a higher peak are then removed in
+    rounds: each round keeps every remaining peak that is the highest in its
+    neighborhood and drops the peaks near the kept ones, which gives the same
+    peaks as find_peaks' greedy pass. Peaks of exactly equal height closer than
+    distance go to the later one, find_peaks' choice there depends on the sort
+    implementation.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        (n_rows, n_samples) signals
+    distance : int, optional
+        minimal number of samples between peaks, by default 1
+
+    Returns
+    -------
+    np.ndarray
+        (n_rows, n_samples) boolean peak mask
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    n_rows, n_samples = data.shape
+    peaks = np.zeros(data.shape, dtype=bool)
+    if n_samples < 3:
+        return peaks
+
+    # runs of equal values, a run is a peak if both neighbours are lower
+    new_run = np.ones(data.shape, dtype=bool)
+    new_run[:, 1:] = data[:, 1:] != data[:, :-1]
+    run_rows, run_start = np.nonzero(new_run)
+    run_stop = np.empty_like(run_start)
+    run_stop[:-1] = run_start[1:]
+    run_stop[np.r_[run_rows[1:] != run_rows[:-1], True]] = n_samples
+    inside = (run_start > 0) & (run_stop < n_samples)
+    run_rows, run_start, run_stop = (
+        run_rows[inside],
+        run_start[inside],
+        run_stop[inside],
+    )
+    value = data[run_rows, run_start]
+    is_peak = (data[run_rows, run_start - 1] < value) & (
+        data[run_rows, run_stop] < value
+    )
+    peaks[run_rows[is_peak], (run_start[is_peak] + run_stop[is_peak] - 1) // 2] = True
+    if distance <= 1:
+        return peaks
+
+    # priority of each sample in its row: height, then position
+    priority = np.empty(data.shape, dtype=np.int64)
+    order = np.argsort(data, axis=-1, kind="stable")
+    np.put_along_axis(priority, order, np.arange(n_samples)[None], axis=-1)
+    priority[~peaks] = -1
+    kept = np.zeros(data.shape, dtype=bool)
+    window = 2 * int(np.ceil(distance)) - 1
+    while True:
+        best = maximum_filter1d(priority, window, axis=-1, mode="constant", cval=-1)
+        new = (priority >= 0) & (priority == best) & ~kept
+        if not new.any():
+            return kept
+        kept |= new
+        near_kept = maximum_filter1d(kept, window, axis=-1, mode="constant") & ~kept
+        priority[near_kept] = -1
+
+
+def _window_means(data: np.ndarray, mask: np.ndarray, avg_window: int) -> np.ndarray:
+    """mean over rows of nanmean(x[i - avg_window // 2 : i + avg_window // 2])
+
+    for the samples i in mask, with python slice semantics at the edges
+    """
+    n_rows, n_samples = data.shape
+    half = avg_window // 2
+    rows, index = np.nonzero(mask)
+    start = index - half
+    start = np.clip(np.where(start < 0, start + n_samples, start), 0, None)
+    stop = np.minimum(index + half, n_samples)
+
+    # nanmean of each window from cumulative sums of the non-nan values
+    valid = ~np.isnan(data)
+    total = np.zeros((n_rows, n_samples + 1))
+    total[:, 1:] = np.cumsum(np.where(valid, data, 0), axis=-1)
+    count = np.zeros((n_rows, n_samples + 1), dtype=np.int64)
+    count[:, 1:] = np.cumsum(valid, axis=-1)
+    n_valid = np.where(stop > start, count[rows, stop] - count[rows, start], 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (total[rows, stop] - total[rows, start]) / n_valid
+    means[n_valid == 0] = np.nan
+
+    # nanmean over the windows of each row
+    finite = ~np.isnan(means)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.bincount(
+            rows[finite], weights=means[finite], minlength=n_rows
+        ) / np.bincount(rows[finite], minlength=n_rows)
+
+
+def peak_trough_rhythmicity(
+    correlograms, width: int = 150, avg_window: int = 10, chunk_size: int = 1024
+) -> np.ndarray:
+    """(peak - trough) / peak of each correlogram
+
+    Peaks and troughs are found with local_peaks(x, width) and
+    local_peaks(-x, width), and their values are the mean over extrema of the
+    avg_window samples around each one.
+
+    Parameters
+    ----------
+    correlograms : np.ndarray or sequence of np.ndarray
+        (n_correlograms, n_lags) correlograms, see correlogram_matrix
+    width : int, optional
+        minimal distance between peaks in samples, by default 150
+    avg_window : int, optional
+        number of samples averaged around each extremum, by default 10
+    chunk_size : int, optional
+        correlograms scored at once, by default 1024
+
+    Returns
+    -------
+    np.ndarray
+        (n_correlograms,) rhythmicity
+    """
+    data = correlogram_matrix(correlograms)
+    rhythmicity = np.full(len(data), np.nan)
+    for rows in _row_chunks(len(data), chunk_size):
+        x = data[rows]
+        peak_vals = _window_means(x, local_peaks(x, width), avg_window)
+        trough_vals = _window_means(x, local_peaks(-x, width), avg_window)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rhythmicity[rows] = (peak_vals - trough_vals) / peak_vals
+    return rhythmicity
+
+
+################################################################################
+# Gaussian modulated cosine fits
+
+
+def gaussian_modulated_cosine(x, frequency, amplitude, stddev):
+    """amplitude * exp(-x^2 / (2 stddev^2)) * cos(2 pi frequency x)
+
+    Parameters broadcast, e.g. (n, 1) parameters with (m,) x give (n, m)
+    """
+    return (
+        amplitude * np.exp(-0.5 * (x / stddev) ** 2) * np.cos(2 * np.pi * frequency * x)
+    )
+
+
+def _gaussian_modulated_cosine_jacobian(x, params):
+    """(n, m, 3) derivatives of the (n, m) model values wrt the (n, 3) params"""
+    frequency, amplitude, stddev = (params[:, i : i + 1] for i in range(3))
+    envelope = np.exp(-0.5 * (x / stddev) ** 2)
+    phase = 2 * np.pi * frequency * x
+    cosine = envelope * np.cos(phase)
+    return np.stack(
+        [
+            -amplitude * envelope * np.sin(phase) * 2 * np.pi * x,
+            cosine,
+            amplitude * cosine * x**2 / stddev**3,
+        ],
+        axis=-1,
+    )
+
+
+def _grid_start(x: np.ndarray, y: np.ndarray, frequencies, stddevs) -> np.ndarray:
+    """best (frequency, amplitude, stddev) of each curve on a grid
+
+    The model is linear in the amplitude, so for each grid (frequency, stddev)
+    the best amplitude and the resulting squared error have closed forms
+    """
+    frequency, stddev = (
+        g.ravel() for g in np.meshgrid(frequencies, stddevs, indexing="ij")
+    )
+    basis = gaussian_modulated_cosine(x, frequency[:, None], 1.0, stddev[:, None])
+    norm = np.sum(basis**2, axis=1)
+    projection = y @ basis.T
+    best = np.argmax(projection**2 / norm, axis=1)
+    amplitude = projection[np.arange(len(y)), best] / norm[best]
+    return np.stack([frequency[best], amplitude, stddev[best]], axis=1)
+
+
+def fit_gaussian_modulated_cosines(
+    x: np.ndarray,
+    y,
+    p0=None,
+    frequencies: np.ndarray = np.arange(1, 20.5, 0.5),
+    stddevs: np.ndarray = np.geomspace(0.01, 1, 15),
+    max_iter: int = 1000,
+    ftol: float = 1.49012e-8,
+    xtol: float = 1.49012e-8,
+):
+    """least squares fits of gaussian_modulated_cosine to many curves at once
+
+    Each curve starts from the best point of a (frequency, stddev) grid and
+    Levenberg-Marquardt is run on every curve together: each iteration solves
+    the damped normal equations of all curves still fitting as one batched
+    3x3 solve, and accepts or rejects the step per curve. A curve stops
+    when a step changes its squared error or its parameters by less than
+    ftol or xtol (relative), the same tolerances as curve_fit.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        (m,) sample positions shared by all curves
+    y : np.ndarray or sequence of np.ndarray
+        (n, m) curves, see correlogram_matrix
+    p0 : array-like, optional
+        (frequency, amplitude, stddev) start, either (3,) for all curves or
+        (n, 3), by default the grid start
+    frequencies, stddevs : np.ndarray, optional
+        grid of the start, by default 1-20 Hz and 10 ms-1 s
+    max_iter : int, optional
+        iterations before a curve is marked as not converged, by default 1000
+    ftol, xtol : float, optional
+        relative tolerances on the squared error and the parameters
+
+    Returns
+    -------
+    params : np.ndarray
+        (n, 3) fitted (frequency, amplitude, stddev), nan where not converged
+    converged : np.ndarray
+        (n,) whether each fit converged
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = correlogram_matrix(y)
+    n = len(y)
+    failed = ~np.isfinite(y).all(axis=1)
+    if p0 is None:
+        params = np.ones((n, 3))
+        params[~failed] = _grid_start(x, y[~failed], frequencies, stddevs)
+    else:
+        params = np.broadcast_to(np.asarray(p0, dtype=np.float64), (n, 3)).copy()
+    damping = np.full(n, 1e-3)
+    converged = np.zeros(n, dtype=bool)
+
+    def squared_error(rows, p):
+        with np.errstate(all="ignore"):
+            residual = y[rows] - gaussian_modulated_cosine(x, *p.T[:, :, None])
+        return np.sum(residual**2, axis=1), residual
+
+    cost, residual = squared_error(np.arange(n), params)
+    for _ in range(max_iter):
+        rows = np.where(~converged & ~failed)[0]
+        if rows.size == 0:
+            break
+        p = params[rows]
+        with np.errstate(all="ignore"):
+            jacobian = _gaussian_modulated_cosine_jacobian(x, p)
+            jtj = np.einsum("nmi,nmj->nij", jacobian, jacobian)
+            gradient = np.einsum("nmi,nm->ni", jacobian, residual[rows])
+        bad = ~(np.isfinite(jtj).all(axis=(1, 2)) & np.isfinite(gradient).all(axis=1))
+        failed[rows[bad]] = True
+        rows, p, jtj, gradient = rows[~bad], p[~bad], jtj[~bad], gradient[~bad]
+        if rows.size == 0:
+            break
+
+        # damped step, scaled by the curvature of each parameter
+        scale = np.diagonal(jtj, axis1=1, axis2=2)
+        scale = np.maximum(scale, 1e-12 * scale.max(axis=1, keepdims=True) + 1e-300)
+        system = jtj + (damping[rows, None] * scale)[:, :, None] * np.eye(3)
+        step = np.linalg.solve(system, gradient[:, :, None])[:, :, 0]
+        new_params = p + step
+        new_cost, new_residual = squared_error(rows, new_params)
+
+        accept = np.isfinite(new_cost) & (new_cost <= cost[rows])
+        small_change = accept & (cost[rows] - new_cost <= ftol * cost[rows])
+        small_step = np.linalg.norm(step, axis=1) <= xtol * (
+            np.linalg.norm(p, axis=1) + xtol
+        )
+        accepted = rows[accept]
+        params[accepted] = new_params[accept]
+        cost[accepted] = new_cost[accept]
+        residual[accepted] = new_residual[accept]
+        damping[rows] = np.where(accept, damping[rows] / 10, damping[rows] * 10)
+        converged[rows[small_change | small_step]] = True
+        failed[rows[damping[rows] > 1e16]] = True
+
+    converged &= ~failed
+    params[~converged] = np.nan
+    return params, converged
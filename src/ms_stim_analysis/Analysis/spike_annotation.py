@@ -0,0 +1,170 @@
+import numpy as np
+
+SPIKE_ANNOTATION_DTYPE = np.dtype(
+    [
+        ("unit", np.int64),
+        ("time", np.float64),
+        ("interval_id", np.int64),
+        ("pos", np.float64),
+        ("vel", np.float64),
+        ("phase", np.float64),
+    ]
+)
+
+
+def interval_membership(intervals: np.ndarray, timestamps: np.ndarray) -> np.ndarray:
+    """whether each timestamp falls in one of the intervals
+
+    Same result as interval_list_contains (both edges inclusive, zero-length
+    intervals contain their time), but returns a mask instead of the
+    contained timestamps. A timestamp is inside if more intervals start at or
+    before it than stop before it, so intervals may overlap.
+
+    Parameters
+    ----------
+    intervals : np.ndarray
+        (n_intervals, 2) array of [start, stop]
+    timestamps : np.ndarray
+        times to test
+
+    Returns
+    -------
+    np.ndarray
+        boolean mask, same shape as timestamps
+    """
+    intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+    # intervals that end before they start contain nothing
+    intervals = intervals[intervals[:, 0] <= intervals[:, 1]]
+    starts = np.sort(intervals[:, 0])
+    stops = np.sort(intervals[:, 1])
+    return (
+        np.searchsorted(starts, timestamps, side="right")
+        - np.searchsorted(stops, timestamps, side="left")
+    ) > 0
+
+
+def _sample_index(sample_time: np.ndarray, times: np.ndarray) -> np.ndarray:
+    # same convention as np.digitize(times, sample_time) used by the analyses,
+    # clipped so spikes after the last sample map onto it
+    return np.clip(
+        np.searchsorted(sample_time, times, side="right"), 0, len(sample_time) - 1
+    )
+
+
+def annotate_spikes(
+    spike_times: list,
+    interval_lists: list = None,
+    pos_time: np.ndarray = None,
+    pos: np.ndarray = None,
+    vel: np.ndarray = None,
+    phase_time: np.ndarray = None,
+    phase: np.ndarray = None,
+) -> np.ndarray:
+    """interval, position, velocity and phase of every spike of every unit
+
+    All spike trains are concatenated and sorted once, and each quantity is
+    looked up with a single searchsorted over all spikes instead of one
+    interval_list_contains / np.digitize call per unit and interval.
+
+    Parameters
+    ----------
+    spike_times : list
+        spike times of each unit (e.g. spike_df.spike_times)
+    interval_lists : list, optional
+        interval lists to label spikes with (e.g. [control, test]). interval_id
+        is the index of the first list containing the spike and spikes outside
+        all of them are dropped. If None, all spikes are kept with interval_id 0
+    pos_time, pos, vel : np.ndarray, optional
+        position timestamps and the position / velocity at each timestamp
+    phase_time, phase : np.ndarray, optional
+        phase timestamps and phase at each timestamp. Spikes outside
+        [phase_time[0], phase_time[-1]] get a phase of nan
+
+    Returns
+    -------
+    np.ndarray
+        structured array with SPIKE_ANNOTATION_DTYPE fields (unit, time,
+        interval_id, pos, vel, phase), ordered by unit then time. Fields without
+        the corresponding input are nan
+    """
+    spike_times = [np.asarray(spikes, dtype=np.float64) for spikes in spike_times]
+    n_spikes = [len(spikes) for spikes in spike_times]
+    times = np.concatenate(spike_times) if len(spike_times) else np.zeros(0)
+    units = np.repeat(np.arange(len(spike_times)), n_spikes)
+
+    # sort once so all lookups below run over monotonic query times
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    units = units[order]
+
+    interval_id = np.zeros(len(times), dtype=np.int64)
+    if interval_lists is not None:
+        interval_id[:] = -1
+        for i, intervals in enumerate(interval_lists):
+            unassigned = interval_id == -1
+            interval_id[unassigned] = np.where(
+                interval_membership(intervals, times[unassigned]), i, -1
+            )
+        keep = interval_id >= 0
+        times, units, interval_id = times[keep], units[keep], interval_id[keep]
+
+    annotation = np.zeros(len(times), dtype=SPIKE_ANNOTATION_DTYPE)
+    for field in ("pos", "vel", "phase"):
+        annotation[field] = np.nan
+    annotation["unit"] = units
+    annotation["time"] = times
+    annotation["interval_id"] = interval_id
+
+    if pos_time is not None and len(pos_time) and len(times):
+        pos_time = np.asarray(pos_time, dtype=np.float64)
+        ind = _sample_index(pos_time, times)
+        if pos is not None:
+            annotation["pos"] = np.asarray(pos)[ind]
+        if vel is not None:
+            annotation["vel"] = np.asarray(vel)[ind]
+
+    if phase_time is not None and len(phase_time) and len(times):
+        phase_time = np.asarray(phase_time, dtype=np.float64)
+        in_range = (times >= phase_time[0]) & (times <= phase_time[-1])
+        ind = _sample_index(phase_time, times[in_range])
+        annotation["phase"][in_range] = np.asarray(phase)[ind]
+
+    # back to unit order, spike times stay sorted within each unit
+    return annotation[np.argsort(annotation["unit"], kind="stable")]
+
+
+def split_by_unit(
+    annotation: np.ndarray,
+    field: str,
+    n_units: int,
+    interval_id: int = None,
+    mask: np.ndarray = None,
+) -> list:
+    """per-unit arrays of one field of annotate_spikes output
+
+    Parameters
+    ----------
+    annotation : np.ndarray
+        output of annotate_spikes
+    field : str
+        field to return, e.g. "pos" or "phase"
+    n_units : int
+        number of units (units without spikes get an empty array)
+    interval_id : int, optional
+        only return spikes from this interval list
+    mask : np.ndarray, optional
+        additional boolean mask of spikes to return
+
+    Returns
+    -------
+    list
+        one array per unit
+    """
+    select = np.ones(len(annotation), dtype=bool)
+    if interval_id is not None:
+        select &= annotation["interval_id"] == interval_id
+    if mask is not None:
+        select &= mask
+    annotation = annotation[select]
+    counts = np.bincount(annotation["unit"], minlength=n_units)
+    return np.split(annotation[field], np.cumsum(counts)[:-1])
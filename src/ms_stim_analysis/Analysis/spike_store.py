@@ -0,0 +1,158 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from spyglass.spikesorting.v0 import CuratedSpikeSorting
+
+from .utils import get_cache_dir
+
+UNIT_DTYPE = np.dtype(
+    [
+        ("sort_group_id", np.int64),
+        ("curation_id", np.int64),
+        ("unit_id", np.int64),
+        ("start", np.int64),
+        ("stop", np.int64),
+    ]
+)
+
+
+def _store_path(basic_key: dict) -> str:
+    return os.path.join(
+        get_cache_dir("spike_store"),
+        basic_key["nwb_file_name"].replace(os.sep, "_"),
+        basic_key["sort_interval_name"].replace(os.sep, "_"),
+    )
+
+
+def _latest_curations(basic_key: dict) -> dict:
+    """{sort_group_id: max curation_id} for the epoch, from a single query"""
+    sort_group_ids, curation_ids = (CuratedSpikeSorting() & basic_key).fetch(
+        "sort_group_id", "curation_id"
+    )
+    latest = {}
+    for sort_group, cur_id in zip(sort_group_ids, curation_ids):
+        latest[int(sort_group)] = max(int(cur_id), latest.get(int(sort_group), -1))
+    return latest
+
+
+def write_spike_store(basic_key: dict) -> str:
+    """materialize the curated units of an epoch as flat arrays on disk
+
+    Uses the latest curation of each sort group and keeps units with an empty
+    label, as the analyses did when fetching each sort group. Spike times of
+    all units are concatenated into spike_times.npy and units.npy holds the
+    sort group, curation and unit id of each unit with its [start, stop)
+    slice into spike_times. The curation used for each sort group is saved in
+    curations.npy to check the store against the database.
+
+    Parameters
+    ----------
+    basic_key : dict
+        key with nwb_file_name and sort_interval_name
+
+    Returns
+    -------
+    str
+        path to the store directory
+    """
+    latest = _latest_curations(basic_key)
+    spike_times = []
+    units = []
+    n_spikes = 0
+    for sort_group, cur_id in sorted(latest.items()):
+        key = {"sort_group_id": sort_group, "curation_id": cur_id}
+        tetrode_df = (CuratedSpikeSorting & basic_key & key).fetch_nwb()[0]
+        if "units" not in tetrode_df:
+            continue
+        tetrode_df = tetrode_df["units"]
+        tetrode_df = tetrode_df[tetrode_df.label == ""]
+        for unit_id, spikes in zip(tetrode_df.index, tetrode_df.spike_times):
+            spikes = np.asarray(spikes, dtype=np.float64)
+            units.append(
+                (sort_group, cur_id, unit_id, n_spikes, n_spikes + len(spikes))
+            )
+            spike_times.append(spikes)
+            n_spikes += len(spikes)
+
+    path = _store_path(basic_key)
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    # each writer stages in its own directory, so concurrent writes of the
+    # same store don't delete each other's files
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix=".tmp_")
+    os.chmod(tmp_path, 0o755)  # mkdtemp only gives the owner access
+    np.save(
+        os.path.join(tmp_path, "spike_times.npy"),
+        np.concatenate(spike_times) if spike_times else np.zeros(0),
+    )
+    np.save(os.path.join(tmp_path, "units.npy"), np.array(units, dtype=UNIT_DTYPE))
+    np.save(
+        os.path.join(tmp_path, "curations.npy"),
+        np.array(sorted(latest.items()), dtype=np.int64).reshape(-1, 2),
+    )
+    # swap in the complete store so readers never see a partial one. The old
+    # store is first renamed out of the way, since a directory can only
+    # replace an empty one
+    old_path = tempfile.mkdtemp(dir=parent, prefix=".old_")
+    try:
+        os.replace(path, os.path.join(old_path, "store"))
+    except FileNotFoundError:
+        pass
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another writer swapped in its complete store first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return path
+
+
+def load_spike_store(basic_key: dict, validate: bool = True) -> pd.DataFrame:
+    """curated units of an epoch, written to the spike store on first use
+
+    Spike times are memory-mapped views into the store, so loading every unit
+    of an epoch reads one file instead of opening the nwb file of each sort
+    group.
+
+    Parameters
+    ----------
+    basic_key : dict
+        key with nwb_file_name and sort_interval_name
+    validate : bool, optional
+        rewrite the store if the latest curation of any sort group has changed
+        since it was written (one database query), by default True
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per unit with sort_group_id, curation_id, unit_id and
+        spike_times
+    """
+    path = _store_path(basic_key)
+    units_file = os.path.join(path, "units.npy")
+    if not os.path.exists(units_file):
+        write_spike_store(basic_key)
+    elif validate:
+        stored = {
+            int(sort_group): int(cur_id)
+            for sort_group, cur_id in np.load(os.path.join(path, "curations.npy"))
+        }
+        if stored != _latest_curations(basic_key):
+            write_spike_store(basic_key)
+    units = np.load(units_file)
+
+    spike_times = np.load(os.path.join(path, "spike_times.npy"), mmap_mode="r")
+    spike_df = pd.DataFrame(
+        {
+            "sort_group_id": units["sort_group_id"],
+            "curation_id": units["curation_id"],
+            "unit_id": units["unit_id"],
+        }
+    )
+    spike_df["spike_times"] = [
+        spike_times[start:stop] for start, stop in zip(units["start"], units["stop"])
+    ]
+    return spike_df
@@ -3,13 +3,10 @@ import matplotlib.cm as cm
 import matplotlib.gridspec as gridspec
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 from tqdm import tqdm
 from spyglass.common import (
     IntervalList,
     PositionIntervalMap,
-    TaskEpoch,
-    convert_epoch_interval_name_to_position_interval_name,
     interval_list_contains,
     interval_list_intersect,
 )
@@ -20,12 +17,35 @@ from spyglass.position.v1 import TrodesPosV1
 from spyglass.spikesorting.analysis.v1.group import SortedSpikesGroup
 from spyglass.spikesorting.v0 import CuratedSpikeSorting
 
+from .accumulators import HistogramAccumulator
+from .rate_maps import (
+    occupancy_map,
+    population_spatial_information,
+    population_spike_counts,
+    relative_rate_maps,
+    smooth_rate_maps,
+    spatial_information_significance,
+)
+from .spike_annotation import annotate_spikes, interval_membership
 from .circular_shuffle import shuffled_spiking_distribution
+from .epoch_executor import dataset_epochs, map_epochs
 from .lfp_analysis import get_ref_electrode_index
+from .lfp_band_cache import fetch_band_phase
+from .spike_store import load_spike_store
 from .position_analysis import filter_position_ports, get_running_intervals
-from .utils import smooth, filter_opto_data
+from .utils import (
+    smooth,
+    filter_opto_data,
+    fetch_epoch_names,
+    get_epoch_interval_name,
+    get_position_interval_name,
+)
 from .spiking_place_fields import decoding_place_fields
-from ms_stim_analysis.AnalysisTables.ms_opto_stim_protocol import OptoStimProtocol
+from ms_stim_analysis.AnalysisTables.ms_opto_stim_protocol import (
+    OptoStimProtocol,
+    OptoStimPulses,
+)
+from ms_stim_analysis.AnalysisTables.phase_marks import PhaseMarks
 
 from .circular_shuffle import discrete_KL_divergence, stacked_marks_to_kl, bootstrap
 
@@ -47,6 +67,7 @@ def opto_spiking_dynamics(
     return_data: bool = False,
     limit_1_epoch: bool = False,
     neuron_type: str = None,
+    n_workers: int = None,
 ):
     """Function to plot the spiking dynamics around opto stimulations
 
@@ -64,6 +85,9 @@ def opto_spiking_dynamics(
         if True only analysze the first matching epoch in the data, by default False
     neuron_type : str, optional
         if not None, only analyze putative neurons of this type as defined by firing rate, by default None
+    n_workers : int, optional
+        number of processes used for the per-epoch computation, by default
+        epoch_executor.DEFAULT_N_WORKERS
 
     Returns
     -------
@@ -78,182 +102,38 @@ def opto_spiking_dynamics(
     """
     # get the filtered data
     dataset = filter_opto_data(dataset_key)
-    nwb_file_name_list = dataset.fetch("nwb_file_name")
-    position_interval_name_list = dataset.fetch("interval_list_name")
-    if limit_1_epoch:
-        nwb_file_name_list = nwb_file_name_list[:1]
-        position_interval_name_list = position_interval_name_list[:1]
 
     if len(plot_rng) < 3:
         raise ValueError("plot_rng is the histogram bins for plotting")
+    if "period_ms" in dataset_key:
+        shuffle_window = dataset_key["period_ms"] / 1000.0
+    else:
+        shuffle_window = 0.125
+    n_shuffles = 10
+
     # compile the data
+    epoch_keys = dataset_epochs(dataset, limit_1_epoch)
+    populate_alignment_marks(epoch_keys, marks)
+    epoch_results = map_epochs(
+        _opto_spiking_dynamics_epoch,
+        epoch_keys,
+        n_workers=n_workers,
+        plot_rng=plot_rng,
+        marks=marks,
+        neuron_type=neuron_type,
+        shuffle_window=shuffle_window,
+        n_shuffles=n_shuffles,
+    )
+    epoch_results = [x for x in epoch_results if x is not None]
     spike_counts = []
     spike_counts_shuffled = []
-    for nwb_file_name, position_interval_name in tqdm(
-        zip(nwb_file_name_list, position_interval_name_list)
-    ):
-        interval_name = (
-            (
-                PositionIntervalMap()
-                & {
-                    "nwb_file_name": nwb_file_name,
-                    "position_interval_name": position_interval_name,
-                }
-            )
-            * TaskEpoch()
-        ).fetch1("interval_list_name")
-        basic_key = {
-            "nwb_file_name": nwb_file_name,
-            "sorted_spikes_group_name": interval_name,
-        }
-        print(basic_key)
-        # get spike times for this interval
-        if not SortedSpikesGroup() & basic_key:
-            print("no compiled spiking data for", basic_key)
-            continue
-        sorted_group_key = (SortedSpikesGroup() & basic_key).fetch1("KEY")
-        spikes = SortedSpikesGroup().fetch_spike_data(sorted_group_key)
-        # filter based on overall firing rate
-        sort_interval = (
-            IntervalList
-            & {"nwb_file_name": nwb_file_name, "interval_list_name": interval_name}
-        ).fetch1("valid_times")
-        sort_time = np.sum([e[1] - e[0] for e in sort_interval])
-        rate = np.array([len(s) for s in spikes]) / sort_time
-        if neuron_type == "pyramidal":
-            spikes = [s for s, r in zip(spikes, rate) if r < 5]
-        elif neuron_type == "interneuron":
-            spikes = [s for s, r in zip(spikes, rate) if r > 5]
-
-        pos_interval_name = convert_epoch_interval_name_to_position_interval_name(
-            {"nwb_file_name": nwb_file_name, "interval_list_name": interval_name}
-        )
-        opto_key = {
-            "nwb_file_name": nwb_file_name,
-            "interval_list_name": pos_interval_name,
-        }
-
-        # Define what marks we're alligning to
-        if marks == "first_pulse":
-            pulse_timepoints = (
-                OptoStimProtocol() & opto_key
-            ).get_cylcle_begin_timepoints(opto_key)
-        elif marks == "all_pulses":
-            stim, time = (OptoStimProtocol() & opto_key).get_stimulus(opto_key)
-            pulse_timepoints = time[stim == 1]
-        elif marks == "odd_pulses":
-            # get times of firt pulse in cylce
-            t_mark_cycle = OptoStimProtocol().get_cylcle_begin_timepoints(opto_key)
-            # get times of all stimulus
-            stim, t_mark = OptoStimProtocol().get_stimulus(opto_key)
-            t_mark = t_mark[stim == 1]
-            # label each pulse as its count in the cycle
-            pulse_count = np.zeros_like(t_mark)
-            mark_ind_cycle = [np.where(t_mark == t_)[0][0] for t_ in t_mark_cycle]
-            pulse_count[mark_ind_cycle] = 1
-            count = 1
-            for i in range(pulse_count.size):
-                if pulse_count[i] == 1:
-                    count = 1
-                pulse_count[i] = count
-                count += 1
-            pulse_count = pulse_count - 1  # 0 index the count
-            pulse_timepoints = t_mark[pulse_count % 2 == 1]
-
-        elif marks == "theta_peaks":
-            # get all running theta peaks
-            band_key = {
-                "nwb_file_name": nwb_file_name,
-                "target_interval_list_name": interval_name,
-            }
-            pulse_timepoints = get_theta_peaks(band_key)
-            # subset to peaks within 1second of a cycle start
-            cycle_start = (OptoStimProtocol() & opto_key).get_cylcle_begin_timepoints(
-                opto_key
-            )
-            cycle_start_intervals = []
-            for t in cycle_start:
-                cycle_start_intervals.append([t, t + 1])
-            pulse_timepoints = interval_list_contains(
-                cycle_start_intervals, pulse_timepoints
-            )
-        elif "dummy_cycle" in marks:
-            dummy_freq = int(marks.split("=")[-1])
-            cycle_start = (OptoStimProtocol() & opto_key).get_cylcle_begin_timepoints(
-                opto_key
-            )
-            pulse_timepoints = []
-            for t in cycle_start:
-                pulse_timepoints.append(t)
-                for dummy_count in range(10):
-                    pulse_timepoints.append(t + dummy_count * 1 / dummy_freq)
-            pulse_timepoints = np.asarray(pulse_timepoints)
-
-        else:
-            raise ValueError(
-                "marks must be in [first_pulse, all_pulses, theta_peaks, dummy_cycle]"
-            )
-
-        interval_restrict = np.array(
-            [[tp + plot_rng[0], tp + plot_rng[-1]] for tp in pulse_timepoints]
-        )
-
-        interval_restrict = (
-            Interval(interval_restrict, no_overlap=True).consolidate().times
-        )
-
-        period = (OptoStimProtocol() & opto_key).fetch1("period_ms")
-        if "period_ms" in dataset_key:
-            shuffle_window = dataset_key["period_ms"] / 1000.0
-        else:
-            shuffle_window = 0.125
-        n_shuffles = 10
-        interval_restrict_shuffle = np.array(
-            [
-                [tp + plot_rng[0] - shuffle_window, tp + plot_rng[-1] + shuffle_window]
-                for tp in pulse_timepoints
-            ]
-        )
-        interval_restrict_shuffle = (
-            Interval(interval_restrict_shuffle, no_overlap=True).consolidate().times
-        )
-
-        # get histogram spike counts
-        for unit_spikes in spikes:
-            unit_spikes_restricted = np.unique(
-                interval_list_contains(interval_restrict, unit_spikes)
-            )
-            vals = bin_spikes_around_marks(
-                unit_spikes_restricted, pulse_timepoints, plot_rng
-            )
-            spike_counts.append(vals)
-            # if gauss_smooth:
-            #     vals = smooth(
-            #         vals, int(gauss_smooth / np.mean(np.diff(histogram_bins)))
-            #     )
-            # break
-            unit_spikes_restricted = np.unique(
-                interval_list_contains(interval_restrict_shuffle, unit_spikes)
-            )
-
-            def alligned_binned_spike_func(marks):
-                return np.array(
-                    [
-                        bin_spikes_around_marks(unit_spikes_restricted, m, plot_rng)
-                        for m in marks
-                    ]
-                )[None, :, :]
-
-            spike_counts_shuffled.extend(
-                shuffled_spiking_distribution(
-                    marks=pulse_timepoints,
-                    alligned_binned_spike_func=alligned_binned_spike_func,
-                    n_shuffles=n_shuffles,
-                    shuffle_window=shuffle_window,
-                )
-            )
+    for epoch_result in epoch_results:
+        spike_counts.extend(epoch_result["spike_counts"])
+        spike_counts_shuffled.extend(epoch_result["spike_counts_shuffled"])
+    n_marks = epoch_results[-1]["n_marks"] if epoch_results else 0
+    period = epoch_results[-1]["period"] if epoch_results else None
 
-    if len(spike_counts) == 0 or len(pulse_timepoints) == 0:
+    if len(spike_counts) == 0 or n_marks == 0:
         if return_data:
             return None, [], [], []
         return
@@ -459,6 +339,179 @@ def opto_spiking_dynamics(
     return fig
 
 
+def _opto_spiking_dynamics_epoch(
+    epoch: dict,
+    plot_rng: np.ndarray,
+    marks: str,
+    neuron_type: str,
+    shuffle_window: float,
+    n_shuffles: int,
+):
+    """spike counts around marks for every unit in one epoch of opto_spiking_dynamics"""
+    nwb_file_name = epoch["nwb_file_name"]
+    position_interval_name = epoch["interval_list_name"]
+    interval_name = get_epoch_interval_name(nwb_file_name, position_interval_name)
+    basic_key = {
+        "nwb_file_name": nwb_file_name,
+        "sorted_spikes_group_name": interval_name,
+    }
+    print(basic_key)
+    # get spike times for this interval
+    if not SortedSpikesGroup() & basic_key:
+        print("no compiled spiking data for", basic_key)
+        return None
+    sorted_group_key = (SortedSpikesGroup() & basic_key).fetch1("KEY")
+    spikes = SortedSpikesGroup().fetch_spike_data(sorted_group_key)
+    # filter based on overall firing rate
+    sort_interval = (
+        IntervalList
+        & {"nwb_file_name": nwb_file_name, "interval_list_name": interval_name}
+    ).fetch1("valid_times")
+    sort_time = np.sum([e[1] - e[0] for e in sort_interval])
+    rate = np.array([len(s) for s in spikes]) / sort_time
+    if neuron_type == "pyramidal":
+        spikes = [s for s, r in zip(spikes, rate) if r < 5]
+    elif neuron_type == "interneuron":
+        spikes = [s for s, r in zip(spikes, rate) if r > 5]
+
+    pos_interval_name = get_position_interval_name(nwb_file_name, interval_name)
+    opto_key = {
+        "nwb_file_name": nwb_file_name,
+        "interval_list_name": pos_interval_name,
+    }
+
+    # Define what marks we're alligning to
+    pulse_timepoints = get_alignment_marks(opto_key, interval_name, marks)
+
+    interval_restrict = np.array(
+        [[tp + plot_rng[0], tp + plot_rng[-1]] for tp in pulse_timepoints]
+    )
+
+    interval_restrict = Interval(interval_restrict, no_overlap=True).consolidate().times
+
+    period = (OptoStimProtocol() & opto_key).fetch1("period_ms")
+    interval_restrict_shuffle = np.array(
+        [
+            [tp + plot_rng[0] - shuffle_window, tp + plot_rng[-1] + shuffle_window]
+            for tp in pulse_timepoints
+        ]
+    )
+    interval_restrict_shuffle = (
+        Interval(interval_restrict_shuffle, no_overlap=True).consolidate().times
+    )
+
+    # get histogram spike counts
+    spike_counts = []
+    spike_counts_shuffled = []
+    for unit_spikes in spikes:
+        unit_spikes_restricted = np.unique(
+            interval_list_contains(interval_restrict, unit_spikes)
+        )
+        vals = bin_spikes_around_marks(
+            unit_spikes_restricted, pulse_timepoints, plot_rng
+        )
+        spike_counts.append(vals)
+        unit_spikes_restricted = np.unique(
+            interval_list_contains(interval_restrict_shuffle, unit_spikes)
+        )
+
+        def alligned_binned_spike_func(marks):
+            return np.array(
+                [
+                    bin_spikes_around_marks(unit_spikes_restricted, m, plot_rng)
+                    for m in marks
+                ]
+            )[None, :, :]
+
+        spike_counts_shuffled.extend(
+            shuffled_spiking_distribution(
+                marks=pulse_timepoints,
+                alligned_binned_spike_func=alligned_binned_spike_func,
+                n_shuffles=n_shuffles,
+                shuffle_window=shuffle_window,
+            )
+        )
+    return {
+        "spike_counts": spike_counts,
+        "spike_counts_shuffled": spike_counts_shuffled,
+        "n_marks": len(pulse_timepoints),
+        "period": period,
+    }
+
+
+def get_alignment_marks(opto_key: dict, interval_name: str, marks: str):
+    """times to align spiking to for an epoch
+
+    Parameters
+    ----------
+    opto_key : dict
+        key for OptoStimProtocol (nwb_file_name, interval_list_name)
+    interval_name : str
+        epoch interval name, used for the theta band key
+    marks : str
+        one of first_pulse, all_pulses, odd_pulses, theta_peaks, dummy_cycle=x
+
+    Returns
+    -------
+    np.ndarray
+        mark times
+    """
+    nwb_file_name = opto_key["nwb_file_name"]
+    if marks == "theta_peaks":
+        # get all running theta peaks
+        band_key = {
+            "nwb_file_name": nwb_file_name,
+            "target_interval_list_name": interval_name,
+        }
+        pulse_timepoints = get_theta_peaks(band_key)
+        # subset to peaks within 1second of a cycle start
+        cycle_start = OptoStimPulses().fetch_marks(opto_key, "first_pulse")
+        cycle_start_intervals = np.stack([cycle_start, cycle_start + 1], axis=1)
+        pulse_timepoints = interval_list_contains(
+            cycle_start_intervals, pulse_timepoints
+        )
+    elif marks in ["first_pulse", "all_pulses", "odd_pulses"] or (
+        "dummy_cycle" in marks
+    ):
+        pulse_timepoints = OptoStimPulses().fetch_marks(opto_key, marks)
+    else:
+        raise ValueError(
+            "marks must be in [first_pulse, all_pulses, theta_peaks, dummy_cycle]"
+        )
+    return pulse_timepoints
+
+
+def populate_alignment_marks(epoch_keys: list, marks: str):
+    """populate the tables get_alignment_marks reads for every epoch
+
+    get_alignment_marks only reads OptoStimPulses and PhaseMarks, so run this
+    in the calling process before map_epochs starts its workers
+
+    Parameters
+    ----------
+    epoch_keys : list
+        epoch keys (nwb_file_name and position interval_list_name), see
+        dataset_epochs
+    marks : str
+        marks passed to get_alignment_marks
+    """
+    OptoStimPulses().populate(epoch_keys, {"dio_event_name": "stim"})
+    if marks != "theta_peaks":
+        return
+    for epoch in epoch_keys:
+        interval_name = get_epoch_interval_name(
+            epoch["nwb_file_name"], epoch["interval_list_name"]
+        )
+        mark_key = _theta_mark_key(
+            {
+                "nwb_file_name": epoch["nwb_file_name"],
+                "target_interval_list_name": interval_name,
+            }
+        )
+        if mark_key is not None:
+            PhaseMarks().populate(mark_key)
+
+
 ###################################################################
 # Place Field + Opto Stimulation
 def opto_spiking_dynamics_place_dependence(
@@ -471,213 +524,44 @@ def opto_spiking_dynamics_place_dependence(
         [10, 99999],
     ],  # distance from place field center in cm
     normalize_rates: bool = True,
+    n_workers: int = None,
 ):
     # get the filtered data
     dataset = filter_opto_data(dataset_key)
     n_place = len(place_field_ranges)
 
+    if "period_ms" in dataset_key:
+        shuffle_window = dataset_key["period_ms"] / 1000.0
+    else:
+        shuffle_window = 0.125
+    n_shuffles = 10
+
     # compile the data
+    epoch_keys = dataset_epochs(dataset, limit_1_epoch=True)
+    populate_alignment_marks(epoch_keys, marks)
+    epoch_results = map_epochs(
+        _opto_spiking_dynamics_place_dependence_epoch,
+        epoch_keys,
+        n_workers=n_workers,
+        plot_rng=plot_rng,
+        marks=marks,
+        place_field_ranges=place_field_ranges,
+        shuffle_window=shuffle_window,
+        n_shuffles=n_shuffles,
+    )
+    epoch_results = [x for x in epoch_results if x is not None]
     spike_counts_list = [[] for _ in range(n_place)]
     spike_counts_shuffled_list = [[] for _ in range(n_place)]
     marks_counts_list = [[] for _ in range(n_place)]
-    for nwb_file_name, position_interval_name in tqdm(
-        zip(dataset.fetch("nwb_file_name")[:1], dataset.fetch("interval_list_name")[:1])
-    ):
-        interval_name = (
-            (
-                PositionIntervalMap()
-                & {
-                    "nwb_file_name": nwb_file_name,
-                    "position_interval_name": position_interval_name,
-                }
+    for epoch_result in epoch_results:
+        for n_pos in range(n_place):
+            spike_counts_list[n_pos].extend(epoch_result["spike_counts"][n_pos])
+            spike_counts_shuffled_list[n_pos].extend(
+                epoch_result["spike_counts_shuffled"][n_pos]
             )
-            * TaskEpoch()
-        ).fetch1("interval_list_name")
-        basic_key = {
-            "nwb_file_name": nwb_file_name,
-            "sorted_spikes_group_name": interval_name,
-        }
-        print(basic_key)
-
-        # get place field data
-        if not SortedSpikesDecodingV1() & basic_key:
-            print("no place field data for", basic_key)
-            continue
-        place_key = {
-            "nwb_file_name": nwb_file_name,
-            "interval_list_name": position_interval_name,
-        }
-        place_fields, place_bins = decoding_place_fields(
-            dataset_key=place_key,
-            return_place_fields=True,
-            plot=False,
-            return_correlations=False,
-            filter_specificity=False,
-            min_rate=0,
-            return_place_field_centers=True,
-        )
-        place_bins = np.array(place_bins)
-        # define the position of the center of each place field
-        place_field_centers = place_bins[np.argmax(place_fields[1], axis=1)]
-
-        # get position info for this interval
-        decode_key = (
-            SortedSpikesDecodingV1()
-            & basic_key
-            & {"encoding_interval": position_interval_name + "_opto_test_interval"}
-            & {"position_group_name": position_interval_name}
-        ).fetch1("KEY")
-        pos_df = SortedSpikesDecodingV1().fetch_linear_position_info(decode_key)
-
-        # get spike times for this interval
-        # if not SortedSpikesGroup() & basic_key:
-        #     print("no compiled spiking data for", basic_key)
-        #     continue
-        # sorted_group_key = (SortedSpikesGroup() & basic_key).fetch1("KEY")
-        # spikes = SortedSpikesGroup().fetch_spike_data(sorted_group_key)
-        spikes = SortedSpikesDecodingV1().fetch_spike_data(decode_key)
-
-        pos_interval_name = convert_epoch_interval_name_to_position_interval_name(
-            {"nwb_file_name": nwb_file_name, "interval_list_name": interval_name}
-        )
-        opto_key = {
-            "nwb_file_name": nwb_file_name,
-            "interval_list_name": pos_interval_name,
-        }
-
-        # Define what marks we're alligning to
-        if marks == "first_pulse":
-            pulse_timepoints = (
-                OptoStimProtocol() & opto_key
-            ).get_cylcle_begin_timepoints(opto_key)
-        elif marks == "all_pulses":
-            stim, time = (OptoStimProtocol() & opto_key).get_stimulus(opto_key)
-            pulse_timepoints = time[stim == 1]
-        elif marks == "odd_pulses":
-            # get times of firt pulse in cylce
-            t_mark_cycle = OptoStimProtocol().get_cylcle_begin_timepoints(opto_key)
-            # get times of all stimulus
-            stim, t_mark = OptoStimProtocol().get_stimulus(opto_key)
-            t_mark = t_mark[stim == 1]
-            # label each pulse as its count in the cycle
-            pulse_count = np.zeros_like(t_mark)
-            mark_ind_cycle = [np.where(t_mark == t_)[0][0] for t_ in t_mark_cycle]
-            pulse_count[mark_ind_cycle] = 1
-            count = 1
-            for i in range(pulse_count.size):
-                if pulse_count[i] == 1:
-                    count = 1
-                pulse_count[i] = count
-                count += 1
-            pulse_count = pulse_count - 1  # 0 index the count
-            pulse_timepoints = t_mark[pulse_count % 2 == 1]
-
-        elif marks == "theta_peaks":
-            # get all running theta peaks
-            band_key = {
-                "nwb_file_name": nwb_file_name,
-                "target_interval_list_name": interval_name,
-            }
-            pulse_timepoints = get_theta_peaks(band_key)
-            # subset to peaks within 1second of a cycle start
-            cycle_start = (OptoStimProtocol() & opto_key).get_cylcle_begin_timepoints(
-                opto_key
-            )
-            cycle_start_intervals = []
-            for t in cycle_start:
-                cycle_start_intervals.append([t, t + 1])
-            pulse_timepoints = interval_list_contains(
-                cycle_start_intervals, pulse_timepoints
-            )
-        elif "dummy_cycle" in marks:
-            dummy_freq = int(marks.split("=")[-1])
-            cycle_start = (OptoStimProtocol() & opto_key).get_cylcle_begin_timepoints(
-                opto_key
-            )
-            pulse_timepoints = []
-            for t in cycle_start:
-                pulse_timepoints.append(t)
-                for dummy_count in range(10):
-                    pulse_timepoints.append(t + dummy_count * 1 / dummy_freq)
-            pulse_timepoints = np.asarray(pulse_timepoints)
-
-        else:
-            raise ValueError(
-                "marks must be in [first_pulse, all_pulses, theta_peaks, dummy_cycle]"
-            )
-        n_marks = len(pulse_timepoints)
-        # get position info of pulse_timepoints
-        pos_ind = np.digitize(pulse_timepoints, pos_df.index.values)
-        pulse_pos = pos_df.linear_position.iloc[pos_ind].values
-        # general restriction on spike times considered
-        interval_restrict = np.array(
-            [[tp + plot_rng[0], tp + plot_rng[-1]] for tp in pulse_timepoints]
-        )
-        period = (OptoStimProtocol() & opto_key).fetch1("period_ms")
-        if "period_ms" in dataset_key:
-            shuffle_window = dataset_key["period_ms"] / 1000.0
-        else:
-            shuffle_window = 0.125
-        n_shuffles = 10
-        interval_restrict_shuffle = np.array(
-            [
-                [tp + plot_rng[0] - shuffle_window, tp + plot_rng[-1] + shuffle_window]
-                for tp in pulse_timepoints
-            ]
-        )
-        spikes = [s for s in spikes if len(s) > 0]
-
-        for n_pos, pos_range in enumerate(place_field_ranges):
-            # get histogram spike counts
-            for n_spike, unit_spikes in enumerate(spikes[:]):
-                # define what pulses happen in the right position relative to unit's place field
-                center_loc = place_field_centers[n_spike]
-                pulse_distance = np.abs(pulse_pos - center_loc)
-                pulse_ind = np.where(
-                    (pulse_distance > pos_range[0]) & (pulse_distance < pos_range[1])
-                )[0]
-                if len(pulse_ind) == 0:
-                    spike_counts_list[n_pos].append(np.ones(plot_rng.size - 1) * np.nan)
-                    spike_counts_shuffled_list[n_pos].extend(
-                        np.ones((1, 10, plot_rng.size - 1)) * np.nan
-                    )
-                    marks_counts_list[n_pos].append(len(pulse_ind))
-                    continue
-
-                unit_spikes_restricted = interval_list_contains(
-                    interval_restrict, unit_spikes
-                )
-                vals = bin_spikes_around_marks(
-                    unit_spikes_restricted, pulse_timepoints[pulse_ind], plot_rng
-                )
-                spike_counts_list[n_pos].append(vals)  # / float(len(pulse_ind)))
-                marks_counts_list[n_pos].append(float(len(pulse_ind)))
-                # if gauss_smooth:
-                #     vals = smooth(
-                #         vals, int(gauss_smooth / np.mean(np.diff(histogram_bins)))
-                #     )
-                # break
-                unit_spikes_restricted = interval_list_contains(
-                    interval_restrict_shuffle, unit_spikes
-                )
-
-                def alligned_binned_spike_func(marks):
-                    return np.array(
-                        [
-                            bin_spikes_around_marks(unit_spikes_restricted, m, plot_rng)
-                            for m in marks
-                        ]
-                    )[None, :, :]
-
-                spike_counts_shuffled_list[n_pos].extend(
-                    shuffled_spiking_distribution(
-                        marks=pulse_timepoints[pulse_ind],
-                        alligned_binned_spike_func=alligned_binned_spike_func,
-                        n_shuffles=n_shuffles,
-                        shuffle_window=shuffle_window,
-                    )
-                )
-        # break
+            marks_counts_list[n_pos].extend(epoch_result["marks_counts"][n_pos])
+    period = epoch_results[-1]["period"] if epoch_results else None
+    n_marks = epoch_results[-1]["n_marks"] if epoch_results else 0
 
     # if len(spike_counts_list) == 0 or len(pulse_timepoints) == 0:
     #     if return_data:
@@ -987,6 +871,139 @@ def opto_spiking_dynamics_place_dependence(
     return fig
 
 
+def _opto_spiking_dynamics_place_dependence_epoch(
+    epoch: dict,
+    plot_rng: np.ndarray,
+    marks: str,
+    place_field_ranges: list,
+    shuffle_window: float,
+    n_shuffles: int,
+):
+    """spike counts around marks split by distance from each unit's place field"""
+    nwb_file_name = epoch["nwb_file_name"]
+    position_interval_name = epoch["interval_list_name"]
+    n_place = len(place_field_ranges)
+    interval_name = get_epoch_interval_name(nwb_file_name, position_interval_name)
+    basic_key = {
+        "nwb_file_name": nwb_file_name,
+        "sorted_spikes_group_name": interval_name,
+    }
+    print(basic_key)
+
+    # get place field data
+    if not SortedSpikesDecodingV1() & basic_key:
+        print("no place field data for", basic_key)
+        return None
+    place_key = {
+        "nwb_file_name": nwb_file_name,
+        "interval_list_name": position_interval_name,
+    }
+    place_fields, place_bins = decoding_place_fields(
+        dataset_key=place_key,
+        return_place_fields=True,
+        plot=False,
+        return_correlations=False,
+        filter_specificity=False,
+        min_rate=0,
+        return_place_field_centers=True,
+    )
+    place_bins = np.array(place_bins)
+    # define the position of the center of each place field
+    place_field_centers = place_bins[np.argmax(place_fields[1], axis=1)]
+
+    # get position info for this interval
+    decode_key = (
+        SortedSpikesDecodingV1()
+        & basic_key
+        & {"encoding_interval": position_interval_name + "_opto_test_interval"}
+        & {"position_group_name": position_interval_name}
+    ).fetch1("KEY")
+    pos_df = SortedSpikesDecodingV1().fetch_linear_position_info(decode_key)
+
+    # get spike times for this interval
+    spikes = SortedSpikesDecodingV1().fetch_spike_data(decode_key)
+
+    pos_interval_name = get_position_interval_name(nwb_file_name, interval_name)
+    opto_key = {
+        "nwb_file_name": nwb_file_name,
+        "interval_list_name": pos_interval_name,
+    }
+
+    # Define what marks we're alligning to
+    pulse_timepoints = get_alignment_marks(opto_key, interval_name, marks)
+    # get position info of pulse_timepoints
+    pos_ind = np.digitize(pulse_timepoints, pos_df.index.values)
+    pulse_pos = pos_df.linear_position.iloc[pos_ind].values
+    # general restriction on spike times considered
+    interval_restrict = np.array(
+        [[tp + plot_rng[0], tp + plot_rng[-1]] for tp in pulse_timepoints]
+    )
+    period = (OptoStimProtocol() & opto_key).fetch1("period_ms")
+    interval_restrict_shuffle = np.array(
+        [
+            [tp + plot_rng[0] - shuffle_window, tp + plot_rng[-1] + shuffle_window]
+            for tp in pulse_timepoints
+        ]
+    )
+    spikes = [s for s in spikes if len(s) > 0]
+
+    spike_counts_list = [[] for _ in range(n_place)]
+    spike_counts_shuffled_list = [[] for _ in range(n_place)]
+    marks_counts_list = [[] for _ in range(n_place)]
+    for n_pos, pos_range in enumerate(place_field_ranges):
+        # get histogram spike counts
+        for n_spike, unit_spikes in enumerate(spikes[:]):
+            # define what pulses happen in the right position relative to unit's place field
+            center_loc = place_field_centers[n_spike]
+            pulse_distance = np.abs(pulse_pos - center_loc)
+            pulse_ind = np.where(
+                (pulse_distance > pos_range[0]) & (pulse_distance < pos_range[1])
+            )[0]
+            if len(pulse_ind) == 0:
+                spike_counts_list[n_pos].append(np.ones(plot_rng.size - 1) * np.nan)
+                spike_counts_shuffled_list[n_pos].extend(
+                    np.ones((1, 10, plot_rng.size - 1)) * np.nan
+                )
+                marks_counts_list[n_pos].append(len(pulse_ind))
+                continue
+
+            unit_spikes_restricted = interval_list_contains(
+                interval_restrict, unit_spikes
+            )
+            vals = bin_spikes_around_marks(
+                unit_spikes_restricted, pulse_timepoints[pulse_ind], plot_rng
+            )
+            spike_counts_list[n_pos].append(vals)  # / float(len(pulse_ind)))
+            marks_counts_list[n_pos].append(float(len(pulse_ind)))
+            unit_spikes_restricted = interval_list_contains(
+                interval_restrict_shuffle, unit_spikes
+            )
+
+            def alligned_binned_spike_func(marks):
+                return np.array(
+                    [
+                        bin_spikes_around_marks(unit_spikes_restricted, m, plot_rng)
+                        for m in marks
+                    ]
+                )[None, :, :]
+
+            spike_counts_shuffled_list[n_pos].extend(
+                shuffled_spiking_distribution(
+                    marks=pulse_timepoints[pulse_ind],
+                    alligned_binned_spike_func=alligned_binned_spike_func,
+                    n_shuffles=n_shuffles,
+                    shuffle_window=shuffle_window,
+                )
+            )
+    return {
+        "spike_counts": spike_counts_list,
+        "spike_counts_shuffled": spike_counts_shuffled_list,
+        "marks_counts": marks_counts_list,
+        "n_marks": len(pulse_timepoints),
+        "period": period,
+    }
+
+
 ###################################################################
 # Theta distribution analysis
 def spiking_theta_distribution(
@@ -998,17 +1015,11 @@ def spiking_theta_distribution(
     dataset = filter_opto_data(dataset_key)
 
     # loop through datasets and get relevant results
-    spike_phase_list = [[], []]  # control, test
-    for nwb_file_name, position_interval_name in tqdm(
-        zip(dataset.fetch("nwb_file_name"), dataset.fetch("interval_list_name"))
-    ):
-        interval_name = (
-            PositionIntervalMap()
-            & {
-                "nwb_file_name": nwb_file_name,
-                "position_interval_name": position_interval_name,
-            }
-        ).fetch1("interval_list_name")
+    bins = np.linspace(0, 2 * np.pi, n_bins)
+    phase_counts_list = [[], []]  # control, test: per-unit phase histograms
+    n_spikes_list = [[], []]
+    for nwb_file_name, position_interval_name in tqdm(zip(*fetch_epoch_names(dataset))):
+        interval_name = get_epoch_interval_name(nwb_file_name, position_interval_name)
         basic_key = {
             "nwb_file_name": nwb_file_name,
             "sort_interval_name": interval_name,
@@ -1045,7 +1056,6 @@ def spiking_theta_distribution(
             )
 
         # define the test and control intervals
-        spike_df = []
         restrict_interval_list = [
             (OptoStimProtocol() & pos_key).fetch1("control_intervals"),
             (OptoStimProtocol() & pos_key).fetch1("test_intervals"),
@@ -1057,55 +1067,43 @@ def spiking_theta_distribution(
 
         # get phase information
         ref_elect, basic_key = get_ref_electrode_index(basic_key)  #
-        phase_df = (LFPBandV1() & band_key).compute_signal_phase(
-            electrode_list=[ref_elect]
-        )
+        phase_df = fetch_band_phase(band_key, [ref_elect])
         phase_time = phase_df.index
         phase_ = np.asarray(phase_df)[:, 0]
 
         # get the spike and position dat for each
-        for sort_group in set(
-            (CuratedSpikeSorting() & basic_key).fetch("sort_group_id")
-        ):
-            key = {"sort_group_id": sort_group}
-            cur_id = np.max(
-                (CuratedSpikeSorting() & basic_key & key).fetch("curation_id")
-            )
-            key["curation_id"] = cur_id
-            tetrode_df = (CuratedSpikeSorting & basic_key & key).fetch_nwb()[0]
-            if "units" in tetrode_df:
-                tetrode_df = tetrode_df["units"]
-                tetrode_df = tetrode_df[tetrode_df.label == ""]
-                spike_df.append(tetrode_df)
-        spike_df = pd.concat(spike_df)
+        spike_df = load_spike_store(basic_key)
 
         # determin the phase for each spike
-        for ii, restrict_interval in enumerate(restrict_interval_list):
-            spike_phase = []
-            for spikes in tqdm(spike_df.spike_times):
-                # find phase time bin of each spike
-                spikes = interval_list_contains(restrict_interval, spikes)
-                spikes = interval_list_contains(
-                    [[phase_time[0], phase_time[-1]]], spikes
-                )
-                spike_ind = np.digitize(spikes, phase_time, right=False)
-                spike_phase.append(phase_[spike_ind])
-            spike_phase_list[ii].append(spike_phase)
+        spike_annotation = annotate_spikes(
+            spike_df.spike_times,
+            restrict_interval_list,
+            phase_time=phase_time,
+            phase=phase_,
+        )
+        in_phase = np.isfinite(spike_annotation["phase"])
+        for ii in range(len(restrict_interval_list)):
+            # one histogram row per unit, accumulated from all units at once
+            spikes = spike_annotation[
+                in_phase & (spike_annotation["interval_id"] == ii)
+            ]
+            unit_phase = HistogramAccumulator(
+                [np.arange(len(spike_df) + 1) - 0.5, bins]
+            )
+            unit_phase.add(spikes["unit"], spikes["phase"])
+            phase_counts_list[ii].append(unit_phase.counts)
+            n_spikes_list[ii].append(
+                np.bincount(spikes["unit"], minlength=len(spike_df))
+            )
 
     # make figure
-    spike_phase_list = [np.concatenate(spike_phase) for spike_phase in spike_phase_list]
     fig, ax = plt.subplots(ncols=4, figsize=(15, 5))
-    bins = np.linspace(0, 2 * np.pi, n_bins)
     kl_list = [[], []]
-    for i, spike_phase in enumerate(spike_phase_list):
+    for i, (phase_counts, n_spikes) in enumerate(zip(phase_counts_list, n_spikes_list)):
         phase_density = []
-        for spikes in spike_phase:
-            if spikes.size < 10:
+        for yy, n in zip(np.concatenate(phase_counts), np.concatenate(n_spikes)):
+            if n < 10:
                 continue
-            yy, _ = np.histogram(
-                spikes,
-                bins=bins,
-            )
             phase_density.append(yy / np.mean(yy))
             kl_list[i].append(discrete_KL_divergence(yy, q="uniform", pool_bins=1))
 
@@ -1162,6 +1160,8 @@ def place_field_analysis(
     dataset_key: dict,
     plot_rng: np.ndarray = np.arange(-0.08, 0.2, 0.002),
     first_pulse_only: bool = False,
+    n_shuffles: int = 0,
+    alpha: float = 0.05,
 ):
     # define datasets
     dataset = filter_opto_data(dataset_key)
@@ -1169,16 +1169,8 @@ def place_field_analysis(
     # loop through datasets and get relevant results
     place_fields_list = [[], []]
     spatial_information_rate_list = [[], []]
-    for nwb_file_name, position_interval_name in tqdm(
-        zip(dataset.fetch("nwb_file_name"), dataset.fetch("interval_list_name"))
-    ):
-        interval_name = (
-            PositionIntervalMap()
-            & {
-                "nwb_file_name": nwb_file_name,
-                "position_interval_name": position_interval_name,
-            }
-        ).fetch1("interval_list_name")
+    for nwb_file_name, position_interval_name in tqdm(zip(*fetch_epoch_names(dataset))):
+        interval_name = get_epoch_interval_name(nwb_file_name, position_interval_name)
         basic_key = {
             "nwb_file_name": nwb_file_name,
             "sort_interval_name": interval_name,
@@ -1196,86 +1188,74 @@ def place_field_analysis(
             continue
 
         # define the test and control intervals
-        spike_df = []
         restrict_interval_list = [
             (OptoStimProtocol() & pos_key).fetch1("control_intervals"),
             (OptoStimProtocol() & pos_key).fetch1("test_intervals"),
         ]
         # get the spike and position dat for each
-        for sort_group in set(
-            (CuratedSpikeSorting() & basic_key).fetch("sort_group_id")
-        ):
-            key = {"sort_group_id": sort_group}
-            cur_id = np.max(
-                (CuratedSpikeSorting() & basic_key & key).fetch("curation_id")
-            )
-            key["curation_id"] = cur_id
-            tetrode_df = (CuratedSpikeSorting & basic_key & key).fetch_nwb()[0]
-            if "units" in tetrode_df:
-                tetrode_df = tetrode_df["units"]
-                tetrode_df = tetrode_df[tetrode_df.label == ""]
-                spike_df.append(tetrode_df)
-        spike_df = pd.concat(spike_df)
+        spike_df = load_spike_store(basic_key)
         pos_df = (TrodesPosV1() & pos_key).fetch1_dataframe()
         pos_time = np.asarray(pos_df.index)
         # determin the position fo each spike
-        spike_pos_list = []
-        for restrict_interval in restrict_interval_list:
-            spike_pos = []
-            for ii, spikes in tqdm(enumerate(spike_df.spike_times)):
-                # find position time bin of each spike
-                spikes = interval_list_contains(restrict_interval, spikes)
-                spike_ind = np.digitize(
-                    spikes,
-                    pos_time,
-                )
-                spike_pos.append(pos_df.position_x.iloc[spike_ind].values)
-            spike_pos_list.append(spike_pos)
+        spike_annotation = annotate_spikes(
+            spike_df.spike_times,
+            restrict_interval_list,
+            pos_time=pos_time,
+            pos=np.asarray(pos_df.position_x),
+        )
 
         crop = 10
         rng = np.linspace(
             np.min(pos_df.position_x) + crop, np.max(pos_df.position_x) - crop, 100
         )  # TODO: define more consistently
+        position_x = np.asarray(pos_df.position_x)
         occupancy_list = [
-            np.histogram(
-                pos_df.position_x[
-                    interval_list_contains(restrict_interval, pos_df.index)
-                ],
-                bins=rng,
-            )[0]
+            occupancy_map(
+                position_x[interval_membership(restrict_interval, pos_time)], rng
+            )
             for restrict_interval in restrict_interval_list
         ]
         occupancy_list = [
             smooth(occupancy, int(0.1 * rng.size)) for occupancy in occupancy_list
         ]
 
-        for i in range(len(spike_pos)):
-            val_list = []
-            sir = []
-            keep = False
-            sufficient_count = True
-            for spike_pos, restrict_interval, occupancy in zip(
-                spike_pos_list, restrict_interval_list, occupancy_list
-            ):
-                val = np.histogram(spike_pos[i], bins=rng)[0]
-                if val.sum() < 100:
-                    sufficient_count = False
-                val = smooth(val, int(0.1 * rng.size))
-                sir.append(spatial_information_rate(val, occupancy))
-
-                val = (val / occupancy) / (
-                    val.sum() / occupancy.sum()
-                )  # p(spike|pos)/p(spike)
-                # val = np.log(val)
-                val_list.append(val)
-                if np.nanmax(val) > 3:
-                    keep = True
-
-            if keep and sufficient_count:
-                # print(i)
-                for ii, val in enumerate(val_list):
-                    place_fields_list[ii].append(val)
-                    spatial_information_rate_list[ii].append(sir[ii])
+        # rate maps of all units at once, (units x position bins)
+        val_list = []
+        sir = []
+        keep = np.zeros(len(spike_df), dtype=bool)
+        sufficient_count = np.ones(len(spike_df), dtype=bool)
+        for i, occupancy in enumerate(occupancy_list):
+            spikes = spike_annotation[spike_annotation["interval_id"] == i]
+            val = population_spike_counts(
+                spikes["unit"], spikes["pos"], rng, len(spike_df)
+            )
+            sufficient_count &= val.sum(axis=1) >= 100
+            val = smooth_rate_maps(val, int(0.1 * rng.size))
+            sir.append(population_spatial_information(val, occupancy))
+            val = relative_rate_maps(val, occupancy)  # p(spike|pos)/p(spike)
+            val_list.append(val)
+            if n_shuffles:
+                # keep units with significant spatial information (circular shuffle)
+                _, p_value = spatial_information_significance(
+                    spikes["unit"],
+                    spikes["time"],
+                    len(spike_df),
+                    restrict_interval_list[i],
+                    pos_time,
+                    position_x,
+                    rng,
+                    occupancy,
+                    n_shuffles=n_shuffles,
+                    smooth_n=int(0.1 * rng.size),
+                )
+                keep |= p_value < alpha
+            else:
+                keep |= np.any(val > 3, axis=1)
+
+        for i in np.where(keep & sufficient_count)[0]:
+            for ii, val in enumerate(val_list):
+                place_fields_list[ii].append(val[i])
+                spatial_information_rate_list[ii].append(sir[ii][i])
     if len(place_fields_list[0]) == 0:
         return
     # fig = plt.figure(figsize=(5, 10))
@@ -1424,7 +1404,9 @@ def spatial_information_rate(
     # return np.nansum(spike_rate * np.log2(spike_rate))
 
 
-def get_theta_peaks(key):
+def _theta_mark_key(key):
+    """PhaseMarks restriction of the theta peaks of an epoch, None if it has no
+    theta band"""
     if not LFPBandV1 & key:
         map_key = key.copy()
         map_key["interval_list_name"] = key["target_interval_list_name"]
@@ -1434,50 +1416,17 @@ def get_theta_peaks(key):
         key["target_interval_list_name"] = pos_interval
         if not LFPBandV1 & key:
             print("no theta band for", key)
-            return []
-    ref_elect, basic_key = get_ref_electrode_index(key)  # get reference electrode
-    filter_key = {"filter_name": "Theta 5-11 Hz"}
-    # get phase information
-    phase_df = (LFPBandV1() & key & filter_key).compute_signal_phase(
-        electrode_list=[ref_elect]
-    )
-    phase_time = phase_df.index
-    phase_ = np.asarray(phase_df)[:, 0]
-
-    # find positive zero crossings
-    target_phase = np.pi  # TODO:pick this
-    phase_ -= target_phase
-    pos_zero_crossings = np.where(np.diff(np.sign(phase_)) > 0)[0]
-    marks = phase_time[pos_zero_crossings]
-
-    # filter against times rat is running and not in port
-    pos_key = {"nwb_file_name": key["nwb_file_name"]}
-    pos_key["interval_list_name"] = key["target_interval_list_name"]
-    if not (TrodesPosV1 & pos_key):
-        # try converting to position interval name
-        pos_interval = (PositionIntervalMap() & key).fetch1("position_interval_name")
-        pos_key2 = {
-            "nwb_file_name": key["nwb_file_name"],
-            "interval_list_name": pos_interval,
-        }
-        if not (TrodesPosV1 & pos_key2):
-            print("no position data for", key)
-            return []
-        else:
-            pos_key = pos_key2
-
-    # make intervals where rat is running
-    filter_speed = 10
-    run_intervals = get_running_intervals(**pos_key, filter_speed=filter_speed)
-    # print("run", run_intervals)
-    # intersect with position-defined intervals
-    valid_position_intervals = filter_position_ports(pos_key)
-    if len(valid_position_intervals) == 0:
-        return []
-    # print("position", valid_position_intervals)
-    run_intervals = interval_list_intersect(
-        np.array(run_intervals), np.array(valid_position_intervals)
-    )
+            return None
+    return {**key, "filter_name": "Theta 5-11 Hz", "phase_mark_name": "theta_peak"}
+
 
-    # return the theta marks from these intervals
-    return interval_list_contains(run_intervals, marks)
+def get_theta_peaks(key):
+    mark_key = _theta_mark_key(key)
+    if mark_key is None:
+        return []
+    # theta marks from times rat is running and not in port, see PhaseMarks
+    if not PhaseMarks & mark_key:
+        raise ValueError(
+            f"no PhaseMarks entry for {mark_key}, see populate_alignment_marks"
+        )
+    return (PhaseMarks & mark_key).fetch_marks(running=True, valid_position=True)
@@ -1,13 +1,19 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
-from spyglass.common import PositionIntervalMap
 from spyglass.common import interval_list_contains_ind
 
 
 from ms_stim_analysis.AnalysisTables.ms_opto_stim_protocol import OptoStimProtocol
 from .position_analysis import get_running_intervals, filter_position_ports
-from .utils import get_running_valid_intervals, autocorr2d, filter_opto_data, smooth
+from .utils import (
+    get_running_valid_intervals,
+    autocorr2d,
+    filter_opto_data,
+    fetch_epoch_names,
+    get_epoch_interval_name,
+    smooth,
+)
 
 
 def spiking_autocorrelation(
@@ -21,16 +27,8 @@ def spiking_autocorrelation(
     )
     dataset = filter_opto_data(dataset_key)
     C_all = [[], []]
-    for nwb_file_name, pos_interval_name in zip(
-        dataset.fetch("nwb_file_name"), dataset.fetch("interval_list_name")
-    ):
-        sort_interval_name = (
-            PositionIntervalMap()
-            & {
-                "nwb_file_name": nwb_file_name,
-                "position_interval_name": pos_interval_name,
-            }
-        ).fetch1("interval_list_name")
+    for nwb_file_name, pos_interval_name in zip(*fetch_epoch_names(dataset)):
+        sort_interval_name = get_epoch_interval_name(nwb_file_name, pos_interval_name)
 
         basic_key = {
             "nwb_file_name": nwb_file_name,
@@ -6,14 +6,20 @@ from spyglass.common import (
     interval_list_contains,
     interval_list_intersect,
     interval_list_contains_ind,
-    PositionIntervalMap,
-    TaskEpoch,
 )
 from spyglass.decoding.v1.sorted_spikes import SortedSpikesDecodingV1
 
 
-from ms_stim_analysis.AnalsyisTables.ms_opto_stim_protocol import OptoStimProtocol
-from .utils import filter_opto_data, get_running_valid_intervals, smooth
+from ms_stim_analysis.AnalysisTables.ms_opto_stim_protocol import OptoStimProtocol
+from .correlograms import lag_histogram
+from .epoch_executor import dataset_epochs, map_epochs
+from .rhythmicity import fit_gaussian_modulated_cosines, gaussian_modulated_cosine
+from .utils import (
+    filter_opto_data,
+    get_epoch_interval_name,
+    get_running_valid_intervals,
+    smooth,
+)
 from ms_stim_analysis.Style.style_guide import interval_style
 
 
@@ -60,12 +66,7 @@ def unit_autocorrelegram(
     # Get the delay time histogram
     if valid_interval is not None:
         spike_times = interval_list_contains(valid_interval, spike_times)
-    delays = np.subtract.outer(spike_times, spike_times)
-    # delays = delays[np.tril_indices_from(delays, k=0)] # if only care about positive lags and spikes are monotonically ordered in time
-    delays = np.ravel(delays)
-    delays = delays[np.logical_and(delays <= bins[-1], delays >= bins[0])]
-
-    vals, bins = np.histogram(delays, bins=bins)
+    vals = lag_histogram(spike_times, spike_times, bins)
     vals = vals + 1e-9  # laplace shift
     vals = vals / valid_bin_count[:-1] / np.mean(np.diff(bins))
     if smooth_sigma:
@@ -84,6 +85,7 @@ def autocorrelegram(
     return_periodicity_results: bool = False,
     return_auto_corr: bool = False,
     linear_detrend=False,
+    n_workers: int = None,
 ):
     """Function that calculates autocorrelegrams and periodicity of sorted units under optogenetic stimulation
 
@@ -95,6 +97,7 @@ def autocorrelegram(
         return_periodicity_results (bool, optional): whether to periodicity results, used in plot_periodicity_dependence(). Defaults to False.
         return_auto_corr (bool, optional): whether to return the autocorrelegrams. Used for development. Defaults to False.
         linear_detrend (bool, optional): whether to linear detrend the autocorrelogram. Defaults to False.
+        n_workers (int, optional): number of processes used for the per-epoch computation. Defaults to epoch_executor.DEFAULT_N_WORKERS.
     Returns:
        fig: subplot figure of results
         periodicity_results (optional): list of periodicity outputs from autocorrelegram()
@@ -104,97 +107,31 @@ def autocorrelegram(
 
     # get the matching epochs
     dataset = filter_opto_data(dataset_key)
-    nwb_file_names = dataset.fetch("nwb_file_name")
-    pos_interval_names = dataset.fetch("interval_list_name")
 
     # get the autocorrelegrams
+    epoch_results = map_epochs(
+        _autocorrelegram_epoch,
+        dataset_epochs(dataset),
+        n_workers=n_workers,
+        histogram_bins=histogram_bins,
+        filter_speed=filter_speed,
+        min_spikes=min_spikes,
+        min_run_time=min_run_time,
+    )
     results = [[], []]
     counts = []
     stim_results = []
-    for nwb_file_name, pos_interval in zip(nwb_file_names, pos_interval_names):
-        interval_name = (
-            (
-                PositionIntervalMap()
-                & {
-                    "nwb_file_name": nwb_file_name,
-                    "position_interval_name": pos_interval,
-                }
-            )
-            * TaskEpoch
-        ).fetch1(
-            "interval_list_name"
-        )  # [0]
-        basic_key = {
-            "nwb_file_name": nwb_file_name,
-            "sort_interval_name": interval_name,
-            "sorter": "mountainsort4",
-            "curation_id": 1,
-        }
-        pos_key = {
-            "nwb_file_name": basic_key["nwb_file_name"],
-            "interval_list_name": pos_interval,
-        }
-        # get the opto intervals
-        test_interval, control_interval = (OptoStimProtocol & pos_key).fetch1(
-            "test_intervals", "control_intervals"
-        )
-        # get the spike and position dat for each
-        decode_key = {
-            "nwb_file_name": nwb_file_name,
-            "encoding_interval": pos_interval,
-            "sorted_spikes_group_name": interval_name,
-        }
-        if not SortedSpikesDecodingV1 & decode_key:
+    for epoch_result in epoch_results:
+        if epoch_result is None:
             continue
-        decode_key = (SortedSpikesDecodingV1 & decode_key).fetch1("KEY")
-        spike_df = SortedSpikesDecodingV1().fetch_spike_data(
-            decode_key, filter_by_interval=False
-        )
-
-        run_intervals = get_running_valid_intervals(
-            pos_key, seperate_optogenetics=False, filter_speed=filter_speed
-        )
-        run_intervals = [
-            interval
-            for interval in run_intervals
-            if interval[1] - interval[0] > min_run_time
-        ]
-
-        for spikes in spike_df:
-            spikes = interval_list_contains(
-                run_intervals,
-                spikes,
-            )
-            if spikes.size < min_spikes:
-                continue
-            # counts.append(spikes.size)
-            for i, interval in enumerate(
-                [
-                    control_interval,
-                    test_interval,
-                ]
-            ):
-                valid_interval = interval_list_intersect(
-                    np.array(interval), np.array(run_intervals)
-                )
-                vals = unit_autocorrelegram(spikes, histogram_bins, valid_interval)
-
-                results[i].append(vals)
-
-        stim, stim_time = OptoStimProtocol().get_stimulus(pos_key)
-        stim_time = stim_time[stim == 1]
-        delays = np.subtract.outer(stim_time, stim_time)
-        delays = delays[np.tril_indices_from(delays, k=0)]
-        delays = delays[delays < histogram_bins[-1]]
-        vals, bins = np.histogram(delays, bins=histogram_bins)
-        vals = vals + 1e-9
-        vals = smooth(vals, int(0.015 / np.mean(np.diff(histogram_bins))))
-        bins = bins[:-1] + np.diff(bins) / 2
-        # vals = vals / vals.sum()
-        stim_results.append(vals)
+        epoch_autocorr, stim_vals = epoch_result
+        for i in range(2):
+            results[i].extend(epoch_autocorr[i])
+        stim_results.append(stim_vals)
+    bins = histogram_bins[:-1] + np.diff(histogram_bins) / 2
 
     results = [np.array(r) for r in results]
-    stim_results = np.array(stim_results) * np.nan
+    stim_results = np.array(stim_results)
 
     if len(results[0]) == 0:
         if return_periodicity_results:
@@ -217,6 +154,7 @@ def autocorrelegram(
     period = dataset_key["period_ms"] if "period_ms" in dataset_key else 0
     periods = [125, period, period]
     periodicity_results = []
+    stim_ax = ax[2].twinx()
     for i, (color, label, data) in enumerate(
         zip(
             [interval_style["control"], interval_style["test"], "purple"],
@@ -252,8 +190,10 @@ def autocorrelegram(
         ]
         ax[i].vlines(marks, 0, len(data), color="w", ls=":")
 
-        ax[2].plot(bins, np.median(data.T, axis=1), color=color)
-        ax[2].fill_between(
+        # the stimulus is on its own scale next to the unit autocorrelegrams
+        curve_ax = ax[2] if i < 2 else stim_ax
+        curve_ax.plot(bins, np.median(data.T, axis=1), color=color, label=label)
+        curve_ax.fill_between(
             bins,
             np.quantile(data.T, 0.25, axis=1),
             np.quantile(data.T, 0.75, axis=1),
@@ -310,7 +250,10 @@ def autocorrelegram(
         rhythmicity_score[1] - rhythmicity_score[0]
     ) / rhythmicity_score[0]
     ax[4].violinplot(
-        delta_rhythmicity, positions=[0], showmeans=False, showextrema=False
+        delta_rhythmicity[np.isfinite(delta_rhythmicity)],
+        positions=[0],
+        showmeans=False,
+        showextrema=False,
     )
     ax[4].set_ylabel("Rhythmicity (test-control)/control")
     ax[4].set_xticks([])
@@ -330,6 +273,8 @@ def autocorrelegram(
     ax[1].set_title("Optogenetic Test")
     ax[0].set_ylabel("Unit #")
     ax[2].set_ylabel("AutoCorrellegram")
+    stim_ax.set_ylabel("Stimulus AutoCorrellegram", color="purple")
+    stim_ax.spines[["top"]].set_visible(False)
     for a in ax[:3]:
         a.set_xlabel("Time (s)")
     for a in ax[2:4]:
@@ -357,6 +302,78 @@ def autocorrelegram(
     return fig
 
 
+def _autocorrelegram_epoch(
+    epoch: dict,
+    histogram_bins: np.ndarray,
+    filter_speed: float,
+    min_spikes: int,
+    min_run_time: float,
+):
+    """control/test autocorrelegrams of each unit and the stimulus autocorrelegram for one epoch"""
+    nwb_file_name = epoch["nwb_file_name"]
+    pos_interval = epoch["interval_list_name"]
+    interval_name = get_epoch_interval_name(nwb_file_name, pos_interval)
+    pos_key = {
+        "nwb_file_name": nwb_file_name,
+        "interval_list_name": pos_interval,
+    }
+    # get the opto intervals
+    test_interval, control_interval = (OptoStimProtocol & pos_key).fetch1(
+        "test_intervals", "control_intervals"
+    )
+    # get the spike and position dat for each
+    decode_key = {
+        "nwb_file_name": nwb_file_name,
+        "encoding_interval": pos_interval,
+        "sorted_spikes_group_name": interval_name,
+    }
+    if not SortedSpikesDecodingV1 & decode_key:
+        return None
+    decode_key = (SortedSpikesDecodingV1 & decode_key).fetch1("KEY")
+    spike_df = SortedSpikesDecodingV1().fetch_spike_data(
+        decode_key, filter_by_interval=False
+    )
+
+    run_intervals = get_running_valid_intervals(
+        pos_key, seperate_optogenetics=False, filter_speed=filter_speed
+    )
+    run_intervals = [
+        interval
+        for interval in run_intervals
+        if interval[1] - interval[0] > min_run_time
+    ]
+
+    results = [[], []]
+    for spikes in spike_df:
+        spikes = interval_list_contains(
+            run_intervals,
+            spikes,
+        )
+        if spikes.size < min_spikes:
+            continue
+        for i, interval in enumerate(
+            [
+                control_interval,
+                test_interval,
+            ]
+        ):
+            valid_interval = interval_list_intersect(
+                np.array(interval), np.array(run_intervals)
+            )
+            vals = unit_autocorrelegram(spikes, histogram_bins, valid_interval)
+
+            results[i].append(vals)
+
+    stim, stim_time = OptoStimProtocol().get_stimulus(pos_key)
+    stim_time = stim_time[stim == 1]
+    # each pulse pair once (non-negative lags), as a rate per pulse like the units
+    vals = lag_histogram(stim_time, stim_time, histogram_bins, min_lag=0)
+    vals = vals + 1e-9
+    vals = vals / max(stim_time.size, 1) / np.mean(np.diff(histogram_bins))
+    vals = smooth(vals, int(0.015 / np.mean(np.diff(histogram_bins))))
+    return results, vals
+
+
 def estimate_periodicity_timescale(autocorr, time, width=0.01):
     """
     Estimates the timescale of periodic peaks in the autocorrelation function.
@@ -466,91 +483,78 @@ def plot_periodicity_dependence(periodicities, driving_periods):
     return fig
 
 
-def rhythmicity_v2(data, tau=None, window=10, crosscorrelegram=False):
+def rhythmicity_v2(
+    data, tau=None, window=10, crosscorrelegram=False, return_status=False
+):
     """calculates rhythmicity of autocorrelogram
     Method from "Behavior-Dependent Activity and Synaptic Organization of Septo-hippocampal
     GABAergic Neurons Selectively Targeting the Hippocampal CA3 Area". Neuron 2017
+
+    The gaussian modulated cosines of all units are fit together with
+    fit_gaussian_modulated_cosines. Units whose fit did not converge get a nan
+    score, set return_status to also get the per-unit convergence.
     """
-    if tau.max() > 1:
-        tau = tau / 1000.0
     # get linear trend
     if tau is None:
         print("Assuming 1ms bins")
         tau = np.arange(data.shape[1]) * 0.001  # assume 1ms bins
+    if tau.max() > 1:
+        tau = tau / 1000.0
     # linear_trend = np.polyval(np.polyfit(tau, data, 1), tau)
-    rhythmicity_ = []
 
     ind_fit = np.logical_and(tau > 0.050, tau < 0.500)
     data = data[:, ind_fit]
     tau = tau[ind_fit]
     ind_peak = np.logical_and(tau > 0.100, tau < 0.200)
-    for x in data:
-        x = x / np.max(x[ind_peak])
-        x = np.clip(x, 0, 1)
-        try:
-            trend, fitted_function, params, r_squared = fit_data(
-                tau, x, crosscorrelegram=crosscorrelegram
-            )
-        except:
-            # if can't fit the function
-            rhythmicity_.append(0)
-            continue
-        # print(
-        #     "freq",
-        #     params[0],
-        #     "amplitude",
-        #     params[1],
-        #     "stddev",
-        #     params[2],
-        # )
-        rhythmicity_.append(rhythmicity_index(tau, data, fitted_function, trend))
-    return np.array(rhythmicity_)
-
-
-from scipy.optimize import curve_fit
-from scipy.stats import linregress
+    x = data / np.max(data[:, ind_peak], axis=1, keepdims=True)
+    x = np.clip(x, 0, 1)
+    trend, fitted_function, params, converged = fit_data(
+        tau, x, crosscorrelegram=crosscorrelegram
+    )
+    if not converged.all():
+        print(f"rhythmicity fit did not converge for {np.sum(~converged)} units")
+    rhythmicity_ = np.full(len(x), np.nan)
+    for i in np.where(converged)[0]:
+        rhythmicity_[i] = rhythmicity_index(tau, data, fitted_function[i], trend[i])
+    if return_status:
+        return rhythmicity_, converged
+    return rhythmicity_
 
 
 def linear_trend(x, y):
-    slope, intercept, r_value, p_value, std_err = linregress(x, y)
-    return slope * x + intercept, r_value**2
-
-
-def gaussian_modulated_cosine(
-    x,
-    frequency,
-    amplitude,
-    stddev,
-):  # phase=0):
-    return (
-        amplitude
-        * np.exp(-0.5 * ((x) / stddev) ** 2)
-        * np.cos(2 * np.pi * frequency * (x))
-    )
+    """least squares line through each row of y and its r squared"""
+    y = np.atleast_2d(y)
+    x_centered = x - np.mean(x)
+    y_centered = y - np.mean(y, axis=1, keepdims=True)
+    slope = y_centered @ x_centered / np.sum(x_centered**2)
+    intercept = np.mean(y, axis=1) - slope * np.mean(x)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        r_value = (y_centered @ x_centered) / np.sqrt(
+            np.sum(x_centered**2) * np.sum(y_centered**2, axis=1)
+        )
+    return slope[:, None] * x + intercept[:, None], r_value**2
 
 
 def fit_data(x, y, crosscorrelegram=False):
+    """detrend each row of y and fit a gaussian modulated cosine to it
+
+    Returns the (n, m) trends and fitted functions, the (n, 3) parameters and
+    whether each fit converged (nan parameters and fit where not)
+    """
     # Fit linear trend
     trend, r_squared = linear_trend(x, y)
 
     # Detrend data
     detrended_data = y - trend
 
-    # Fit Gaussian-modulated cosine
-    # Initial guess: frequency = 6 Hz, amplitude = max(detrended_data), stddev = 50 ms, phase = 0 (optional)
-    p0 = [6, np.max(detrended_data), 0.05]
-    if crosscorrelegram:
-        p0.append(0)
-    params, covariance = curve_fit(
-        gaussian_modulated_cosine,
-        x,
-        detrended_data,
-    )
+    # Fit Gaussian-modulated cosine, started from the best point of a
+    # (frequency, stddev) grid
+    params, converged = fit_gaussian_modulated_cosines(x, detrended_data)
 
     # Calculate fitted function
-    fitted_function = gaussian_modulated_cosine(x, *params)  # + trend
+    fitted_function = gaussian_modulated_cosine(x, *params.T[:, :, None])  # + trend
 
-    return trend, fitted_function, params, r_squared
+    return trend, fitted_function, params, converged
 
 
 def rhythmicity_index(x, y, fitted_function, trend):
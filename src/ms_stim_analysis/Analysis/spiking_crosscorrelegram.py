@@ -1,20 +1,36 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from scipy.signal import find_peaks
 from spyglass.common import (
-    PositionIntervalMap,
-    TaskEpoch,
     interval_list_contains,
-    interval_list_contains_ind,
     interval_list_intersect,
 )
 from spyglass.decoding.v1.sorted_spikes import SortedSpikesDecodingV1
 from spyglass.spikesorting.v0 import CuratedSpikeSorting
 from tqdm import tqdm
 
+from .correlograms import (
+    condition_bin_counts,
+    condition_correlograms,
+    condition_pair_lags,
+)
+from .decoder_cache import fetch_encoding_summary
+from .rhythmicity import (
+    boxcar_filter,
+    fft_rhythmicity,
+    local_peaks,
+    peak_trough_rhythmicity,
+)
+from .spike_annotation import annotate_spikes
 from .spiking_analysis import smooth
-from .utils import filter_opto_data, get_running_valid_intervals, violin_scatter
+from .epoch_executor import dataset_epochs, map_epochs
+from .utils import (
+    filter_opto_data,
+    fetch_epoch_names,
+    get_epoch_interval_name,
+    get_running_valid_intervals,
+    violin_scatter,
+)
 from ms_stim_analysis.AnalysisTables.ms_opto_stim_protocol import OptoStimProtocol
 from ms_stim_analysis.Style.style_guide import interval_style
 
@@ -49,8 +65,8 @@ def overlap_place_fields_crosscorrelegram(
     full_day_sort = False
     # get the matching epochs
     dataset = filter_opto_data(dataset_key)
-    nwb_file_name_list = dataset.fetch("nwb_file_name", limit=100)
-    interval_list = dataset.fetch("interval_list_name")
+    nwb_file_name_list, interval_list = fetch_epoch_names(dataset)
+    nwb_file_name_list = nwb_file_name_list[:100]
 
     results = [[], []]
     time = []
@@ -59,14 +75,7 @@ def overlap_place_fields_crosscorrelegram(
     # loop through epochs
     for nwb_file_name, interval in tqdm(zip(nwb_file_name_list, interval_list)):
 
-        sort_interval = (
-            (
-                PositionIntervalMap()
-                & {"nwb_file_name": nwb_file_name}
-                & {"position_interval_name": interval}
-            )
-            * TaskEpoch
-        ).fetch1("interval_list_name")
+        sort_interval = get_epoch_interval_name(nwb_file_name, interval)
         if full_day_sort:
             sort_interval = "manual_full_day"
 
@@ -79,11 +88,7 @@ def overlap_place_fields_crosscorrelegram(
         if not SortedSpikesDecodingV1() & key:
             continue
         # get the place field locations
-        result = (SortedSpikesDecodingV1() & key).fetch_model()
-        for k in list(result.encoding_model_.keys()):
-            print(k)
-            place_fields = result.encoding_model_[k]["place_fields"]
-            print("\n")
+        place_fields = fetch_encoding_summary(key)["place_fields"]
         # get the pairs of units that are correct distance apart
         included_pairs = []
         pair_distance = []
@@ -131,10 +136,7 @@ def overlap_place_fields_crosscorrelegram(
         0.01 / np.diff(time).mean()
     )  # take the average of the 10ms around the peak
     rhythmicity = [
-        np.array(
-            [cross_correlation_rhythmicity(x, peak_width, avg_window) for x in data]
-        )
-        for data in results
+        peak_trough_rhythmicity(data, peak_width, avg_window) for data in results
     ]
     ind_rhythmic = np.where(rhythmicity[0] > 0.05)[0]
 
@@ -172,20 +174,17 @@ def overlap_place_fields_crosscorrelegram(
 
     # peak_time = [time[:-1][data.argmax(axis=1)] for data in results]
 
-    filtered_corr = [boxcar_filter_set(data.T, 100, "divide").T for data in results]
+    filtered_corr = [boxcar_filter(data, 100, "divide", axis=-1) for data in results]
     # peak_time = [time[:-1][peak_window][data[:,peak_window].argmax(axis=1)] for data in filtered_corr]
 
-    all_peaks = [
-        [find_peaks(x, distance=peak_width)[0] for x in data] for data in filtered_corr
-    ]
-
-    def closest_peak(x):
-        if len(x):
-            return time[x[np.argmin(np.abs(time[x]))]]
-        else:
-            return 0
+    def closest_peak(data):
+        # time of the peak closest to zero lag in each row, 0 if there is none
+        peaks = local_peaks(data, peak_width)
+        peak_lag = np.where(peaks, np.abs(time[: peaks.shape[1]]), np.inf)
+        closest = np.argmin(peak_lag, axis=1)
+        return list(np.where(peaks.any(axis=1), time[closest], 0))
 
-    peak_time = [[closest_peak(x) for x in data] for data in all_peaks]
+    peak_time = [closest_peak(data) for data in filtered_corr]
 
     x_pos = []
     for i, (data, interval) in enumerate(zip(peak_time, ["control", "test"])):
@@ -239,6 +238,7 @@ def crosscorrelegram(
     window: float = 0.1,
     closest_spike_only=False,
     return_ids=False,
+    n_workers: int = None,
 ):
     """Returns the cross correlegram of spike times between unit pairs in a dataset
 
@@ -251,6 +251,7 @@ def crosscorrelegram(
         gauss_smooth (float, optional): sigma of gausian smoothing, seconds. Defaults to 0.003.
         analyze_pairs (list, optional): If provided, only run analysis on pairs of neurons listed here. Defaults to None.
         window (float, optional): +-time window to analyze correlagram. Defaults to 0.1.
+        n_workers (int, optional): number of processes used for the per-epoch computation. Defaults to epoch_executor.DEFAULT_N_WORKERS.
 
     Returns:
         results, histogram_bins, rates: cross correlegrams (Hz), bins, firing rates (of individual neuron, Hz)
@@ -263,8 +264,7 @@ def crosscorrelegram(
         raise ValueError(
             "If analyzing specific pairs, must restrict to one dataset at a time"
         )
-    nwb_file_names = dataset.fetch("nwb_file_name")
-    pos_interval_names = dataset.fetch("interval_list_name")
+    nwb_file_names, pos_interval_names = fetch_epoch_names(dataset)
 
     # get the cross-correlegrams
     results = [[], []]
@@ -286,153 +286,24 @@ def crosscorrelegram(
     ###########
     ###########
 
-    for nwb_file_name, pos_interval in zip(nwb_file_names, pos_interval_names):
-
-        interval_name = (
-            (
-                PositionIntervalMap()
-                & {"nwb_file_name": nwb_file_name}
-                & {"position_interval_name": pos_interval}
-            )
-            * TaskEpoch
-        ).fetch1("interval_list_name")
-        basic_key = {
-            "nwb_file_name": nwb_file_name,
-            "sort_interval_name": interval_name,
-            "sorter": "mountainsort4",
-            "curation_id": 1,
-        }
-        pos_key = {
-            "nwb_file_name": basic_key["nwb_file_name"],
-            "interval_list_name": pos_interval,
-        }
-        # get the opto intervals
-        test_interval, control_interval = (OptoStimProtocol & pos_key).fetch1(
-            "test_intervals", "control_intervals"
-        )
-        from spyglass.common import IntervalList
-
-        # test_interval = (
-        #     IntervalList
-        #     & {
-        #         "nwb_file_name": nwb_file_name,
-        #         "interval_list_name": pos_interval + "_stimulus_on_interval",
-        #     }
-        # ).fetch1("valid_times")
-
-        spike_df = []
-        decode_key = {
-            "nwb_file_name": nwb_file_name,
-            "encoding_interval": pos_interval,
-            "sorted_spikes_group_name": interval_name,
-            "position_group_name": pos_interval,
-        }
-        decode_key = (SortedSpikesDecodingV1 & decode_key).fetch1("KEY")
-        spike_df = SortedSpikesDecodingV1().fetch_spike_data(decode_key)
-
-        # define what intervals to use
-        run_intervals = get_running_valid_intervals(
-            pos_key, seperate_optogenetics=False, filter_speed=filter_speed
-        )
-        run_intervals = [
-            interval
-            for interval in run_intervals
-            if interval[1] - interval[0] > min_run_time
-        ]
-
-        histogram_bins = np.arange(-window, window, 0.0005)
-        print("number_units", len(spike_df))
-        # loop through unit pairs
-        for n_s1, spikes in enumerate(spike_df):
-            spikes = interval_list_contains(
-                run_intervals,
-                spikes,
-            )
-            if spikes.size < min_spikes:
-                continue
-
-            valid_bin_count = []
-            # print("spikes", spikes.size)
-            for interval in [control_interval, test_interval]:
-                bins = histogram_bins[:-1] + np.diff(histogram_bins) / 2
-                x = interval_list_contains(interval, spikes)
-                absolute_bin_times = np.add.outer(x, bins).ravel()
-                absolute_bin_index = np.array(
-                    [np.arange(bins.size) for _ in range(x.size)]
-                ).ravel()
-                valid_interval = interval_list_intersect(
-                    np.array(interval), np.array(run_intervals)
-                )
-                valid_interval = interval
-                valid_bin_index = absolute_bin_index[
-                    interval_list_contains_ind(valid_interval, absolute_bin_times)
-                ]
-                valid_bin_count.append(
-                    np.bincount(valid_bin_index, minlength=bins.size)
-                )
-
-            repeat_count = np.zeros(histogram_bins.size - 1)
-            # bin_centers = histogram_bins[:-1] + np.diff(histogram_bins) / 2
-            for n_s2, spikes_2 in enumerate(spike_df):
-                # skip if have a specific list of pairs and this pair is not in it
-                if (
-                    (analyze_pairs is not None)
-                    and (n_s1, n_s2) not in analyze_pairs
-                    and (n_s2, n_s1) not in analyze_pairs
-                ):
-                    continue
-                # skip auto correlegrams
-                if n_s1 == n_s2:
-                    continue
-                spikes_2 = interval_list_contains(
-                    run_intervals,
-                    spikes_2,
-                )
-                if spikes_2.size < min_spikes:
-                    continue
-
-                for i, interval in enumerate(
-                    [
-                        control_interval,
-                        test_interval,
-                    ]
-                ):
-                    x = interval_list_contains(interval, spikes)
-                    x2 = interval_list_contains(interval, spikes_2)
-
-                    # get the correlegram count
-                    delays = np.subtract.outer(x, x2)
-                    if closest_spike_only:
-                        closest_spike = np.argmin(np.abs(delays), axis=1)
-                        delays = np.array(
-                            [
-                                delays[ii, closest_spike[ii]]
-                                for ii in range(closest_spike.size)
-                            ]
-                        )
-                    delays = np.ravel(delays)
-                    delays = delays[delays < histogram_bins[-1]]
-                    delays = delays[delays >= histogram_bins[0]]
-                    vals, bins = np.histogram(delays, bins=histogram_bins)
-                    # vals = vals + 1e-1
-                    if gauss_smooth:
-                        sigma = int(
-                            gauss_smooth / np.mean(np.diff(histogram_bins))
-                        )  # turn gauss_smooth from seconds to bins
-                        # print(sigma)
-                        vals = smooth(vals, 3 * sigma, sigma)
-                    bins = bins[:-1] + np.diff(bins) / 2
-
-                    # vals = vals / vals.sum() # normalize
-                    vals = vals / (
-                        np.diff(bins).mean() * valid_bin_count[i]
-                    )  # normalize into rate (Hz)
-
-                    results[i].append(vals)
-                    rates[i].append(
-                        x2.size / np.sum([e - s for s, e in interval])
-                    )  # overall rate of the neuron
-                pair_id.append([n_s1, n_s2])
+    epoch_results = map_epochs(
+        _crosscorrelegram_epoch,
+        dataset_epochs(dataset),
+        n_workers=n_workers,
+        filter_speed=filter_speed,
+        min_spikes=min_spikes,
+        min_run_time=min_run_time,
+        gauss_smooth=gauss_smooth,
+        analyze_pairs=analyze_pairs,
+        window=window,
+        closest_spike_only=closest_spike_only,
+    )
+    histogram_bins = np.arange(-window, window, 0.0005)
+    for epoch_results_, epoch_rates, epoch_pair_id in epoch_results:
+        for i in range(2):
+            results[i].extend(epoch_results_[i])
+            rates[i].extend(epoch_rates[i])
+        pair_id.extend(epoch_pair_id)
 
     results = [np.array(r) for r in results]
     rates = [np.array(r) for r in rates]
@@ -442,6 +313,117 @@ def crosscorrelegram(
     return results, histogram_bins, rates
 
 
+def _crosscorrelegram_epoch(
+    epoch: dict,
+    filter_speed: float,
+    min_spikes: int,
+    min_run_time: float,
+    gauss_smooth: float,
+    analyze_pairs: list,
+    window: float,
+    closest_spike_only: bool,
+):
+    """control/test cross correlegrams (Hz) of unit pairs in one epoch of crosscorrelegram"""
+    nwb_file_name = epoch["nwb_file_name"]
+    pos_interval = epoch["interval_list_name"]
+    results = [[], []]
+    rates = [[], []]
+    pair_id = []
+
+    interval_name = get_epoch_interval_name(nwb_file_name, pos_interval)
+    basic_key = {
+        "nwb_file_name": nwb_file_name,
+        "sort_interval_name": interval_name,
+        "sorter": "mountainsort4",
+        "curation_id": 1,
+    }
+    pos_key = {
+        "nwb_file_name": basic_key["nwb_file_name"],
+        "interval_list_name": pos_interval,
+    }
+    # get the opto intervals
+    test_interval, control_interval = (OptoStimProtocol & pos_key).fetch1(
+        "test_intervals", "control_intervals"
+    )
+    from spyglass.common import IntervalList
+
+    # test_interval = (
+    #     IntervalList
+    #     & {
+    #         "nwb_file_name": nwb_file_name,
+    #         "interval_list_name": pos_interval + "_stimulus_on_interval",
+    #     }
+    # ).fetch1("valid_times")
+
+    spike_df = []
+    decode_key = {
+        "nwb_file_name": nwb_file_name,
+        "encoding_interval": pos_interval,
+        "sorted_spikes_group_name": interval_name,
+        "position_group_name": pos_interval,
+    }
+    decode_key = (SortedSpikesDecodingV1 & decode_key).fetch1("KEY")
+    spike_df = SortedSpikesDecodingV1().fetch_spike_data(decode_key)
+
+    # define what intervals to use
+    run_intervals = get_running_valid_intervals(
+        pos_key, seperate_optogenetics=False, filter_speed=filter_speed
+    )
+    run_intervals = [
+        interval
+        for interval in run_intervals
+        if interval[1] - interval[0] > min_run_time
+    ]
+
+    histogram_bins = np.arange(-window, window, 0.0005)
+    bins = histogram_bins[:-1] + np.diff(histogram_bins) / 2
+    print("number_units", len(spike_df))
+    # unit pairs with enough running spikes
+    spike_df = [interval_list_contains(run_intervals, spikes) for spikes in spike_df]
+    valid_units = [n for n, spikes in enumerate(spike_df) if spikes.size >= min_spikes]
+    pairs = [
+        (n_s1, n_s2)
+        for n_s1 in valid_units
+        for n_s2 in valid_units
+        # skip auto correlegrams and pairs not in a specific list of pairs
+        if n_s1 != n_s2
+        and (
+            analyze_pairs is None
+            or (n_s1, n_s2) in analyze_pairs
+            or (n_s2, n_s1) in analyze_pairs
+        )
+    ]
+    if len(pairs) == 0:
+        return results, rates, pair_id
+    pair_id = [[n_s1, n_s2] for n_s1, n_s2 in pairs]
+    reference_units, target_units = np.array(pairs).T
+
+    # correlegram counts of every pair in each condition, in one pass
+    conditions = [control_interval, test_interval]
+    counts = condition_correlograms(
+        spike_df, conditions, histogram_bins, pairs, closest_spike_only
+    )
+    # number of valid instances of each lagged bin for each reference unit
+    valid_bin_count = condition_bin_counts(spike_df, conditions, bins)
+    for i, interval in enumerate(conditions):
+        vals = counts[i].astype(float)
+        if gauss_smooth:
+            sigma = int(
+                gauss_smooth / np.mean(np.diff(histogram_bins))
+            )  # turn gauss_smooth from seconds to bins
+            vals = smooth(vals.T, 3 * sigma, sigma).T
+        # normalize into rate (Hz)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            vals = vals / (np.diff(bins).mean() * valid_bin_count[i][reference_units])
+        results[i] = list(vals)
+        # overall rate of the neuron
+        n_spikes = np.array(
+            [interval_list_contains(interval, spikes).size for spikes in spike_df]
+        )
+        rates[i] = list(n_spikes[target_units] / np.sum([e - s for s, e in interval]))
+    return results, rates, pair_id
+
+
 def crosscorrelegram_stimulus_only(
     dataset_key: dict,
     filter_speed: float = 10,
@@ -452,8 +434,7 @@ def crosscorrelegram_stimulus_only(
 ):
     # get the matching epochs
     dataset = filter_opto_data(dataset_key)
-    nwb_file_names = dataset.fetch("nwb_file_name")
-    pos_interval_names = dataset.fetch("interval_list_name")
+    nwb_file_names, pos_interval_names = fetch_epoch_names(dataset)
 
     # get the autocorrelegrams
     results = [[], []]
@@ -476,14 +457,7 @@ def crosscorrelegram_stimulus_only(
 
     for nwb_file_name, pos_interval in zip(nwb_file_names, pos_interval_names):
 
-        interval_name = (
-            (
-                PositionIntervalMap()
-                & {"nwb_file_name": nwb_file_name}
-                & {"position_interval_name": pos_interval}
-            )
-            * TaskEpoch
-        ).fetch1("interval_list_name")
+        interval_name = get_epoch_interval_name(nwb_file_name, pos_interval)
         basic_key = {
             "nwb_file_name": nwb_file_name,
             "sort_interval_name": interval_name,
@@ -541,58 +515,46 @@ def crosscorrelegram_stimulus_only(
         histogram_bins = np.arange(-0.1, 0.1, 0.0001)
         print("number_units", len(spike_df.spike_times.values))
 
-        for n_s1, spikes in enumerate(spike_df.spike_times.values):
-            spikes = interval_list_contains(
-                run_intervals_stim_only,
-                spikes,
+        # all pairs of units with enough spikes while stimulating
+        unit_spikes = [
+            interval_list_contains(run_intervals_stim_only, spikes)
+            for spikes in spike_df.spike_times.values
+        ]
+        valid_units = [
+            n for n, spikes in enumerate(unit_spikes) if spikes.size >= min_spikes
+        ]
+        pairs = [
+            (n_s1, n_s2) for n_s1 in valid_units for n_s2 in valid_units if n_s1 != n_s2
+        ]
+        if len(pairs) == 0:
+            continue
+        reference_units = np.array(pairs)[:, 0]
+
+        conditions = [control_interval, test_interval]
+        counts = condition_correlograms(unit_spikes, conditions, histogram_bins, pairs)
+        for i, interval in enumerate(conditions):
+            vals = counts[i] + 1e-9
+            if gauss_smooth:
+                vals = smooth(
+                    vals.T, int(gauss_smooth / np.mean(np.diff(histogram_bins)))
+                ).T
+            vals = vals / vals.sum(axis=1, keepdims=True)
+            results[i].extend(vals)
+            n_spikes = np.array(
+                [
+                    interval_list_contains(interval, spikes).size
+                    for spikes in unit_spikes
+                ]
             )
-            if spikes.size < min_spikes:
-                continue
-
-            for n_s2, spikes_2 in enumerate(spike_df.spike_times.values):
-                if n_s1 == n_s2:
-                    continue
-                spikes_2 = interval_list_contains(
-                    run_intervals_stim_only,
-                    spikes_2,
-                )
-                if spikes_2.size < min_spikes:
-                    continue
-
-                for i, interval in enumerate(
-                    [
-                        control_interval,
-                        test_interval,
-                    ]
-                ):
-                    x = interval_list_contains(interval, spikes)
-                    x2 = interval_list_contains(interval, spikes_2)
-
-                    delays = np.subtract.outer(x, x2)
-                    delays = delays[delays < histogram_bins[-1]]
-                    delays = delays[delays >= histogram_bins[0]]
-                    vals, bins = np.histogram(delays, bins=histogram_bins)
-                    # if vals.sum() < 100:
-                    #     continue
-                    vals = vals + 1e-9
-                    if gauss_smooth:
-                        vals = smooth(
-                            vals, int(gauss_smooth / np.mean(np.diff(histogram_bins)))
-                        )
-                    bins = bins[:-1] + np.diff(bins) / 2
-                    vals = vals / vals.sum()
-                    results[i].append(vals)
-                    rates[i].append(
-                        x.size
-                        / np.sum(
-                            [
-                                e - s
-                                for s, e in interval_list_intersect(
-                                    np.array(interval), run_intervals_stim_only
-                                )
-                            ]
-                        )
+            duration = np.sum(
+                [
+                    e - s
+                    for s, e in interval_list_intersect(
+                        np.array(interval), run_intervals_stim_only
                     )
+                ]
+            )
+            rates[i].extend(n_spikes[reference_units] / duration)
 
         # stim, stim_time = OptoStimProtocol().get_stimulus(pos_key)
         # stim_time = stim_time[stim == 1]
@@ -630,8 +592,7 @@ def spike_lag_vs_position(
     assert len(field_centers) == len(analyze_pairs)
     # get the matching epochs
     dataset = filter_opto_data(dataset_key)
-    nwb_file_names = dataset.fetch("nwb_file_name")
-    pos_interval_names = dataset.fetch("interval_list_name")
+    nwb_file_names, pos_interval_names = fetch_epoch_names(dataset)
 
     # get the autocorrelegrams
     lags = [[], []]
@@ -654,14 +615,7 @@ def spike_lag_vs_position(
 
     for nwb_file_name, pos_interval in zip(nwb_file_names, pos_interval_names):
 
-        interval_name = (
-            (
-                PositionIntervalMap()
-                & {"nwb_file_name": nwb_file_name}
-                & {"position_interval_name": pos_interval}
-            )
-            * TaskEpoch
-        ).fetch1("interval_list_name")
+        interval_name = get_epoch_interval_name(nwb_file_name, pos_interval)
         basic_key = {
             "nwb_file_name": nwb_file_name,
             "sort_interval_name": interval_name,
@@ -718,88 +672,77 @@ def spike_lag_vs_position(
 
         histogram_bins = np.arange(-0.2, 0.2, 0.0005)
         print("number_units", len(spike_df))
-        # loop through unit pairs
-        for n_s1, spikes in enumerate(spike_df):
-            spikes = interval_list_contains(
-                run_intervals,
-                spikes,
-            )
-            if spikes.size < min_spikes:
-                continue
+        # unit pairs to analyze, in either order
+        spike_df = [
+            interval_list_contains(run_intervals, spikes) for spikes in spike_df
+        ]
+        valid_units = [
+            n for n, spikes in enumerate(spike_df) if spikes.size >= min_spikes
+        ]
+        pairs = [
+            (n_s1, n_s2)
+            for n_s1 in valid_units
+            for n_s2 in valid_units
+            if n_s1 != n_s2
+            and ((n_s1, n_s2) in analyze_pairs or (n_s2, n_s1) in analyze_pairs)
+        ]
+        if len(pairs) == 0:
+            continue
+        ref_place = np.array(
+            [
+                field_centers[
+                    (
+                        analyze_pairs.index(pair)
+                        if pair in analyze_pairs
+                        else analyze_pairs.index(pair[::-1])
+                    )
+                ]
+                for pair in pairs
+            ]
+        )
 
-            for n_s2, spikes_2 in enumerate(spike_df):
-                # skip if have a specific list of pairs and this pair is not in it
-                if (
-                    (analyze_pairs is not None)
-                    and (n_s1, n_s2) not in analyze_pairs
-                    and (n_s2, n_s1) not in analyze_pairs
-                ):
-                    continue
-                # skip auto correlegrams
-                if n_s1 == n_s2:
-                    continue
-                spikes_2 = interval_list_contains(
-                    run_intervals,
-                    spikes_2,
+        # label each spike with its condition and position once
+        annotation = annotate_spikes(
+            spike_df,
+            [control_interval, test_interval],
+            pos_time=np.asarray(pos_df.index),
+            pos=pos_df.linear_position.values,
+        )
+        annotation = annotation[np.argsort(annotation["time"], kind="stable")]
+
+        # only the in-window spike pairs are enumerated
+        chunks = []
+        for condition, pair, delays, reference in condition_pair_lags(
+            annotation["time"],
+            annotation["unit"],
+            annotation["interval_id"],
+            pairs,
+            len(spike_df),
+            histogram_bins[0],
+            histogram_bins[-1],
+        ):
+            keep = (delays < histogram_bins[-1]) & (delays != 0)
+            chunks.append(
+                (
+                    condition[keep] * len(pairs) + pair[keep],
+                    delays[keep],
+                    annotation["pos"][reference[keep]] - ref_place[pair[keep]],
                 )
-                if spikes_2.size < min_spikes:
-                    continue
-
-                for i, interval in enumerate(
-                    [
-                        control_interval,
-                        test_interval,
-                    ]
-                ):
-                    x = interval_list_contains(interval, spikes)
-                    x2 = interval_list_contains(interval, spikes_2)
-
-                    delays = np.subtract.outer(x, x2)
-                    ref_times = np.subtract.outer(x, np.zeros_like(x2))
-
-                    ref_times = ref_times[delays < histogram_bins[-1]]
-                    delays = delays[delays < histogram_bins[-1]]
-                    ref_times = ref_times[delays >= histogram_bins[0]]
-                    delays = delays[delays >= histogram_bins[0]]
-                    ref_times = ref_times[delays != 0]
-                    delays = delays[delays != 0]
-
-                    # get the position for each spike
-                    pos_index = np.digitize(ref_times, pos_df.index)
-                    try:
-                        ref_ind = analyze_pairs.index((n_s1, n_s2))
-                    except:
-                        ref_ind = analyze_pairs.index((n_s2, n_s1))
-                    ref_place = field_centers[ref_ind]
-                    position = pos_df.linear_position.values[pos_index] - ref_place
-
-                    # save the results
-                    lags[i].append(delays)
-                    delta_positions[i].append(position)
-
-                    # vals, bins = np.histogram(delays, bins=histogram_bins)
-                    # # if vals.sum() < 100:
-                    # #     continue
-                    # vals = vals + 1e-9
-                    # if gauss_smooth:
-                    #     vals = smooth(
-                    #         vals, int(gauss_smooth / np.mean(np.diff(histogram_bins)))
-                    #     )
-                    # bins = bins[:-1] + np.diff(bins) / 2
-                    # vals = vals / vals.sum()
-                    # results[i].append(vals)
-                    # # rates[i].append(
-                    # #     x.size
-                    # #     / np.sum(
-                    # #         [
-                    # #             e - s
-                    # #             for s, e in interval_list_intersect(
-                    # #                 np.array(interval), np.array(run_intervals)
-                    # #             )
-                    # #         ]
-                    # #     )
-                    # # )
-                    # rates[i].append(x.size / np.sum([e - s for s, e in interval]))
+            )
+        if chunks:
+            group, delays, position = [np.concatenate(x) for x in zip(*chunks)]
+        else:
+            group, delays, position = np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+
+        # split into one array per pair and condition, in pair order
+        order = np.argsort(group, kind="stable")
+        split = np.cumsum(np.bincount(group, minlength=2 * len(pairs)))[:-1]
+        pair_delays = np.split(delays[order], split)
+        pair_positions = np.split(position[order], split)
+        for n_pair in range(len(pairs)):
+            for i in range(2):
+                lags[i].append(pair_delays[i * len(pairs) + n_pair])
+                delta_positions[i].append(pair_positions[i * len(pairs) + n_pair])
 
         # stim, stim_time = OptoStimProtocol().get_stimulus(pos_key)
         # stim_time = stim_time[stim == 1]
@@ -821,26 +764,12 @@ def spike_lag_vs_position(
 
 
 def cross_correlation_rhythmicity(x, width=150, avg_window=10):
-    peak_inds = find_peaks(x, distance=width)[0]
-    peak_vals = np.nanmean(
-        [np.nanmean(x[i - avg_window // 2 : i + avg_window // 2]) for i in peak_inds]
-    )
-    trough_inds = find_peaks(-x, distance=width)[0]
-    # trough_inds = (peak_inds[1:]+peak_inds[:-1])//2
-
-    trough_vals = np.nanmean(
-        [np.nanmean(x[i - avg_window // 2 : i + avg_window // 2]) for i in trough_inds]
-    )
-    rhythmicity = (peak_vals - trough_vals) / peak_vals
-    return rhythmicity
+    return peak_trough_rhythmicity(x, width, avg_window)[0]
 
 
 # def peak_corr_offset(x, width=150,):
 
 
-from scipy.signal import welch
-
-
 def get_fft_rhythmicities(
     cross_correlegrams, lag_times, freq_range=(5, 11), nperseg=None
 ):
@@ -863,41 +792,8 @@ def get_fft_rhythmicities(
     List
         the rhythmicity scores
     """
-
-    fft_rhythmicity = []
-    for x in cross_correlegrams:
-        if np.max(x) > 1e9:
-            print(x)
-            raise
-        xx = x / np.nanmax(x)
-        fs = 1 / np.mean(np.diff(lag_times))
-
-        # Use Welch's method with zero padding via nfft
-        frequencies, power_spectrum = welch(
-            xx, fs=fs, nperseg=nperseg, nfft=10000, scaling="density"
-        )
-        rhythm_power = np.nanmax(
-            power_spectrum[
-                np.logical_and(frequencies > freq_range[0], frequencies < freq_range[1])
-            ]
-        )
-        fft_rhythmicity.append(rhythm_power)
-    print(frequencies)
-    return np.array(fft_rhythmicity)  # [np.isfinite(fft_rhythmicity)]
-
-
-def boxcar_filter(x, size=100, method="subtract"):
-    filter = np.ones(size) / size
-    if method == "subtract":
-        return x - np.convolve(x, filter, mode="same")
-    elif method == "divide":
-        return x / np.convolve(x, filter, mode="same")
-    else:
-        raise NotImplementedError(f"method {method} not defined for boxcar filter")
+    return fft_rhythmicity(cross_correlegrams, lag_times, freq_range, nperseg)
 
 
 def boxcar_filter_set(data, size, method="subtract"):
-    result = []
-    for i in range(data.shape[1]):
-        result.append(boxcar_filter(data[:, i], size, method))
-    return np.array(result).T
+    return boxcar_filter(data, size, method, axis=0)
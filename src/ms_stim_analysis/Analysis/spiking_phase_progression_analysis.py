@@ -1,20 +1,21 @@
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import scipy.signal
 
-from spyglass.common import (
-    PositionIntervalMap,
-    interval_list_contains,
-)
 from spyglass.position.v1 import TrodesPosV1
-from spyglass.lfp.analysis.v1 import LFPBandV1
 from spyglass.spikesorting import CuratedSpikeSorting
 
-from .utils import filter_opto_data
+from .utils import (
+    filter_opto_data,
+    fetch_epoch_names,
+    get_epoch_interval_name,
+)
 from ms_stim_analysis.AnalysisTables.ms_opto_stim_protocol import OptoStimProtocol
 from .lfp_analysis import get_ref_electrode_index
+from .lfp_band_cache import fetch_band_phase
+from .spike_store import load_spike_store
+from .spike_annotation import annotate_spikes, split_by_unit
 
 
 def phase_progression_analysis(
@@ -32,16 +33,8 @@ def phase_progression_analysis(
     spike_velocity_list = [[], []]
     crop_rng = [np.nan, np.nan]
 
-    for nwb_file_name, position_interval_name in tqdm(
-        zip(dataset.fetch("nwb_file_name"), dataset.fetch("interval_list_name"))
-    ):
-        interval_name = (
-            PositionIntervalMap()
-            & {
-                "nwb_file_name": nwb_file_name,
-                "position_interval_name": position_interval_name,
-            }
-        ).fetch1("interval_list_name")
+    for nwb_file_name, position_interval_name in tqdm(zip(*fetch_epoch_names(dataset))):
+        interval_name = get_epoch_interval_name(nwb_file_name, position_interval_name)
         basic_key = {
             "nwb_file_name": nwb_file_name,
             "sort_interval_name": interval_name,
@@ -65,67 +58,55 @@ def phase_progression_analysis(
             continue
 
         # define the test and control intervals
-        spike_df = []
         restrict_interval_list = [
             (OptoStimProtocol() & pos_key).fetch1("control_intervals"),
             (OptoStimProtocol() & pos_key).fetch1("test_intervals"),
         ]
         # get the spike and position dat for each
-        for sort_group in set(
-            (CuratedSpikeSorting() & basic_key).fetch("sort_group_id")
-        ):
-            key = {"sort_group_id": sort_group}
-            cur_id = np.max(
-                (CuratedSpikeSorting() & basic_key & key).fetch("curation_id")
-            )
-            key["curation_id"] = cur_id
-            tetrode_df = (CuratedSpikeSorting & basic_key & key).fetch_nwb()[0]
-            if "units" in tetrode_df:
-                tetrode_df = tetrode_df["units"]
-                tetrode_df = tetrode_df[tetrode_df.label == ""]
-                spike_df.append(tetrode_df)
-        spike_df = pd.concat(spike_df)
+        spike_df = load_spike_store(basic_key)
 
         ### POSITION ###
         pos_df = (TrodesPosV1() & pos_key).fetch1_dataframe()
         crop_rng[0] = np.nanmin([crop_rng[0], np.nanmin(pos_df.position_x)])
         crop_rng[1] = np.nanmax([crop_rng[1], np.nanmax(pos_df.position_x)])
-        pos_time = np.asarray(pos_df.index)
-        # determin the position fo each spike
-        for i, restrict_interval in enumerate(restrict_interval_list):
-            spike_pos = []
-            for ii, spikes in tqdm(enumerate(spike_df.spike_times)):
-                # find position time bin of each spike
-                spikes = interval_list_contains(restrict_interval, spikes)
-                spike_ind = np.digitize(
-                    spikes,
-                    pos_time,
-                )
-                spike_pos.append(pos_df.position_x.iloc[spike_ind].values)
-                spike_velocity_list[i].append(pos_df.velocity_x.iloc[spike_ind].values)
-            spike_pos_list[i].extend(spike_pos)
 
         ### PHASE ###
         # get phase information
         ref_elect, basic_key = get_ref_electrode_index(basic_key)  #
-        phase_df = (LFPBandV1() & band_key).compute_signal_phase(
-            electrode_list=[ref_elect]
-        )
-        phase_time = phase_df.index
-        phase_ = np.asarray(phase_df)[:, 0]
+        phase_df = fetch_band_phase(band_key, [ref_elect])
 
-        # determin the phase for each spike
-        for i, restrict_interval in enumerate(restrict_interval_list):
-            spike_phase = []
-            for spikes in tqdm(spike_df.spike_times):
-                # find phase time bin of each spike
-                spikes = interval_list_contains(restrict_interval, spikes)
-                spikes = interval_list_contains(
-                    [[phase_time[0], phase_time[-1]]], spikes
+        # determin the position, velocity and phase for each spike in one pass
+        spike_annotation = annotate_spikes(
+            spike_df.spike_times,
+            restrict_interval_list,
+            pos_time=np.asarray(pos_df.index),
+            pos=np.asarray(pos_df.position_x),
+            vel=np.asarray(pos_df.velocity_x),
+            phase_time=np.asarray(phase_df.index),
+            phase=(np.asarray(phase_df)[:, 0] + np.pi) % (2 * np.pi),
+        )
+        # spikes outside the phase timestamps are dropped from all fields
+        in_phase = np.isfinite(spike_annotation["phase"])
+        for i in range(len(restrict_interval_list)):
+            spike_pos_list[i].extend(
+                split_by_unit(
+                    spike_annotation, "pos", len(spike_df), interval_id=i, mask=in_phase
+                )
+            )
+            spike_velocity_list[i].extend(
+                split_by_unit(
+                    spike_annotation, "vel", len(spike_df), interval_id=i, mask=in_phase
                 )
-                spike_ind = np.digitize(spikes, phase_time, right=False)
-                spike_phase.append((phase_[spike_ind] + np.pi) % (2 * np.pi))
-            spike_phase_list[i].extend(spike_phase)
+            )
+            spike_phase_list[i].extend(
+                split_by_unit(
+                    spike_annotation,
+                    "phase",
+                    len(spike_df),
+                    interval_id=i,
+                    mask=in_phase,
+                )
+            )
 
     ### PLOT heatmap ###
     nrows = 3
@@ -1,10 +1,14 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from spyglass.common import PositionIntervalMap, TaskEpoch
-
 from spyglass.decoding.v1.sorted_spikes import SortedSpikesDecodingV1
 
-from .utils import filter_opto_data, violin_scatter
+from .decoder_cache import fetch_encoding_summary
+from .utils import (
+    filter_opto_data,
+    fetch_epoch_names,
+    violin_scatter,
+    get_epoch_interval_name,
+)
 
 
 def decoding_place_fields(
@@ -21,8 +25,7 @@ def decoding_place_fields(
 ):
     # get the matching epochs
     dataset = filter_opto_data(dataset_key)
-    nwb_file_names = dataset.fetch("nwb_file_name")
-    pos_interval_names = dataset.fetch("interval_list_name")
+    nwb_file_names, pos_interval_names = fetch_epoch_names(dataset)
 
     # get the autocorrelegrams
     place_field_list = [[], [], []]
@@ -32,14 +35,7 @@ def decoding_place_fields(
     spikes = []
     place_bin_centers = None
     for nwb_file_name, pos_interval in zip(nwb_file_names, pos_interval_names):
-        interval_name = (
-            (
-                PositionIntervalMap()
-                & {"nwb_file_name": nwb_file_name}
-                & {"position_interval_name": pos_interval}
-            )
-            * TaskEpoch
-        ).fetch1("interval_list_name")
+        interval_name = get_epoch_interval_name(nwb_file_name, pos_interval)
         if full_day_sort:
             sort_interval = "manual_full_day"
         else:
@@ -63,14 +59,10 @@ def decoding_place_fields(
             decode_key = (SortedSpikesDecodingV1 & decode_key).fetch1("KEY")
             if i == 0:
                 spikes.extend((SortedSpikesDecodingV1).fetch_spike_data(decode_key))
-            fit_model = (
-                SortedSpikesDecodingV1
-                & key
-                & {"encoding_interval": pos_interval + encoding}
-            ).fetch_model()
+            encoding_summary = fetch_encoding_summary(decode_key)
 
             # get place fields
-            place_field = list(fit_model.encoding_model_.values())[0]["place_fields"]
+            place_field = encoding_summary["place_fields"]
             norm_place_field = place_field / np.sum(place_field, axis=1, keepdims=True)
             place_field_list[i].extend(norm_place_field)
             raw_place_field_list[i].extend(place_field)
@@ -89,28 +81,17 @@ def decoding_place_fields(
             n_bins = (
                 np.sum([x[1] - x[0] for x in encode_times]) * 500
             )  # TODO: don't hardcode sampling rate
-            mean_rates_list[i].extend(
-                np.array(list(fit_model.encoding_model_.values())[0]["mean_rates"])
-                * n_bins
-            )
+            mean_rates_list[i].extend(encoding_summary["mean_rates"] * n_bins)
             # get information rates
-            encoding = fit_model.encoding_model_
-            encoding = encoding[list(encoding.keys())[0]]
-            p_loc = encoding["occupancy"]
+            p_loc = encoding_summary["occupancy"]
             p_loc = p_loc / p_loc.sum()
             from ms_stim_analysis.Analysis.spiking_analysis import (
                 spatial_information_rate,
             )
 
-            place = list(
-                (
-                    SortedSpikesDecodingV1
-                    & key
-                    & {"encoding_interval": pos_interval + "_opto_test_interval"}
-                )
-                .fetch_model()
-                .encoding_model_.values()
-            )[0]["environment"].place_bin_centers_
+            place = fetch_encoding_summary(
+                {**key, "encoding_interval": pos_interval + "_opto_test_interval"}
+            )["place_bin_centers"]
             place = [float(x) for x in place]
             if place_bin_centers is None:
                 place_bin_centers = place
@@ -1,4 +1,14 @@
-from spyglass.common import Session, interval_list_intersect
+import os
+
+import datajoint as dj
+from spyglass.common import (
+    PositionIntervalMap,
+    Session,
+    TaskEpoch,
+    convert_epoch_interval_name_to_position_interval_name,
+    interval_list_intersect,
+)
+from spyglass.settings import temp_dir
 from datajoint.user_tables import UserTable
 import numpy as np
 from typing import Tuple
@@ -45,7 +55,8 @@ def filter_animal(table: UserTable, animal: str) -> UserTable:
         animal_key = [
             {"subject_id": name} for name in ["Yoshi", "Olive", "Wallie", "Bilbo"]
         ]
-    return table & ((table * Session) & animal_key).fetch("KEY")
+    # semijoin so the restriction stays part of a single query
+    return table & (Session & animal_key).proj()
 
 
 def filter_task(table: UserTable, task: str) -> UserTable:
@@ -84,21 +95,19 @@ def filter_task(table: UserTable, task: str) -> UserTable:
 
     if len(task) == 0:
         return table
+    contingencies = [task]
     for alias_set in alias_sets:
         if task in alias_set:
-            keys = []
-            for alias in alias_set:
-                keys.extend(
-                    (
-                        table * EpochIntervalListName * TaskIdentification
-                        & {"contingency": alias}
-                    ).fetch("KEY")
-                )
-            return table & keys
-
-    return table & (
-        table * EpochIntervalListName * TaskIdentification & {"contingency": task}
-    ).fetch("KEY")
+            contingencies = alias_set
+            break
+    # a list of dicts is an OR restriction, datajoint escapes the values
+    contingency_restriction = [{"contingency": alias} for alias in contingencies]
+    return (
+        table
+        & (
+            table * EpochIntervalListName * TaskIdentification & contingency_restriction
+        ).proj()
+    )
 
 
 def weighted_quantile(
@@ -437,15 +446,33 @@ def autocorr2d(x):
     return result[:n] / result[0]
 
 
+_dataset_cache = {}
+
+
+def clear_dataset_cache():
+    """forget datasets and interval names memoized for this session"""
+    _dataset_cache.clear()
+    _epoch_interval_cache.clear()
+
+
 def filter_opto_data(dataset_key: dict):
     """filter optogenetic data based on the dataset key
 
+    The restrictions are combined into a single query expression, memoized per
+    dataset_key (see clear_dataset_cache).
+
     Args:
         dataset_key (dict): restriction to filter by
 
     Returns:
         Table: filtered table
     """
+    cache_key = ("dataset", repr(sorted(dataset_key.items())))
+    if cache_key in _dataset_cache:
+        dataset, n_epochs = _dataset_cache[cache_key]
+        print("datasets:", n_epochs)
+        return dataset
+
     # define datasets
     dataset_table = OptoStimProtocol
     if "transfected" in dataset_key:
@@ -463,10 +490,121 @@ def filter_opto_data(dataset_key: dict):
         dataset = dataset & f"pulse_length_ms>{dataset_key['min_pulse_length']}"
     if "max_pulse_length" in dataset_key:
         dataset = dataset & f"pulse_length_ms<{dataset_key['max_pulse_length']}"
-    print("datasets:", len(dataset))
+    n_epochs = len(dataset)
+    print("datasets:", n_epochs)
+    _dataset_cache[cache_key] = (dataset, n_epochs)
     return dataset
 
 
+def fetch_epoch_names(dataset: UserTable) -> Tuple[np.ndarray, np.ndarray]:
+    """nwb_file_name and interval_list_name of every epoch in a dataset
+
+    Both are fetched in one query, so they are aligned, and memoized on the
+    dataset's SQL (see clear_dataset_cache).
+
+    Args:
+        dataset (UserTable): dataset, e.g. from filter_opto_data
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: nwb_file_name and interval_list_name arrays
+    """
+    cache_key = ("epochs", dataset.make_sql())
+    if cache_key not in _dataset_cache:
+        _dataset_cache[cache_key] = dataset.fetch("nwb_file_name", "interval_list_name")
+        # resolve the epoch interval names of the whole dataset while we're at it
+        resolve_epoch_interval_names(*_dataset_cache[cache_key])
+    return _dataset_cache[cache_key]
+
+
+# (nwb_file_name, position_interval_name) -> (interval_list_name, epoch)
+_epoch_interval_cache = {}
+
+
+def resolve_epoch_interval_names(nwb_file_names, position_interval_names) -> dict:
+    """map position interval names to their task epoch interval names
+
+    Pairs not resolved yet in this session are looked up together in one
+    PositionIntervalMap * TaskEpoch query. Sort groups and reference electrodes
+    are resolved and cached per session by the spike store and
+    lfp_analysis.resolve_session_electrodes.
+
+    Args:
+        nwb_file_names (Iterable[str]): nwb file of each epoch
+        position_interval_names (Iterable[str]): position interval name of each epoch
+
+    Returns:
+        dict: {(nwb_file_name, position_interval_name): (interval_list_name, epoch)}
+    """
+    pairs = list(zip(nwb_file_names, position_interval_names))
+    missing = [
+        {"nwb_file_name": nwb_file_name, "position_interval_name": pos_interval}
+        for nwb_file_name, pos_interval in set(pairs)
+        if (nwb_file_name, pos_interval) not in _epoch_interval_cache
+    ]
+    if missing:
+        rows = ((PositionIntervalMap() & missing) * TaskEpoch).fetch(
+            "nwb_file_name", "position_interval_name", "interval_list_name", "epoch"
+        )
+        resolved = {}
+        for nwb_file_name, pos_interval, interval_name, epoch in zip(*rows):
+            # same error as fetch1 if a position interval maps to several epochs
+            if (nwb_file_name, pos_interval) in resolved:
+                raise dj.DataJointError(
+                    f"more than one epoch for {nwb_file_name}, {pos_interval}"
+                )
+            resolved[(nwb_file_name, pos_interval)] = (interval_name, epoch)
+        # only cache once all rows are valid, so a retry raises again
+        _epoch_interval_cache.update(resolved)
+    return {
+        pair: _epoch_interval_cache[pair]
+        for pair in pairs
+        if pair in _epoch_interval_cache
+    }
+
+
+def get_epoch_interval_name(nwb_file_name: str, position_interval_name: str) -> str:
+    """task epoch interval name of a position interval, cached for the session
+
+    Args:
+        nwb_file_name (str): nwb file name
+        position_interval_name (str): position interval name, e.g. "pos 1 valid times"
+
+    Returns:
+        str: interval_list_name of the task epoch
+    """
+    resolved = resolve_epoch_interval_names([nwb_file_name], [position_interval_name])
+    if (nwb_file_name, position_interval_name) not in resolved:
+        raise dj.DataJointError(
+            f"no epoch found for {nwb_file_name}, {position_interval_name}"
+        )
+    return resolved[(nwb_file_name, position_interval_name)][0]
+
+
+def get_position_interval_name(nwb_file_name: str, interval_list_name: str) -> str:
+    """position interval name of a task epoch interval, from the session cache if possible
+
+    Falls back to convert_epoch_interval_name_to_position_interval_name if the
+    epoch hasn't been resolved or is mapped from several position intervals.
+
+    Args:
+        nwb_file_name (str): nwb file name
+        interval_list_name (str): task epoch interval name
+
+    Returns:
+        str: position interval name
+    """
+    matches = [
+        pos_interval
+        for (nwb, pos_interval), (interval_name, _) in _epoch_interval_cache.items()
+        if nwb == nwb_file_name and interval_name == interval_list_name
+    ]
+    if len(matches) == 1:
+        return matches[0]
+    return convert_epoch_interval_name_to_position_interval_name(
+        {"nwb_file_name": nwb_file_name, "interval_list_name": interval_list_name}
+    )
+
+
 def smooth(data, n=5, sigma=None, hamming=False):
     """smooths data with gaussian kernel of size n"""
     if n % 2 == 0:
@@ -567,6 +705,30 @@ def parse_unit_ids(unit_ids):
     return unit_ids
 
 
+def get_cache_dir(name: str) -> str:
+    """directory for derived-data caches of this package, created if missing
+
+    Caches live under $MS_STIM_CACHE_DIR if set, otherwise under the spyglass
+    temp directory.
+
+    Parameters
+    ----------
+    name : str
+        name of the cache (subdirectory)
+
+    Returns
+    -------
+    str
+        path to the cache directory
+    """
+    base = os.environ.get(
+        "MS_STIM_CACHE_DIR", os.path.join(temp_dir, "ms_stim_analysis_cache")
+    )
+    path = os.path.join(base, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 early_wtrack_files = [
     "Yoshi20220517_.nwb",
     "Yoshi20220518_.nwb",
@@ -0,0 +1,96 @@
+"""
+Benchmarks of helpers used in table makes against the slower routes they replaced:
+- event_times_in_intervals_bool against the per-interval masks it used before switching to searchsorted
+- remove_repeat_elements on integer DIO codes (ProcessedDioEvents.make) against the pandas Series of DIO
+names it was called on before the DIO channels were merged with numpy
+Run with: python -m ms_stim_analysis.AnalysisTables.Utils.benchmarks
+"""
+
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from .point_process_helpers import event_times_in_intervals_bool
+from .vector_helpers import remove_repeat_elements
+
+
+def _reference_event_times_in_intervals_bool(event_times, valid_time_intervals):
+    return (
+        np.sum(
+            np.asarray(
+                [
+                    np.logical_and(event_times >= t1, event_times <= t2)
+                    for t1, t2 in valid_time_intervals
+                ]
+            ),
+            axis=0,
+        )
+        > 0
+    )
+
+
+def _reference_first_pokes(dio_pokes_ups_df):
+    # first up event of each run at the same well, from a df of DIO names indexed by time
+    _, idxs = remove_repeat_elements(
+        dio_pokes_ups_df["dio_event_names"], keep_first=True
+    )
+    return dio_pokes_ups_df.iloc[idxs].index.to_numpy()
+
+
+def _first_pokes(codes, times):
+    # same from integer codes into the DIO names
+    _, idxs = remove_repeat_elements(codes, keep_first=True)
+    return times[idxs]
+
+
+def _time(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def run_benchmarks(n_events=100000, n_intervals=1000, number=5, seed=0):
+    """
+    Time each helper route against the one it replaced on synthetic data and check they agree
+    :param n_events: number of event times / DIO events
+    :param n_intervals: number of intervals for event_times_in_intervals_bool
+    :param number: calls per timing
+    :param seed: random seed
+    :return: df with reference and current time per call (s) and speedup for each case
+    """
+    rng = np.random.default_rng(seed)
+    event_times = np.sort(rng.uniform(0, 1000, n_events))
+    starts = np.sort(rng.uniform(0, 1000, n_intervals))
+    intervals = np.stack([starts, starts + rng.uniform(0, 2, n_intervals)], axis=1)
+    dio_names = np.asarray(["poke3", "poke4", "poke5"], dtype=object)
+    codes = rng.integers(0, len(dio_names), n_events)
+    dio_pokes_ups_df = pd.DataFrame(
+        {"dio_event_names": dio_names[codes]},
+        index=pd.Index(event_times, name="dio_event_times"),
+    )
+
+    cases = {
+        "event_times_in_intervals_bool": (
+            lambda: _reference_event_times_in_intervals_bool(event_times, intervals),
+            lambda: event_times_in_intervals_bool(event_times, intervals),
+        ),
+        "remove_repeat_elements (DIO pokes)": (
+            lambda: _reference_first_pokes(dio_pokes_ups_df),
+            lambda: _first_pokes(codes, event_times),
+        ),
+    }
+    results = []
+    for name, (reference, current) in cases.items():
+        if not np.array_equal(reference(), current()):
+            raise Exception(f"{name} does not match its reference version")
+        reference_time = _time(reference, number)
+        current_time = _time(current, number)
+        results.append(
+            (name, reference_time, current_time, reference_time / current_time)
+        )
+    return pd.DataFrame(
+        results, columns=["case", "reference_s", "current_s", "speedup"]
+    )
+
+
+if __name__ == "__main__":
+    print(run_benchmarks().to_string(index=False))
@@ -4,14 +4,21 @@ import numpy as np
 def event_times_in_intervals_bool(event_times,
                                   valid_time_intervals):
     """
-    Filter event times for those within valid_intervals
+    Filter event times for those within valid_intervals (both edges inclusive, intervals may overlap)
+    An event is in an interval if more intervals start at or before it than stop before it. Both counts come
+    from searchsorted on the sorted starts and stops, so cost is O((n + m) log m) for n events and m intervals.
     :param event_times: array-like with times of events
     :param valid_time_intervals: nested list with intervals for valid times
     :return: boolean indicating indices in event_times within valid_time_intervals
     """
-    return np.sum(np.asarray([np.logical_and(event_times >= t1,
-                                             event_times <= t2)
-                              for t1, t2 in valid_time_intervals]), axis=0) > 0
+    event_times = np.asarray(event_times)
+    valid_time_intervals = np.asarray(valid_time_intervals, dtype=float).reshape(-1, 2)
+    # intervals that end before they start contain no events
+    valid_time_intervals = valid_time_intervals[valid_time_intervals[:, 0] <= valid_time_intervals[:, 1]]
+    starts = np.sort(valid_time_intervals[:, 0])
+    stops = np.sort(valid_time_intervals[:, 1])
+    return (np.searchsorted(starts, event_times, side="right")
+            - np.searchsorted(stops, event_times, side="left")) > 0
 
 
 def event_times_in_intervals(event_times,
@@ -9,6 +9,7 @@ from .ms_opto_stim_protocol import *
 from .ms_statescript_event import *
 from .ms_task_identification import *
 from .ms_task_performance import *
+from .phase_marks import *
 from .place_fields import *
 from .ripples import *
 from .sequence_compression import *
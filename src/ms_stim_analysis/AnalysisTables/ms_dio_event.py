@@ -12,7 +12,6 @@ from .Utils.datajoint_table_helpers import (
     fetch1_dataframe,
     get_table_object_id_name,
 )
-from .Utils.df_helpers import df_pop
 from .Utils.nwbf_helpers import events_in_epoch_bool
 from .Utils.plot_helpers import format_ax
 from .Utils.vector_helpers import remove_repeat_elements
@@ -232,130 +231,92 @@ class ProcessedDioEvents(dj.Computed):
 
     def make(self, key):
 
-        # Put all processed dio events into a single df
+        # Put all processed dio events into a single time sorted stream, with
+        # each event's DIO name stored as an integer code into dio_names
         dio_df = (DioEvents & key).fetch1_dataframe()
-        dio_names = dio_df["dio_name"]  # DIO event names
-        dict_temp = {
-            "dio_event_names": [],
-            "dio_event_times": [],
-            "dio_event_values": [],
-        }  # initialize dictionary to store all dio events across epochs
-        for dio_name in dio_names:  # for each dio poke event
-            dio_event_times = df_pop(dio_df, {"dio_name": dio_name}, "dio_event_times")
-            dio_event_values = df_pop(
-                dio_df, {"dio_name": dio_name}, "dio_event_values"
+        dio_names = np.asarray(dio_df["dio_name"], dtype=object)  # DIO event names
+        codes, times, values = merge_dio_events(
+            dio_names, dio_df["dio_event_times"], dio_df["dio_event_values"]
+        )
+
+        def events_df(mask):
+            # names are only rebuilt here, when writing out
+            return pd.DataFrame(
+                {
+                    "dio_event_names": dio_names[codes[mask]],
+                    "dio_event_values": values[mask],
+                },
+                index=pd.Index(times[mask], name="dio_event_times"),
             )
-            dict_temp["dio_event_names"] += [dio_name] * len(dio_event_times)
-            dict_temp["dio_event_times"] += list(dio_event_times)
-            dict_temp["dio_event_values"] += list(dio_event_values)
-        all_dio_df = pd.DataFrame.from_dict(dict_temp)
-        all_dio_df.set_index("dio_event_times", inplace=True)
-        all_dio_df.sort_index(inplace=True)
+
+        def has_name(pattern):
+            # mask of the events of DIO names containing pattern
+            return np.array(
+                [pattern in dio_name for dio_name in dio_names], dtype=bool
+            )[codes]
 
         # Insert into table
-        all_dio_df_reset_index = (
-            all_dio_df.reset_index()
-        )  # index does not save out to analysis nwbf so must reset
-        insert_analysis_table_entry(self, [all_dio_df_reset_index], key)
+        all_dio = np.ones(len(codes), dtype=bool)
+        insert_analysis_table_entry(self, [events_df(all_dio).reset_index()], key)
 
         # Now prepare to populate subtables for stim events
         # Filter for stim events
-        poke_dio_names = [
-            dio_name for dio_name in dio_names if "stim" in dio_name
-        ]  # get names of stim dio events
-        dio_stim_df = all_dio_df[all_dio_df["dio_event_names"].isin(poke_dio_names)]
-        dio_stim_ups_df = dio_stim_df[
-            dio_stim_df["dio_event_values"] == 1
-        ]  # filter for up events
-        dio_stim_downs_df = dio_stim_df[
-            dio_stim_df["dio_event_values"] == 0
-        ]  # filter for down events
+        is_stim = has_name("stim")
+        is_up = values == 1
+        is_down = values == 0
 
         # Now prepare to populate subtables for pokes
         # Filter for dio poke events
-        poke_dio_names = [
-            dio_name for dio_name in dio_names if "poke" in dio_name
-        ]  # get names of poke dio events
-        dio_pokes_df = all_dio_df[all_dio_df["dio_event_names"].isin(poke_dio_names)]
+        is_poke = has_name("poke")
 
         # Get first dio up event in series of consecutive up events at same well
-        dio_pokes_ups_df = dio_pokes_df[
-            dio_pokes_df["dio_event_values"] == 1
-        ]  # filter for up events
+        poke_ups = np.where(is_poke & is_up)[0]
         _, idxs = remove_repeat_elements(
-            dio_pokes_ups_df["dio_event_names"], keep_first=True
+            codes[poke_ups], keep_first=True
         )  # find consecutive pokes at same well (after first)
-        dio_pokes_first_ups_df = dio_pokes_ups_df.iloc[
-            idxs
-        ]  # remove consecutive pokes at same well
+        first_ups = poke_ups[idxs]  # remove consecutive pokes at same well
 
         # Get last DIO down events in series of consecutive down events at same well
         # Only consider DIO down events that happen after first DIO up event
-        dio_pokes_downs_df = dio_pokes_df[
-            dio_pokes_df["dio_event_values"] == 0
-        ]  # filter for down events
-        # Initialize variable for first up time
-        if len(dio_pokes_downs_df) > 0:  # if down events
-            first_up_time = dio_pokes_downs_df.index[
-                -1
-            ]  # initialize variable for first up time to last down event
-        else:
-            first_up_time = -1  # value will not matter since no down pokes to filter
-        if len(dio_pokes_first_ups_df) > 0:  # if up events
-            first_up_time = dio_pokes_first_ups_df.index[
-                0
-            ]  # get time of first up event
-        dio_pokes_downs_df = dio_pokes_downs_df[
-            dio_pokes_downs_df.index > first_up_time
-        ]  # filter for down events after first up event
+        poke_downs = np.where(is_poke & is_down)[0]
+        if len(first_ups) > 0:  # if up events
+            poke_downs = poke_downs[times[poke_downs] > times[first_ups[0]]]
+        else:  # no down event is after the first up
+            poke_downs = poke_downs[:0]
         _, idxs = remove_repeat_elements(
-            dio_pokes_downs_df["dio_event_names"], keep_first=False
+            codes[poke_downs], keep_first=False
         )  # find consecutive pokes at same well (before last)
-        dio_pokes_last_downs_df = dio_pokes_downs_df.iloc[
-            idxs
-        ]  # remove consecutive pokes at same well
+        last_downs = poke_downs[idxs]  # remove consecutive pokes at same well
 
         # Check that same well visits found for first dio ups and last dio downs, tolerating having one less down than
         # up event (since recording can be stopped during a dio up)
-        if len(dio_pokes_first_ups_df) - len(dio_pokes_last_downs_df) not in [0, 1]:
+        n_downs = len(last_downs)
+        if len(first_ups) - n_downs not in [0, 1]:
             raise Exception(
                 f"Should have found either zero or one more dio up events than dio down events, but found "
-                f"{len(dio_pokes_first_ups_df) - len(dio_pokes_last_downs_df)}"
+                f"{len(first_ups) - n_downs}"
             )
-        if not all(
-            dio_pokes_last_downs_df["dio_event_names"].values
-            == dio_pokes_first_ups_df["dio_event_names"]
-            .iloc[: len(dio_pokes_last_downs_df)]
-            .values
-        ):
+        if not all(codes[last_downs] == codes[first_ups[:n_downs]]):
             raise Exception(
                 f"Not all well identities the same for first dio ups and last dio downs"
             )
         # Check that each dio down after same index dio up and before next index dio up
+        up_times, down_times = times[first_ups[:n_downs]], times[last_downs]
         if not np.logical_and(
-            all(
-                (
-                    dio_pokes_last_downs_df["dio_event_names"].index[:-1]
-                    - dio_pokes_first_ups_df["dio_event_names"]
-                    .iloc[: len(dio_pokes_last_downs_df)]
-                    .index[1:]
-                )
-                < 0
-            ),
-            all(
-                (
-                    dio_pokes_last_downs_df["dio_event_names"].index
-                    - dio_pokes_first_ups_df["dio_event_names"]
-                    .iloc[: len(dio_pokes_last_downs_df)]
-                    .index
-                )
-                > 0
-            ),
+            all(down_times[:-1] - up_times[1:] < 0),
+            all(down_times - up_times > 0),
         ):
             raise Exception(
                 f"At least one dio down is not after same index dio up and next index dio up"
             )
 
+        dio_stim_df = events_df(is_stim)
+        dio_stim_ups_df = events_df(is_stim & is_up)
+        dio_stim_downs_df = events_df(is_stim & is_down)
+        dio_pokes_df = events_df(is_poke)
+        dio_pokes_first_ups_df = events_df(first_ups)
+        dio_pokes_last_downs_df = events_df(last_downs)
+
         # Populate subtable for stim events
         insert_analysis_table_entry(self.Stim(), [dio_stim_df], key, reset_index=True)
 
@@ -429,16 +390,11 @@ class ProcessedDioEvents(dj.Computed):
         )
 
         # Populate subtable for pump events
-        pump_dio_names = [
-            dio_name for dio_name in dio_names if "pump" in dio_name
-        ]  # filter for pump dio events
-        dio_pumps_df = all_dio_df[all_dio_df["dio_event_names"].isin(pump_dio_names)]
+        pumps = np.where(has_name("pump"))[0]  # filter for pump dio events
         # Only consider dio down events that happen after first dio up event
-        valid_idxs = []  # initialize valid idxs to empty list
-        if np.sum(dio_pumps_df["dio_event_values"] == 1) > 0:  # if dio up events
-            idx_first_up = np.where(dio_pumps_df["dio_event_values"] == 1)[0][0]
-            valid_idxs = np.arange(idx_first_up, len(dio_pumps_df))
-        dio_pumps_df = dio_pumps_df.iloc[valid_idxs]
+        pump_ups = np.where(values[pumps] == 1)[0]
+        pumps = pumps[pump_ups[0] :] if len(pump_ups) > 0 else pumps[:0]
+        dio_pumps_df = events_df(pumps)
         ProcessedDioEvents.Pumps.insert1(
             {
                 **key,
@@ -476,6 +432,37 @@ class ProcessedDioEvents(dj.Computed):
         )
 
 
+def merge_dio_events(dio_names, dio_event_times, dio_event_values):
+    """events of all DIO channels as one time sorted stream
+
+    Parameters
+    ----------
+    dio_names : array-like
+        name of each DIO channel, must be unique
+    dio_event_times, dio_event_values : list
+        event times and values of each channel
+
+    Returns
+    -------
+    codes, times, values : np.ndarray
+        index into dio_names, time and value of each event, sorted by time
+        (events at the same time keep their channel order)
+    """
+    if len(set(dio_names)) != len(dio_names):
+        raise Exception(f"DIO names must be unique, got {list(dio_names)}")
+    dio_event_times = [np.asarray(x, dtype=np.float64) for x in dio_event_times]
+    dio_event_values = [np.asarray(x) for x in dio_event_values]
+    codes = np.repeat(
+        np.arange(len(dio_event_times)), [len(x) for x in dio_event_times]
+    )
+    if len(codes) == 0:
+        return codes, np.zeros(0), np.zeros(0)
+    times = np.concatenate(dio_event_times)
+    values = np.concatenate(dio_event_values)
+    order = np.argsort(times, kind="stable")
+    return codes[order], times[order], values[order]
+
+
 # Checked that the following assignments hold in metadata files (at /cumulus/amankili/{animal_name}/metadata) for:
 # Winnie20220719.yml, Winnie20220720.yml
 def get_poke_map():
@@ -4,8 +4,286 @@ import numpy as np
 import matplotlib.pyplot as plt
 from spyglass.utils.dj_mixin import SpyglassMixin
 
+from ms_stim_analysis.Analysis.spike_annotation import interval_membership
+
 schema = dj.schema("ms_opto_stim_protocol")
 
+# (nwb_file_name, dio_event_name) -> (data, timestamps) of the whole session
+_session_dio_cache = {}
+# (nwb_file_name, dio_event_name, interval_list_name) -> epoch interval
+_stimulus_interval_cache = {}
+
+
+def clear_stimulus_cache(nwb_file_name: str = None):
+    """forget the DIO streams loaded by fetch_epoch_dio
+
+    Parameters
+    ----------
+    nwb_file_name : str, optional
+        only forget this session, by default all sessions
+    """
+    for cache in (_session_dio_cache, _stimulus_interval_cache):
+        for cache_key in list(cache):
+            if nwb_file_name is None or cache_key[0] == nwb_file_name:
+                del cache[cache_key]
+
+
+def fetch_session_dio(nwb_file_name: str, dio_event_name: str):
+    """data and timestamps of a session's DIO event stream, read once
+
+    Returns
+    -------
+    data, time : np.ndarray
+        whole session arrays, shared between calls and not to be modified
+    """
+    cache_key = (nwb_file_name, dio_event_name)
+    if cache_key not in _session_dio_cache:
+        dio_info = sgc.DIOEvents() & {
+            "nwb_file_name": nwb_file_name,
+            "dio_event_name": dio_event_name,
+        }
+        dio_data = dio_info.fetch_nwb()[0]["dio"]
+        _session_dio_cache[cache_key] = (
+            np.asarray(dio_data.data[:]),
+            np.asarray(dio_data.timestamps[:]),
+        )
+    return _session_dio_cache[cache_key]
+
+
+def fetch_epoch_dio(key: dict):
+    """DIO events of an epoch, sliced from the cached session stream
+
+    The session stream is loaded once per (nwb_file_name, dio_event_name) and
+    the epoch interval once per interval list (see clear_stimulus_cache). DIO
+    timestamps are sorted, so the epoch is found with searchsorted.
+
+    Parameters
+    ----------
+    key : dict
+        nwb_file_name, interval_list_name and dio_event_name
+
+    Returns
+    -------
+    data, time : np.ndarray
+        events with interval[0] <= time <= interval[1], copies
+    interval : np.ndarray
+        first valid time interval of the epoch
+    """
+    cache_key = (key["nwb_file_name"], key["dio_event_name"], key["interval_list_name"])
+    if cache_key not in _stimulus_interval_cache:
+        _stimulus_interval_cache[cache_key] = (
+            sgc.IntervalList
+            & {
+                "nwb_file_name": key["nwb_file_name"],
+                "interval_list_name": key["interval_list_name"],
+            }
+        ).fetch1("valid_times")[0]
+    interval = _stimulus_interval_cache[cache_key]
+    data, time = fetch_session_dio(key["nwb_file_name"], key["dio_event_name"])
+    start = np.searchsorted(time, interval[0], side="left")
+    stop = np.searchsorted(time, interval[1], side="right")
+    return data[start:stop].copy(), time[start:stop].copy(), interval
+
+
+def collapse_repeated_states(data: np.ndarray, time: np.ndarray):
+    """keep only the first sample of each run of repeated DIO states"""
+    data = np.asarray(data)
+    time = np.asarray(time, dtype=np.float64)
+    if len(data):
+        change = np.ones(len(data), dtype=bool)
+        change[1:] = data[1:] != data[:-1]
+        data, time = data[change], time[change]
+    return data, time
+
+
+def stimulus_edges(data: np.ndarray, time: np.ndarray, interval: np.ndarray):
+    """on/off transitions of an epoch's DIO stream, starting and ending off
+
+    Repeated states are collapsed to their first sample (see
+    collapse_repeated_states) and an off state is added at the start or end
+    of the interval if the stream starts or ends on.
+
+    Returns
+    -------
+    data, time : np.ndarray
+        alternating states and their times
+    ends_off : bool
+        whether the stream itself ended in an off state
+    """
+    data, time = collapse_repeated_states(data, time)
+    # the session starts with probe off
+    # TODO confrim this with abhilasha or with the data
+    if len(data) == 0 or data[0] == 1:
+        data = np.append([0], data)
+        time = np.append([interval[0]], time)
+    ends_off = data[-1] != 1
+    if not ends_off:
+        data = np.append(data, [0])
+        time = np.append(time, [interval[-1]])
+    return data, time, ends_off
+
+
+def infer_opto_protocol(
+    data: np.ndarray, time: np.ndarray, interval: np.ndarray, params: dict
+) -> dict:
+    """infer the stimulus protocol of an epoch from its DIO stream
+
+    On and off durations come from the alternating transitions of
+    stimulus_edges. Off gaps are classified once against the thresholds in
+    params: gaps above control_interval_threshold split control intervals,
+    gaps below behavior_defined_off_threshold are train delays, and for pulse
+    trains gaps above train_delay_threshold segment the pulses into trains.
+
+    Parameters
+    ----------
+    data, time : np.ndarray
+        DIO states and timestamps inside the epoch
+    interval : np.ndarray
+        [start, stop] of the epoch
+    params : dict
+        OptoStimProtocolParams params
+
+    Returns
+    -------
+    dict
+        OptoStimProtocol secondary attributes
+    """
+    data, time, ends_off = stimulus_edges(data, time, interval)
+
+    # check if there's any stim in this period. If not, call it all control
+    if data.sum() == 0:
+        return {
+            "control_intervals": [interval],
+            "test_intervals": [],
+            "pulse_length_ms": -1,
+            "inter_pulse_interval_ms": -1,
+            "inter_train_interval_ms": -1,
+            "period_ms": -1,
+            "pulses_per_train": -1,
+            "number_trains": -1,
+            "stim_on": False,
+            "optogenetic_protocol": "None",
+        }
+
+    # times the stim changes state and the durations between them
+    t_switch_on = time[data > 0]
+    t_switch_off = time[data == 0]
+    duration_off = t_switch_on - t_switch_off[:-1]
+    duration_on = t_switch_off[1:] - t_switch_on
+
+    # control intervals are the long off gaps (and the end of the epoch)
+    is_control = duration_off > params["control_interval_threshold"]
+    control = np.stack([t_switch_off[:-1][is_control], t_switch_on[is_control]], 1)
+    if ends_off and interval[-1] - time[-1] > params["control_interval_threshold"]:
+        control = np.vstack([control, [time[-1], interval[1]]])
+    # fill in the rest of the epoch with test intervals
+    if len(control):
+        test = np.stack([control[:-1, 1], control[1:, 0]], 1)
+        if control[0, 0] > interval[0]:  # epoch starts in a test interval
+            test = np.vstack([[interval[0], control[0, 0]], test])
+        if control[-1, 1] != interval[1]:  # epoch doesn't end in a control
+            test = np.vstack([test, [control[-1, 1], interval[1]]])
+        test_intervals = list(test)
+    else:
+        test_intervals = [interval]
+
+    protocol = {
+        "control_intervals": list(control),
+        "test_intervals": test_intervals,
+        "pulse_length_ms": int(np.round(np.median(duration_on) * 1000)),
+        "inter_pulse_interval_ms": -1,
+        "inter_train_interval_ms": -1,
+        "period_ms": -1,
+        "pulses_per_train": -1,
+        "number_trains": -1.0,
+        "stim_on": True,
+        "optogenetic_protocol": params["optogenetic_protocol"],
+    }
+
+    # delays within the stimulation, without control and spatially defined pauses
+    is_train_delay = duration_off < params["behavior_defined_off_threshold"]
+    if params["optogenetic_protocol"] == "phase_targeting":
+        # only calculate the inter stimulus interval
+        protocol["inter_pulse_interval_ms"] = int(
+            np.round(np.median(duration_off[is_train_delay]) * 1000)
+        )
+    elif params["optogenetic_protocol"] == "pulse_train":
+        # pulses separated by more than the train threshold start a new train
+        new_train = duration_off > params["train_delay_threshold"]
+        intra_train = is_train_delay & (duration_off < params["train_delay_threshold"])
+        # only single pulse trains, (with a buffer for artifacts/short pauses)
+        if np.sum(intra_train) > 100:
+            protocol["inter_pulse_interval_ms"] = int(
+                np.round(np.median(duration_off[intra_train]) * 1000)
+            )
+        protocol["inter_train_interval_ms"] = int(
+            np.round(np.median(duration_off[is_train_delay & new_train]) * 1000)
+        )
+        # pulses per train and the period between the end of each train
+        train_starts = np.where(new_train)[0]
+        pulses_per_train = np.median(np.diff(train_starts))
+        protocol["pulses_per_train"] = int(pulses_per_train)
+        train_period = np.diff(t_switch_off[train_starts])
+        protocol["period_ms"] = int(
+            np.round(
+                np.median(
+                    train_period[
+                        train_period < params["behavior_defined_off_threshold"]
+                    ]
+                )
+                * 1000
+            )
+        )
+        # observed number of trains between behavior pauses
+        behavior_pauses = np.where(
+            duration_off > params["behavior_defined_off_threshold"]
+        )[0]
+        number_trains = np.mean(np.diff(behavior_pauses) / pulses_per_train)
+        if not np.isnan(number_trains):
+            protocol["number_trains"] = float(number_trains)
+    return protocol
+
+
+def infer_opto_protocols(keys: list) -> list:
+    """OptoStimProtocol rows for many selection keys without inserting them
+
+    Keys are processed session by session so each DIO stream is read once
+    (see fetch_epoch_dio) and dropped from the cache once the session is
+    done, e.g. to compare parameter sets before repopulating the table.
+
+    Parameters
+    ----------
+    keys : list
+        OptoStimProtocolSelection keys
+
+    Returns
+    -------
+    list
+        {**key, **infer_opto_protocol(...)} for each key, in order
+    """
+    rows = [None] * len(keys)
+    params = {}
+    order = sorted(
+        range(len(keys)),
+        key=lambda i: (keys[i]["nwb_file_name"], keys[i]["dio_event_name"]),
+    )
+    for n, i in enumerate(order):
+        key = keys[i]
+        name = key["opto_infer_params_name"]
+        if name not in params:
+            params[name] = (
+                OptoStimProtocolParams & {"opto_infer_params_name": name}
+            ).fetch1("params")
+        data, time, interval = fetch_epoch_dio(key)
+        rows[i] = {**key, **infer_opto_protocol(data, time, interval, params[name])}
+        # drop the session's DIO streams once all of its keys are done
+        if (
+            n + 1 == len(order)
+            or keys[order[n + 1]]["nwb_file_name"] != key["nwb_file_name"]
+        ):
+            clear_stimulus_cache(key["nwb_file_name"])
+    return rows
+
 
 @schema
 class OptoStimProtocolParams(SpyglassMixin, dj.Manual):
@@ -99,191 +377,12 @@ class OptoStimProtocol(SpyglassMixin, dj.Computed):
     def make(self, key):
         print(f"Computing optogenetic protocols for: {key}")
         params = (OptoStimProtocolParams() & key).fetch1("params")
-
-        # fetch epoch interval information
-        interval = (sgc.IntervalList & key).fetch1("valid_times")[0]
-        # gets the time and opt data for that epoch interval
-        dio_info = sgc.DIOEvents() & {
-            "nwb_file_name": key["nwb_file_name"],
-            "dio_event_name": key["dio_event_name"],
-        }
-        dio_data = dio_info.fetch_nwb()[0]["dio"]
-        time = dio_data.timestamps[:]
-        epoch_index = np.where((time >= interval[0]) & (time <= interval[1]))[0]
-        data = dio_data.data[epoch_index]
-        time = time[epoch_index]
-        control_intervals = []
-        test_intervals = []
-        # append an off event at the beginning and end of the epoch if necessary, indicates the session starts with probe off
-        # TODO confrim this with abhilasha or with the data
-        if len(data) == 0 or (data[0] == 1):
-            data = np.append(
-                [
-                    0,
-                ],
-                data,
-            )
-            time = np.append([interval[0]], time)
-        if len(data) == 0 or (data[-1] == 1):
-            data = np.append(
-                data,
-                [
-                    0,
-                ],
-            )
-            time = np.append(
-                time,
-                [interval[-1]],
-            )
-            add_end_control_interval = False
-        else:
-            add_end_control_interval = True
-
-        # check if there's any stim in this period. If not, call it all control and exit
-        if data.sum() == 0:
-            control_intervals.append(
-                interval,
-            )
-            test_intervals = []
-            self.insert1(
-                {
-                    **key,
-                    "control_intervals": control_intervals,
-                    "test_intervals": test_intervals,
-                    "pulse_length_ms": -1,
-                    "inter_pulse_interval_ms": -1,
-                    "inter_train_interval_ms": -1,
-                    "period_ms": -1,
-                    "pulses_per_train": -1,
-                    "number_trains": -1,
-                    "stim_on": False,
-                    "optogenetic_protocol": "None",
-                }
-            )
-            return
-        else:
-            stim_on = True
-        # find the times when the stim changes state and the duration of time between when it does
-        t_switch_on = time[data > 0]
-        t_switch_off = time[data == 0]
-        duration_off = t_switch_on - t_switch_off[:-1]
-        # define control intervals based on threshold
-        index_control_list = np.where(
-            duration_off > params["control_interval_threshold"]
-        )[0]
-        control_intervals.extend(
-            [
-                np.array([t_switch_off[index_control], t_switch_on[index_control]])
-                for index_control in index_control_list
-            ]
-        )
-        # check if it ends in a control interval:
-        if add_end_control_interval:
-            # if naturally ended in an off, check if control interval belongs there
-            if interval[-1] - time[-1] > params["control_interval_threshold"]:
-                control_intervals.append(np.array([time[-1], interval[1]]))
-        # fill in the rest of the interval with test_intervals
-        test_intervals = []
-        for i in range(len(control_intervals)):
-            if i == 0:
-                if (
-                    control_intervals[i][0] > interval[0]
-                ):  # if epoch starts in test interval
-                    test_intervals.append(
-                        np.array(
-                            [interval[0], control_intervals[0][0]],
-                        )
-                    )
-            if i + 1 == len(control_intervals):
-                # add final test interval if it doesn't end in a control
-                if not (control_intervals[i][1] == interval[1]):
-                    test_intervals.append(
-                        np.array([control_intervals[i][1], interval[1]])
-                    )
-                break
-            test_intervals.append(
-                np.array([control_intervals[i][1], control_intervals[i + 1][0]])
-            )
-        if len(control_intervals) == 0:
-            test_intervals.append(interval)
-        # identify the pulse duration
-        duration_on = t_switch_off[1:] - t_switch_on[:]
-        pulse_length_ms = np.round(
-            np.median(duration_on) * 1000,
-        )  # units ms
-
-        # calculate delay intervals, remove the control off period and spatially defined off events
-        train_delays = duration_off[
-            duration_off < params["behavior_defined_off_threshold"]
-        ]
-        if params["optogenetic_protocol"] == "phase_targeting":
-            # only calculate the inter stimulus interval
-            inter_pulse_interval_ms = np.round(np.median(train_delays) * 1000)
-            inter_train_interval_ms = -1
-            period_ms = -1
-            pulses_per_train = -1
-            number_trains = -1
-        elif params["optogenetic_protocol"] == "pulse_train":
-            # calculate within-train delays
-            intra_train_delays = train_delays[
-                train_delays < params["train_delay_threshold"]
-            ]  # delays that are shorter than the new train threshold
-            print("INTRATRAINS: ", len(intra_train_delays))
-            if (
-                len(intra_train_delays) <= 100
-            ):  # only single pulse trains, (with a buffer for artifacts/short pauses)
-                inter_pulse_interval_ms = -1
-            else:
-                inter_pulse_interval_ms = np.round(np.median(intra_train_delays) * 1000)
-            # calculate delay between trains
-            inter_train_interval_ms = np.round(
-                np.median(train_delays[train_delays > params["train_delay_threshold"]])
-                * 1000
-            )
-            # calculate number of pulses per train (= # pulses between super train threshold events)
-            index_intertrain_delays = np.where(
-                duration_off > params["train_delay_threshold"]
-            )[0]
-            pulses_per_train = np.median(
-                index_intertrain_delays[1:] - index_intertrain_delays[:-1]
-            )
-            # calculate the period between the end of each train
-            t_intertrain_delays = t_switch_off[
-                index_intertrain_delays
-            ]  # the times when intertrain delays begin
-            intertrain_period = t_intertrain_delays[1:] - t_intertrain_delays[:-1]
-            intertrain_period = intertrain_period[
-                intertrain_period < params["behavior_defined_off_threshold"]
-            ]  # filter delays including behaviorally define pauses
-            period_ms = np.round(np.median(intertrain_period) * 1000)
-            # calculate the observed number of trains between pauses
-            index_interbehavior_delays = np.where(
-                duration_off > params["behavior_defined_off_threshold"]
-            )[0]
-            number_trains = np.mean(
-                (index_interbehavior_delays[1:] - index_interbehavior_delays[:-1])
-                / pulses_per_train
-            )
-            if np.isnan(number_trains):
-                number_trains = -1
-            print(index_interbehavior_delays)
-            print("TYPE:", type(float(number_trains)), number_trains)
-        self.insert1(
-            {
-                **key,
-                "control_intervals": control_intervals,
-                "test_intervals": test_intervals,
-                "pulse_length_ms": int(pulse_length_ms),
-                "inter_pulse_interval_ms": int(inter_pulse_interval_ms),
-                "inter_train_interval_ms": int(inter_train_interval_ms),
-                "period_ms": int(period_ms),
-                "pulses_per_train": int(pulses_per_train),
-                "number_trains": float(number_trains),
-                "stim_on": True,
-                "optogenetic_protocol": params["optogenetic_protocol"],
-            }
-        )
-        self.make_opto_intervals(key)
+        # gets the epoch interval and the time and opt data for that interval
+        data, time, interval = fetch_epoch_dio(key)
+        protocol = infer_opto_protocol(data, time, interval, params)
+        self.insert1({**key, **protocol})
+        if protocol["stim_on"]:
+            self.make_opto_intervals(key)
 
     def get_protocol_type(self, key):
         return (self & key).fetch("optogenetic_protocol")
@@ -313,34 +412,14 @@ class OptoStimProtocol(SpyglassMixin, dj.Computed):
         if "dio_event_name" not in key:
             key["dio_event_name"] = "stim"
         # gets the time and optognetic data for that epoch interval
-        interval = (sgc.IntervalList & key).fetch1("valid_times")[0]
-        dio_info = sgc.DIOEvents() & {
-            "nwb_file_name": key["nwb_file_name"],
-            "dio_event_name": key["dio_event_name"],
-        }
-        dio_data = dio_info.fetch_nwb()[0]["dio"]
-        time = dio_data.timestamps[:]
-        epoch_index = np.where((time >= interval[0]) & (time <= interval[1]))[0]
-        data = dio_data.data[epoch_index]
+        data, time, interval = fetch_epoch_dio(key)
         if len(data) == 0:
             return np.array([]), np.array([])
-        time = time[epoch_index]
-        # add a intial off state to indicate interval starts with stimulus off
-        if initial_zero and not (data[0] == 0):
-            data = np.append(
-                [
-                    0,
-                ],
-                data,
-            )
-            time = np.append([interval[0]], time)
-        # add a final off state to indicate interval ends with stimulus off
-        if initial_zero and not (data[-1] == 0):
-            data = np.append(data, [0])
-            time = np.append(
-                time,
-                [interval[-1]],
-            )
+        if initial_zero:
+            # the same alternating transitions the protocol is inferred from
+            data, time, _ = stimulus_edges(data, time, interval)
+        else:
+            data, time = collapse_repeated_states(data, time)
         if convert_to_plot_format:
             data_plot = []
             time_plot = []
@@ -395,8 +474,7 @@ class OptoStimProtocol(SpyglassMixin, dj.Computed):
         if stim.size == 0:
             return
         ind_on = np.where(stim == 1)[0]
-        stim_intervals = [[stim_time[i], stim_time[i + 1]] for i in ind_on]
-        stim_intervals = np.array(stim_intervals)
+        stim_intervals = np.stack([stim_time[ind_on], stim_time[ind_on + 1]], axis=1)
         stim_interval_key = {
             "nwb_file_name": key["nwb_file_name"],
             "interval_list_name": key["interval_list_name"] + "_stimulus_on_interval",
@@ -406,6 +484,135 @@ class OptoStimProtocol(SpyglassMixin, dj.Computed):
         return
 
 
+def label_pulses(data: np.ndarray, time: np.ndarray, cycle_threshold: float) -> dict:
+    """onset, offset and position in its cycle of every pulse of a stimulus
+
+    A cycle starts at each pulse preceded by more than cycle_threshold of off
+    time, as in get_cylcle_begin_timepoints. Pulses before the first cycle
+    start are counted from the first pulse.
+
+    Parameters
+    ----------
+    data, time : np.ndarray
+        alternating on/off stimulus states starting with off, as returned by
+        OptoStimProtocol.get_stimulus
+    cycle_threshold : float
+        off time (s) that starts a new cycle
+
+    Returns
+    -------
+    dict
+        pulse_on, pulse_off: times of each pulse
+        cycle_id: cycle of each pulse, 0 before the first cycle start
+        pulse_number: 0-indexed count of each pulse in its cycle
+    """
+    ind_on = np.where(data == 1)[0]
+    pulse_on = time[ind_on]
+    t_switch_off = time[data == 0]
+    cycle_start = pulse_on - t_switch_off[: len(pulse_on)] > cycle_threshold
+    # index of the last cycle start at or before each pulse
+    pulse_index = np.arange(len(pulse_on))
+    start_index = np.maximum.accumulate(np.where(cycle_start, pulse_index, 0))
+    return {
+        "pulse_on": pulse_on,
+        "pulse_off": time[ind_on + 1],
+        "cycle_id": np.cumsum(cycle_start),
+        "pulse_number": pulse_index - start_index,
+    }
+
+
+@schema
+class OptoStimPulses(SpyglassMixin, dj.Computed):
+    """
+    Every stimulus pulse of an OptoStimProtocol entry, labeled with its cycle
+    """
+
+    definition = """
+    -> OptoStimProtocol
+    ---
+    pulse_on: longblob  # onset time of each pulse
+    pulse_off: longblob  # offset time of each pulse
+    cycle_id: longblob  # cycle of each pulse, 0 before the first cycle start
+    pulse_number: longblob  # 0-indexed count of each pulse in its cycle
+    test: longblob  # whether each pulse starts in a test interval
+    """
+
+    def make(self, key):
+        threshold = (OptoStimProtocolParams & key).fetch1("params")[
+            "behavior_defined_off_threshold"
+        ]
+        data, time = OptoStimProtocol().get_stimulus(key)
+        pulses = label_pulses(data, time, threshold)
+        test_intervals = (OptoStimProtocol & key).fetch1("test_intervals")
+        pulses["test"] = interval_membership(test_intervals, pulses["pulse_on"])
+        self.insert1({**key, **pulses})
+
+    def fetch_pulses(self, key: dict) -> dict:
+        """pulse arrays of the protocol entry matching key
+
+        Read only, populate OptoStimPulses for the epochs first (e.g. before
+        starting a map_epochs pool) so workers never insert concurrently.
+
+        Parameters
+        ----------
+        key : dict
+            restriction matching one OptoStimProtocol entry, dio_event_name
+            defaults to "stim" as in get_stimulus
+
+        Returns
+        -------
+        dict
+            pulse_on, pulse_off, cycle_id, pulse_number and test arrays
+        """
+        key = {"dio_event_name": "stim", **key}
+        protocol_keys = (OptoStimProtocol & key).fetch("KEY")
+        if len(protocol_keys) != 1:
+            raise ValueError(
+                f"key matches {len(protocol_keys)} OptoStimProtocol entries: {key}"
+            )
+        if not OptoStimPulses & protocol_keys[0]:
+            raise ValueError(
+                f"no OptoStimPulses entry for {protocol_keys[0]}, populate it first"
+            )
+        names = ["pulse_on", "pulse_off", "cycle_id", "pulse_number", "test"]
+        return dict(zip(names, (OptoStimPulses & protocol_keys[0]).fetch1(*names)))
+
+    def fetch_marks(self, key: dict, marks: str) -> np.ndarray:
+        """pulse times to align to
+
+        Parameters
+        ----------
+        key : dict
+            see fetch_pulses
+        marks : str
+            first_pulse: first pulse of each cycle
+            all_pulses: every pulse
+            odd_pulses: pulses with an odd (0-indexed) count in their cycle
+            dummy_cycle=x: each cycle start followed by 10 marks at x Hz
+
+        Returns
+        -------
+        np.ndarray
+            mark times
+        """
+        pulses = self.fetch_pulses(key)
+        pulse_on = pulses["pulse_on"]
+        cycle_start = (pulses["pulse_number"] == 0) & (pulses["cycle_id"] > 0)
+        if marks == "first_pulse":
+            return pulse_on[cycle_start]
+        if marks == "all_pulses":
+            return pulse_on
+        if marks == "odd_pulses":
+            return pulse_on[pulses["pulse_number"] % 2 == 1]
+        if "dummy_cycle" in marks:
+            dummy_freq = int(marks.split("=")[-1])
+            t = pulse_on[cycle_start][:, None]
+            return np.concatenate([t, t + np.arange(10) / dummy_freq], axis=1).ravel()
+        raise ValueError(
+            "marks must be in [first_pulse, all_pulses, odd_pulses, dummy_cycle]"
+        )
+
+
 @schema
 class OptoStimProtocolTransfected(dj.Manual):
     """
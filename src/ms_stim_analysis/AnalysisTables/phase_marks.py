@@ -0,0 +1,131 @@
+import datajoint as dj
+import numpy as np
+
+from spyglass.lfp.analysis.v1 import LFPBandV1
+from spyglass.position.v1 import TrodesPosV1
+from spyglass.utils.dj_mixin import SpyglassMixin
+
+from ms_stim_analysis.Analysis.lfp_analysis import get_ref_electrode_index
+from ms_stim_analysis.Analysis.lfp_band_cache import fetch_band_phase
+from ms_stim_analysis.Analysis.position_analysis import (
+    filter_position_ports,
+    get_running_intervals,
+)
+from ms_stim_analysis.Analysis.spike_annotation import interval_membership
+from ms_stim_analysis.Analysis.utils import get_position_interval_name
+
+schema = dj.schema("ms_phase_marks")
+
+
+@schema
+class PhaseMarkParams(SpyglassMixin, dj.Lookup):
+    definition = """
+    phase_mark_name: varchar(32)
+    ---
+    filter_name: varchar(80)  # LFP band the phase is taken from
+    target_phase: float  # marks are upward crossings of this phase (rad, compute_signal_phase convention)
+    filter_speed = 10: float  # speed threshold (cm/s) for the running flag
+    """
+
+    contents = [
+        ("theta_peak", "Theta 5-11 Hz", np.pi, 10),
+    ]
+
+
+@schema
+class PhaseMarks(SpyglassMixin, dj.Computed):
+    definition = """
+    -> LFPBandV1
+    -> PhaseMarkParams
+    ---
+    electrode_id: int  # reference electrode the phase is taken from
+    mark_times: longblob  # every crossing of the target phase in the band
+    running: longblob  # whether each mark is in a running interval
+    valid_position: longblob  # whether each mark is away from the ports
+    """
+
+    @property
+    def key_source(self):
+        # only mark the band each phase mark is defined on
+        return (LFPBandV1 * PhaseMarkParams.proj(mark_filter_name="filter_name")) & (
+            "filter_name = mark_filter_name"
+        )
+
+    def make(self, key):
+        params = (PhaseMarkParams & key).fetch1()
+
+        # find positive zero crossings of the phase relative to the target
+        ref_elect, _ = get_ref_electrode_index(
+            {
+                "nwb_file_name": key["nwb_file_name"],
+                "target_interval_list_name": key["target_interval_list_name"],
+            }
+        )
+        band_key = {k: v for k, v in key.items() if k in LFPBandV1.primary_key}
+        phase_df = fetch_band_phase(band_key, [ref_elect])
+        phase_ = np.asarray(phase_df)[:, 0] - params["target_phase"]
+        pos_zero_crossings = np.where(np.diff(np.sign(phase_)) > 0)[0]
+        marks = np.asarray(phase_df.index)[pos_zero_crossings]
+
+        running = np.zeros(len(marks), dtype=bool)
+        valid_position = np.zeros(len(marks), dtype=bool)
+        pos_key = {
+            "nwb_file_name": key["nwb_file_name"],
+            "interval_list_name": key["target_interval_list_name"],
+        }
+        if not (TrodesPosV1 & pos_key):
+            # try converting to position interval name
+            pos_key["interval_list_name"] = get_position_interval_name(
+                key["nwb_file_name"], key["target_interval_list_name"]
+            )
+        if TrodesPosV1 & pos_key:
+            run_intervals = get_running_intervals(
+                **pos_key, filter_speed=params["filter_speed"]
+            )
+            running = interval_membership(np.array(run_intervals), marks)
+            valid_position_intervals = filter_position_ports(pos_key)
+            if valid_position_intervals is not None:
+                valid_position = interval_membership(
+                    np.array(valid_position_intervals), marks
+                )
+        else:
+            print("no position data for", key)
+
+        self.insert1(
+            {
+                **key,
+                "electrode_id": ref_elect,
+                "mark_times": marks,
+                "running": running,
+                "valid_position": valid_position,
+            }
+        )
+
+    def fetch_marks(
+        self, running: bool = True, valid_position: bool = True
+    ) -> np.ndarray:
+        """mark times of the first matching entry, selected by the flags
+
+        Parameters
+        ----------
+        running : bool, optional
+            only return marks while the rat is running, by default True
+        valid_position : bool, optional
+            only return marks away from the ports, by default True
+
+        Returns
+        -------
+        np.ndarray
+            mark times
+        """
+        mark_times, is_running, is_valid_position = self.fetch(
+            "mark_times", "running", "valid_position"
+        )
+        if len(mark_times) == 0:
+            return np.array([])
+        mask = np.ones(len(mark_times[0]), dtype=bool)
+        if running:
+            mask &= is_running[0]
+        if valid_position:
+            mask &= is_valid_position[0]
+        return mark_times[0][mask]
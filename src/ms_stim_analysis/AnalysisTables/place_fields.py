@@ -20,6 +20,8 @@ from spyglass.decoding.v1.sorted_spikes import SortedSpikesDecodingV1
 from spyglass.decoding.v1.clusterless import ClusterlessDecodingV1
 from spyglass.utils.dj_mixin import SpyglassMixin, SpyglassMixinPart
 
+from ms_stim_analysis.Analysis.decoder_cache import fetch_encoding_summary
+
 schema = dj.schema("ms_place_fields")
 
 
@@ -105,10 +107,10 @@ class OptoPlaceField(SpyglassMixin, dj.Computed):
 
         # calculate the values
         for data_key in datasets:
-            fit_model = (SortedSpikesDecodingV1 & data_key).fetch_model()
+            encoding = fetch_encoding_summary(data_key)
 
             # get place fields
-            place_field = list(fit_model.encoding_model_.values())[0]["place_fields"]
+            place_field = encoding["place_fields"]
             norm_place_field = place_field / np.sum(place_field, axis=1, keepdims=True)
             place_field_list.append(norm_place_field)
             raw_place_field_list.append(place_field)
@@ -126,8 +128,6 @@ class OptoPlaceField(SpyglassMixin, dj.Computed):
             )
 
             # get information rates
-            encoding = fit_model.encoding_model_
-            encoding = encoding[list(encoding.keys())[0]]
             p_loc = encoding["occupancy"]
             p_loc = p_loc / p_loc.sum()
             if not p_loc.size == place_field.shape[1]:
@@ -3,10 +3,13 @@ import datajoint as dj
 
 from spyglass.lfp.v1 import LFPV1
 from spyglass.ripple.v1 import RippleTimesV1
-from spyglass.common import IntervalList, get_electrode_indices
+from spyglass.common import IntervalList
 from spyglass.utils.dj_mixin import SpyglassMixin
 
-from ms_stim_analysis.Analysis.lfp_analysis import get_ref_electrode_index
+from ms_stim_analysis.Analysis.lfp_analysis import (
+    get_lfp_electrode_index,
+    get_ref_electrode_index,
+)
 
 schema = dj.schema("ms_ripple")
 
@@ -58,7 +61,7 @@ class MsLfpArtifact(SpyglassMixin, dj.Computed):
         lfp_eseries = (LFPV1 & key).fetch_nwb()[0][
             "lfp"
         ]  # (LFPOutput()).fetch_nwb(restriction=lfp_s_key)[0]["lfp"]
-        lfp_elect_indeces = get_electrode_indices(lfp_eseries, [ref_electrode])
+        lfp_elect_indeces = [get_lfp_electrode_index(lfp_s_key, ref_electrode)]
         if lfp_elect_indeces[0] > 1000:
             raise ValueError("lfp_elect_indeces: ", lfp_elect_indeces)
         time = lfp_eseries.timestamps
@@ -1,9 +1,13 @@
 import datajoint as dj
+import itertools
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
 from scipy.signal import find_peaks
 from scipy.stats import pearsonr
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 from spyglass.common.common_interval import Interval
 from spyglass.common import AnalysisNwbfile, IntervalList
@@ -12,9 +16,14 @@ from spyglass.spikesorting.analysis.v1.group import SortedSpikesGroup
 from spyglass.utils.dj_mixin import SpyglassMixin
 
 
+from ms_stim_analysis.Analysis.rate_maps import (
+    normalized_place_fields,
+    occupancy_map,
+    peak_ratio,
+    population_spike_counts,
+)
 from ms_stim_analysis.Analysis.utils import get_running_valid_intervals, smooth
 
-
 os.environ["JAX_PLATFORM_NAME"] = "cpu"
 
 schema = dj.schema("sambray_compression_index")
@@ -68,6 +77,10 @@ class CompressionIndex(SpyglassMixin, dj.Computed):
 
     """
 
+    # number of processes used for the pairwise delay calculation.
+    # None uses all available cores, 1 runs serially in the populating process
+    n_pair_workers = None
+
     def make(self, key):
         # read params
         params = (CompressionIndexParams & key).fetch1()
@@ -124,100 +137,90 @@ class CompressionIndex(SpyglassMixin, dj.Computed):
                 pos_df.linear_position.max() + 1,
                 pf_bin_size,
             )
-        occupancy = np.histogram(pos_df.linear_position, bins=pos_bins)[0]
+        linear_position = np.asarray(pos_df.linear_position)
+        occupancy = occupancy_map(linear_position, pos_bins)
+        # restrict to running once per unit, reused for all pairs below
+        unit_running_spikes = [
+            np.asarray(running_intervals.contains(s), dtype=np.float64) for s in spikes
+        ]
+        n_running = np.array([len(s) for s in unit_running_spikes])
+        # place fields of all units from one histogram over (unit, position bin)
+        all_running_spikes = np.concatenate(unit_running_spikes + [np.zeros(0)])
+        pos_s = linear_position[
+            np.digitize(all_running_spikes, pos_df.index.values) - 1
+        ]
+        fields = normalized_place_fields(
+            population_spike_counts(
+                np.repeat(np.arange(len(spikes)), n_running),
+                pos_s,
+                pos_bins,
+                len(spikes),
+            ),
+            occupancy,
+        )
+        # skip non-localized place fields
+        valid = (n_running >= min_running_spikes) & ~(
+            peak_ratio(fields) < pf_peak_ratio
+        )
         place_fields = {}
-        for s, s_id in zip(spikes, unit_ids):
-            s = running_intervals.contains(s)
-            if len(s) < min_running_spikes:
-                continue
-            pos_s = pos_df.linear_position.iloc[np.digitize(s, pos_df.index.values) - 1]
-            spikes_in_pos = np.histogram(pos_s, bins=pos_bins)[0]
-            field = spikes_in_pos / occupancy
-            field = field / np.nansum(field)
-
-            # skip non-localized place fields
-            if np.max(field) / np.median(field) < pf_peak_ratio:
-                continue
-            place_fields[s_id] = field
+        running_spikes = {}
+        for i in np.where(valid)[0]:
+            place_fields[unit_ids[i]] = fields[i]
+            running_spikes[unit_ids[i]] = unit_running_spikes[i]
+
+        # field locations and distances only depend on the unit, not the pair
+        field_locs = {}
+        for s_id, field in place_fields.items():
+            if graph_distance:
+                field_locs[s_id] = pos_bins[np.argmax(field)]
+            else:
+                field_locs[s_id] = np.average(pos_bins[:-1], weights=field)
+
+        # each unordered pair once, oriented so that s_id_1 > s_id_2
+        pf_ids = list(place_fields.keys())
+        unit_order = {s_id: i for i, s_id in enumerate(pf_ids)}
+        pairs = [
+            (a, b) if a > b else (b, a) for a, b in itertools.combinations(pf_ids, 2)
+        ]
+        pairs.sort(key=lambda x: (unit_order[x[0]], unit_order[x[1]]))
 
         # calculate needed delays
+        delay_params = dict(
+            delay_range=delay_range,
+            delay_smoothing=delay_smoothing,
+            smoothing_sigma=smoothing_sigma,
+            delay_distance=delay_distance,
+            min_coincident_spikes=min_coincident_spikes,
+        )
+        pair_results = _map_pair_delays(
+            running_spikes, pairs, delay_params, n_workers=self.n_pair_workers
+        )
 
-        delay_bins = np.arange(-2 * delay_range, 2 * delay_range, 1)
-        ind_relevant = np.where(np.abs(delay_bins) <= delay_range)[0]
-        # ind_relevant = np.where(np.logical_and(delay_bins >= 0, delay_bins <= delay_range))[0]
         results = []
-        for s1, s_id_1 in zip(spikes, unit_ids):
-            for s2, s_id_2 in zip(spikes, unit_ids):
-                # skip if not good place fields
-                if s_id_1 not in place_fields or s_id_2 not in place_fields:
-                    continue
-                # skip if same unit
-                if s_id_1 == s_id_2:
-                    continue
-                # only need to calculate each pair once
-                if s_id_1 < s_id_2:
-                    continue
-
-                field_1 = place_fields[s_id_1]
-                field_2 = place_fields[s_id_2]
-                field_loc_1 = np.average(pos_bins[:-1], weights=field_1)
-                field_loc_2 = np.average(pos_bins[:-1], weights=field_2)
-                if graph_distance:
-                    # distance = self._get_field_graph_distance(
-                    #     environment, field_1, field_2, pos_bins
-                    # )
-                    # print("HI")
-                    field_loc_1 = pos_bins[np.argmax(field_1)]
-                    field_loc_2 = pos_bins[np.argmax(field_2)]
-                    distance = self._get_pos_graph_distance(
-                        environment, field_loc_1, field_loc_2
-                    )
-                else:
-                    distance = np.abs(field_loc_1 - field_loc_2)
-
-                s1 = running_intervals.contains(s1)
-                s2 = running_intervals.contains(s2)
-                if len(s1) < min_coincident_spikes or len(s2) < min_coincident_spikes:
-                    continue
-
-                delays = np.subtract.outer(s1, s2) * 1000
-                delays = np.ravel(delays)
-                delays = delays[delays >= -delay_range * 2]
-                delays = delays[delays <= delay_range * 2]
-                if len(delays) < min_coincident_spikes:
-                    continue
-                cross_corr = np.histogram(delays, bins=delay_bins)[0]
-                if (
-                    n_coincident := cross_corr[ind_relevant].sum()
-                ) < min_coincident_spikes:
-                    continue
-                cross_corr = smooth(
-                    cross_corr, n=delay_smoothing, sigma=smoothing_sigma
-                )
-
-                # peak_delay = delay_bins[ind_relevant][np.argmax(cross_corr[ind_relevant])]
-                peak_inds = find_peaks(
-                    cross_corr[ind_relevant], distance=delay_distance
-                )
-                peak_times = delay_bins[1:][ind_relevant][peak_inds[0]]
-                if len(peak_times) == 0:
-                    continue
-                peak_delay = peak_times[
-                    np.argmin(np.abs(peak_times))
-                ]  # This is the peak closest to zero
-
-                results.append(
-                    {
-                        "s_id_1": s_id_1,
-                        "s_id_2": s_id_2,
-                        "field_loc_1": field_loc_1,
-                        "field_loc_2": field_loc_2,
-                        "distance": distance,
-                        "cross_corr": cross_corr,
-                        "peak_delay": peak_delay,
-                        "n_coincidients": n_coincident,
-                    }
+        for (s_id_1, s_id_2), pair_result in zip(pairs, pair_results):
+            if pair_result is None:
+                continue
+            field_loc_1 = field_locs[s_id_1]
+            field_loc_2 = field_locs[s_id_2]
+            if graph_distance:
+                distance = self._get_pos_graph_distance(
+                    environment, field_loc_1, field_loc_2
                 )
+            else:
+                distance = np.abs(field_loc_1 - field_loc_2)
+            cross_corr, peak_delay, n_coincident = pair_result
+            results.append(
+                {
+                    "s_id_1": s_id_1,
+                    "s_id_2": s_id_2,
+                    "field_loc_1": field_loc_1,
+                    "field_loc_2": field_loc_2,
+                    "distance": distance,
+                    "cross_corr": cross_corr,
+                    "peak_delay": peak_delay,
+                    "n_coincidients": n_coincident,
+                }
+            )
 
         results = pd.DataFrame(results)
         place_field_df = [
@@ -327,3 +330,149 @@ class CompressionIndex(SpyglassMixin, dj.Computed):
             edge_nodes_df.linear_position == pos_2
         ].node_id.values[0]
         return environment.distance_between_nodes_[node_id_1][node_id_2]
+
+
+# --- pairwise delay calculation ---
+# Spike trains are packed into a single shared memory block (concatenated
+# trains + offsets) so that worker processes can read them without each pair
+# being pickled and sent across.
+_worker_state = {}
+
+
+def _pair_delays(
+    s1,
+    s2,
+    delay_range,
+    delay_smoothing,
+    smoothing_sigma,
+    delay_distance,
+    min_coincident_spikes,
+):
+    """Smoothed cross-correlation and peak delay for a single pair of units.
+
+    Parameters
+    ----------
+    s1, s2 : np.ndarray
+        sorted spike times (s) restricted to the running intervals
+    delay_range : int
+        range of delays (ms) considered for the peak
+    delay_smoothing, smoothing_sigma : int, float
+        gaussian smoothing of the delay histogram
+    delay_distance : int
+        minimum distance between peaks in the delay histogram
+    min_coincident_spikes : int
+        minimum number of spikes/coincidences to keep the pair
+
+    Returns
+    -------
+    tuple or None
+        (cross_corr, peak_delay, n_coincident), None if the pair is rejected
+    """
+    if len(s1) < min_coincident_spikes or len(s2) < min_coincident_spikes:
+        return None
+    delay_bins = np.arange(-2 * delay_range, 2 * delay_range, 1)
+    ind_relevant = np.where(np.abs(delay_bins) <= delay_range)[0]
+
+    # only the s2 spikes within +-2*delay_range of each s1 spike contribute,
+    # find them with searchsorted instead of building the full outer difference
+    window = 2 * delay_range / 1000.0
+    margin = 1e-6
+    lo = np.searchsorted(s2, s1 - window - margin, side="left")
+    hi = np.searchsorted(s2, s1 + window + margin, side="right")
+    counts = hi - lo
+    if counts.sum() == 0:
+        return None
+    ref_ind = np.repeat(np.arange(len(s1)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    delays = (s1[ref_ind] - s2[np.repeat(lo, counts) + offsets]) * 1000
+    delays = delays[delays >= -delay_range * 2]
+    delays = delays[delays <= delay_range * 2]
+    if len(delays) < min_coincident_spikes:
+        return None
+    cross_corr = np.histogram(delays, bins=delay_bins)[0]
+    if (n_coincident := cross_corr[ind_relevant].sum()) < min_coincident_spikes:
+        return None
+    cross_corr = smooth(cross_corr, n=delay_smoothing, sigma=smoothing_sigma)
+
+    peak_inds = find_peaks(cross_corr[ind_relevant], distance=delay_distance)
+    peak_times = delay_bins[1:][ind_relevant][peak_inds[0]]
+    if len(peak_times) == 0:
+        return None
+    peak_delay = peak_times[np.argmin(np.abs(peak_times))]  # peak closest to zero
+    return cross_corr, peak_delay, n_coincident
+
+
+def _init_pair_worker(shm_name, n_spikes, offsets, delay_params):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_state["shm"] = shm  # keep a reference so the buffer stays mapped
+    _worker_state["spikes"] = np.ndarray((n_spikes,), dtype=np.float64, buffer=shm.buf)
+    _worker_state["offsets"] = offsets
+    _worker_state["delay_params"] = delay_params
+
+
+def _pair_worker(pair_inds):
+    spikes = _worker_state["spikes"]
+    offsets = _worker_state["offsets"]
+    results = []
+    for i, j in pair_inds:
+        s1 = spikes[offsets[i] : offsets[i + 1]]
+        s2 = spikes[offsets[j] : offsets[j + 1]]
+        results.append(_pair_delays(s1, s2, **_worker_state["delay_params"]))
+    return results
+
+
+def _map_pair_delays(running_spikes, pairs, delay_params, n_workers=None):
+    """Run `_pair_delays` over all pairs, in parallel if n_workers != 1.
+
+    Parameters
+    ----------
+    running_spikes : dict
+        unit id -> sorted spike times restricted to running
+    pairs : list of tuple
+        (s_id_1, s_id_2) pairs to compute
+    delay_params : dict
+        keyword arguments passed to `_pair_delays`
+    n_workers : int, optional
+        number of processes, defaults to os.cpu_count()
+
+    Returns
+    -------
+    list
+        result of `_pair_delays` for each pair, in the same order as `pairs`
+    """
+    if len(pairs) == 0:
+        return []
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = min(n_workers, len(pairs))
+    if n_workers <= 1:
+        return [
+            _pair_delays(running_spikes[a], running_spikes[b], **delay_params)
+            for a, b in pairs
+        ]
+
+    unit_ind = {s_id: i for i, s_id in enumerate(running_spikes.keys())}
+    trains = list(running_spikes.values())
+    offsets = np.concatenate([[0], np.cumsum([len(s) for s in trains])])
+    all_spikes = np.concatenate(trains).astype(np.float64)
+    pair_inds = np.array([(unit_ind[a], unit_ind[b]) for a, b in pairs])
+    chunks = np.array_split(pair_inds, min(len(pairs), n_workers * 8))
+
+    shm = shared_memory.SharedMemory(create=True, size=max(all_spikes.nbytes, 1))
+    try:
+        np.ndarray(all_spikes.shape, dtype=np.float64, buffer=shm.buf)[:] = all_spikes
+        # fork avoids re-importing the schema (and reconnecting) in each worker
+        ctx = multiprocessing.get_context(
+            "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        )
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=ctx,
+            initializer=_init_pair_worker,
+            initargs=(shm.name, len(all_spikes), offsets, delay_params),
+        ) as executor:
+            results = [r for chunk in executor.map(_pair_worker, chunks) for r in chunk]
+    finally:
+        shm.close()
+        shm.unlink()
+    return results